@@ -0,0 +1,200 @@
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from calibration import load_calibration
+from detectors import CASCADES, get_registry
+from frame import Frame
+from stereo import StereoMatcher
+from tp17storage import TP17Storage
+
+# people per frame the crowd dependent stages are measured at
+CROWDS = (1, 5, 20, 50)
+# file the baseline is saved to and compared with
+BASELINE = 'bench_baseline.json'
+# a stage is reported as a regression when its median gets slower than the baseline by this fraction
+TOLERANCE = 0.2
+# size of a chessboard square used in calibration, in meters, see distances.py
+SQUARE_SIZE = 0.0025
+# range of distances from the rig the synthetic people are at, in meters
+DISTANCES = (1.0, 6.0)
+
+
+def synthetic_frame(rng, width=Frame.WIDTH, height=Frame.HEIGHT):
+    '''
+    :returns a BGR noise image of the given size, cascades have to search all of it like a real frame
+    '''
+    return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def synthetic_points(rng, calibration, count, width=Frame.WIDTH, height=Frame.HEIGHT, noise=0.1):
+    '''
+    Builds left/right midpoints of count people by projecting random points in front of the rig
+    through both cameras, K1[I|0] and K2[R|T], so every pair lies on the epipolar line the
+    calibration's F gives, like the raw camera points the StereoMatcher gets
+
+    :param calibration: StereoCalibration of the rig, its camera matrices, R and T are in chessboard squares
+    :param noise: standard deviation of the detection error added to every point, in pixels
+
+    :returns (left, right) lists of (x, y) points, all of them inside both images
+    '''
+    K1, K2 = np.asarray(calibration.camera_matrix1, dtype=float), np.asarray(calibration.camera_matrix2, dtype=float)
+    R, T = np.asarray(calibration.R, dtype=float), np.asarray(calibration.T, dtype=float).reshape(3, 1)
+    left, right = np.empty((0, 2)), np.empty((0, 2))
+    while len(left) < count:
+        # a pixel of the left image and a distance, back projected to a point in chessboard squares
+        pixels = np.column_stack((rng.uniform(0, width, count), rng.uniform(0, height, count), np.ones(count)))
+        depth = rng.uniform(*DISTANCES, count) / SQUARE_SIZE
+        xyz = np.linalg.solve(K1, pixels.T) * depth
+        projected = (K1 @ xyz).T, (K2 @ (R @ xyz + T)).T
+        l, r = (p[:, :2] / p[:, 2:] + rng.normal(0, noise, (count, 2)) for p in projected)
+        inside = np.all((l >= 0) & (l < (width, height)) & (r >= 0) & (r < (width, height)), axis=1)
+        left, right = np.vstack((left, l[inside])), np.vstack((right, r[inside]))
+    return [tuple(p) for p in left[:count]], [tuple(p) for p in right[:count]]
+
+
+def measure(fn, repeat, setup=None):
+    '''
+    Times repeat calls of fn
+
+    :param fn: function to time, called with whatever setup returned, or nothing
+    :param repeat: number of timed calls
+    :param setup: optional function run before every call, not timed
+
+    :returns dict with p50, p90, p99 and max latency in milliseconds and throughput in calls per second
+    '''
+    times = np.empty(repeat)
+    for i in range(repeat):
+        args = () if setup is None else (setup(),)
+        began = time.perf_counter()
+        fn(*args)
+        times[i] = time.perf_counter() - began
+    p50, p90, p99 = np.percentile(times, (50, 90, 99)) * 1e3
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': times.max() * 1e3, 'per_second': repeat / times.sum()}
+
+
+def run(repeat=50, crowds=CROWDS, cascades=('face', 'upper', 'fullbody'), seed=0):
+    '''
+    Benchmarks every hot path on synthetic data, no cameras needed
+
+    :param repeat: timed calls per stage, detection stages get a fifth of these as they are much slower
+    :param crowds: people per frame for the matching, triangulation, counting and drawing stages
+    :param cascades: names of the cascades to time detection with
+    :param seed: seed of the synthetic data, same seed gives the same frames and points
+
+    :returns dict stage name -> measure() result
+    '''
+    rng = np.random.default_rng(seed)
+    calibration = load_calibration()
+    matcher = StereoMatcher(calibration.F, calibration.P1, calibration.P2, SQUARE_SIZE)
+    frame_img = synthetic_frame(rng)
+    camera_img = synthetic_frame(rng, 1280, 720)
+    results = {}
+
+    results['frame_init'] = measure(lambda: Frame(frame_img), repeat)
+    results['frame_init_resize'] = measure(lambda: Frame(camera_img), repeat)
+
+    registry = get_registry()
+    registry.load(cascades)
+    methods = {'face': Frame.detect_people, 'upper': Frame.detect_upper, 'fullbody': Frame.detect_fullbody}
+    for name in cascades:
+        detector = registry.borrow(name)
+        detect = methods.get(name, Frame.detect_people)
+        results['detect_' + name] = measure(lambda frame: detect(frame, detector), max(repeat // 5, 1),
+                                            lambda: Frame(frame_img.copy()))
+
+    storage_dir = tempfile.mkdtemp(prefix='bench_tp17db_')
+    try:
+        for crowd in crowds:
+            left, right = synthetic_points(rng, calibration, crowd)
+            boxes = [(int(x) - 20, int(y) - 20, 40, 40) for x, y in left]
+            pairs = matcher.match(left, right)
+            # otherwise the matching and triangulation numbers aren't for crowd people
+            if len(pairs) != crowd:
+                raise RuntimeError("Matched {} of {} synthetic people".format(len(pairs), crowd))
+            results['match_{}'.format(crowd)] = measure(lambda: matcher.match(left, right), repeat)
+            results['triangulate_{}'.format(crowd)] = measure(
+                lambda: matcher.triangulate(np.asarray(left)[pairs[:, 0]], np.asarray(right)[pairs[:, 1]]), repeat)
+
+            def counted():
+                frame = Frame(frame_img.copy())
+                frame.add_people(boxes)
+                return frame
+            results['count_sections_{}'.format(crowd)] = measure(Frame.count_sections, repeat, counted)
+            results['draw_boundaries_{}'.format(crowd)] = measure(Frame.draw_boundaries, repeat, counted)
+
+        storage = TP17Storage(storage_dir)
+        frame = counted()
+        frame.update_movements([0] * len(frame.sections))
+        # enough rows to cross a few segment writes, so the cost of flushing is part of the numbers
+        results['storage_add'] = measure(lambda: storage.add(frame), max(repeat * 200, 3 * storage.batch_rows))
+    finally:
+        shutil.rmtree(storage_dir)
+    return results
+
+
+def config():
+    '''
+    :returns the settings the numbers depend on, saved with the baseline so a comparison shows what changed
+    '''
+    return {'grid': Frame.SPLIT_DIV, 'size': [Frame.WIDTH, Frame.HEIGHT],
+            'cascades': json.loads(json.dumps({name: vars(spec) for name, spec in CASCADES.items()}))}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''
+    :returns list of (stage, baseline p50, current p50) for stages whose median got slower than the tolerance allows
+    '''
+    slower = []
+    for stage, current in results.items():
+        previous = baseline['results'].get(stage)
+        if previous is not None and current['p50'] > previous['p50'] * (1 + tolerance):
+            slower.append((stage, previous['p50'], current['p50']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detection, matching, triangulation and storage hot paths")
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--grid', type=int, default=Frame.SPLIT_DIV, help="sections per row and column")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    # the storage keeps a fixed number of sections per row
+    if args.grid ** 2 != TP17Storage.NUM_SECTIONS:
+        parser.error("--grid has to be {}, the storage keeps {} sections".format(
+            int(TP17Storage.NUM_SECTIONS ** 0.5), TP17Storage.NUM_SECTIONS))
+
+    Frame.SPLIT_DIV = args.grid
+    results = run(args.repeat)
+    print("{:<24}{:>10}{:>10}{:>10}{:>10}{:>12}".format('stage', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'per second'))
+    for stage, r in results.items():
+        print("{:<24}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>12.1f}".format(
+            stage, r['p50'], r['p90'], r['p99'], r['max'], r['per_second']))
+
+    code = 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config():
+            print("Baseline was taken with different settings: {}".format(baseline['config']))
+        slower = compare(results, baseline, args.tolerance)
+        for stage, previous, current in slower:
+            print("REGRESSION {}: p50 {:.3f} ms -> {:.3f} ms".format(stage, previous, current))
+        code = 1 if slower else 0
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': config(), 'results': results}, f, indent=2)
+        print("Baseline saved to {}".format(args.baseline))
+    return code
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,263 @@
+
+import hashlib
+import json
+import os
+import struct
+
+import cv2
+import numpy as np
+
+# files written by chesscal.py, {} is the device number
+CAMERA_FILES = ["device_{}_mtx.txt", "device_{}_dist.txt"]
+STEREO_FILES = ["stereo_F.txt", "stereo_E.txt", "stereo_R.txt", "stereo_T.txt"]
+CACHE_DIR = "rectify_cache"
+# binary bundle of everything above plus what stereoRectify and initUndistortRectifyMap derive from it,
+# {} are the device numbers
+BUNDLE_FILE = "calibration_{}_{}.bin"
+BUNDLE_MAGIC = b"TP17CAL\0"
+# bump when the bundle layout or what goes into it changes, older bundles are rebuilt
+BUNDLE_VERSION = 1
+# arrays in the bundle start at multiples of this many bytes
+BUNDLE_ALIGN = 64
+# matrices a bundle holds, on top of the rectification maps
+BUNDLE_MATRICES = ['camera_matrix1', 'dist_coef1', 'camera_matrix2', 'dist_coef2', 'R', 'T', 'E', 'F',
+                   'R1', 'R2', 'P1', 'P2', 'Q', 'roi1', 'roi2']
+
+
+class StereoCalibration:
+    '''
+    Everything we know about the stereo rig from chesscal.py, plus what stereoRectify derives from it.
+
+    fields:
+        camera_matrix1, camera_matrix2: intrinsics of the left and right camera
+        dist_coef1, dist_coef2: distortion coefficients
+        R, T, E, F: rotation, translation, essential and fundamental matrix between the cameras
+        image_size: (width, height) the calibration was done at
+        R1, R2: rectification rotations
+        P1, P2: projection matrices of the rectified cameras, also used for triangulation
+        Q: disparity to depth matrix
+        roi1, roi2: (x, y, w, h) of the valid pixels in each rectified image
+        checksum: hash of the calibration files, identifies the calibration in caches
+    '''
+    def __init__(self, camera_matrix1, dist_coef1, camera_matrix2, dist_coef2, R, T, E, F, image_size,
+                 checksum):
+        self.camera_matrix1 = camera_matrix1
+        self.dist_coef1 = dist_coef1
+        self.camera_matrix2 = camera_matrix2
+        self.dist_coef2 = dist_coef2
+        self.R = R
+        self.T = T
+        self.E = E
+        self.F = F
+        self.image_size = image_size
+        self.checksum = checksum
+        self.R1, self.R2, self.P1, self.P2, self.Q, self.roi1, self.roi2 = cv2.stereoRectify(
+            camera_matrix1, dist_coef1, camera_matrix2, dist_coef2, image_size, R, T, alpha=0)
+
+    def rectification_maps(self, cache_dir=CACHE_DIR):
+        '''
+        Builds the initUndistortRectifyMap tables for both cameras, or loads them from cache_dir
+        if they were already built for this calibration
+
+        :param cache_dir: directory the maps are cached in, None to not cache
+
+        :returns ((map1_left, map2_left), (map1_right, map2_right)) fixed point maps for cv2.remap
+        '''
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, "rectify_{}.npz".format(self.checksum))
+            if os.path.exists(path):
+                maps = np.load(path)
+                return (maps['left1'], maps['left2']), (maps['right1'], maps['right2'])
+
+        # fixed point maps are smaller and remap faster than float ones
+        left = cv2.initUndistortRectifyMap(self.camera_matrix1, self.dist_coef1, self.R1, self.P1,
+                                           self.image_size, cv2.CV_16SC2)
+        right = cv2.initUndistortRectifyMap(self.camera_matrix2, self.dist_coef2, self.R2, self.P2,
+                                            self.image_size, cv2.CV_16SC2)
+        if path is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            np.savez(path, left1=left[0], left2=left[1], right1=right[0], right2=right[1])
+        return left, right
+
+
+def load_calibration(directory=".", devices=(0, 1), image_size=(640, 480)):
+    '''
+    Loads the calibration of a stereo rig, from its bundle if there is an up to date one.
+
+    The text files chesscal.py saved are only hashed to check the bundle is current. When there is
+    no bundle, or it was built from other files, they are parsed, rectified and a new bundle is
+    written next to them so the next start is a single mmap.
+
+    :param directory: where the calibration files are
+    :param devices: (left, right) device numbers used in the file names
+    :param image_size: (width, height) of the calibrated images
+
+    :returns CalibrationBundle, or StereoCalibration if the bundle couldn't be written
+    '''
+    bundle = os.path.join(directory, BUNDLE_FILE.format(*devices))
+    paths = _text_files(directory, devices)
+    checksum = None
+    if all(os.path.exists(path) for path in paths):
+        checksum, texts = _checksum(paths, image_size)
+    elif os.path.exists(bundle):
+        # only the bundle was shipped, trust it
+        return CalibrationBundle(bundle)
+    else:
+        raise IOError("No calibration for devices {} in '{}'".format(devices, directory))
+
+    if os.path.exists(bundle):
+        header = read_bundle_header(bundle)
+        if header is not None and header['checksum'] == checksum and tuple(header['devices']) == tuple(devices):
+            return CalibrationBundle(bundle)
+
+    calibration = _parse(texts, image_size, checksum)
+    try:
+        save_bundle(calibration, bundle, devices)
+    except OSError:
+        return calibration
+    return CalibrationBundle(bundle)
+
+
+def build_bundle(directory=".", devices=(0, 1), image_size=(640, 480)):
+    '''
+    Parses the text files chesscal.py saved and writes the rig's bundle, replacing an older one
+
+    :returns path of the bundle
+    '''
+    checksum, texts = _checksum(_text_files(directory, devices), image_size)
+    bundle = os.path.join(directory, BUNDLE_FILE.format(*devices))
+    save_bundle(_parse(texts, image_size, checksum), bundle, devices)
+    return bundle
+
+
+def _text_files(directory, devices):
+    paths = [os.path.join(directory, name.format(device)) for device in devices for name in CAMERA_FILES]
+    return paths + [os.path.join(directory, name) for name in STEREO_FILES]
+
+
+def _checksum(paths, image_size):
+    digest = hashlib.sha1("{}x{}".format(*image_size).encode())
+    texts = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest.update(data)
+        texts.append(data)
+    return digest.hexdigest()[:16], texts
+
+
+def _parse(texts, image_size, checksum):
+    matrices = [np.loadtxt(data.decode().splitlines()) for data in texts]
+    camera_matrix1, dist_coef1, camera_matrix2, dist_coef2, F, E, R, T = matrices
+    return StereoCalibration(camera_matrix1, dist_coef1, camera_matrix2, dist_coef2, R, T, E, F, image_size, checksum)
+
+
+def save_bundle(calibration, path, devices=(0, 1)):
+    '''
+    Writes the calibration, its rectification and its rectification maps into one binary file:
+    magic, version and header length, a JSON header with the dtype, shape and offset of every array,
+    then the arrays, each aligned so it can be memory mapped in place. Written under a temporary
+    name first so a reader never sees half a bundle.
+
+    :returns None
+    '''
+    arrays = {name: np.ascontiguousarray(np.asarray(getattr(calibration, name), dtype=np.float64))
+              for name in BUNDLE_MATRICES}
+    (arrays['left1'], arrays['left2']), (arrays['right1'], arrays['right2']) = calibration.rectification_maps(None)
+
+    header = {'checksum': calibration.checksum, 'image_size': list(calibration.image_size),
+              'devices': list(devices), 'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        array = arrays[name] = np.ascontiguousarray(array)
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // BUNDLE_ALIGN) * BUNDLE_ALIGN
+    encoded = json.dumps(header).encode()
+    start = -(-(len(BUNDLE_MAGIC) + 8 + len(encoded)) // BUNDLE_ALIGN) * BUNDLE_ALIGN
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(BUNDLE_MAGIC + struct.pack('<II', BUNDLE_VERSION, len(encoded)) + encoded)
+        for name, array in arrays.items():
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(path + '.tmp', path)
+    return None
+
+
+def read_bundle_header(path):
+    '''
+    :returns the bundle's header dict with 'start', the offset the arrays are relative to, added.
+             None if the file isn't a bundle of the current version
+    '''
+    with open(path, 'rb') as f:
+        prefix = f.read(len(BUNDLE_MAGIC) + 8)
+        if len(prefix) < len(BUNDLE_MAGIC) + 8 or not prefix.startswith(BUNDLE_MAGIC):
+            return None
+        version, length = struct.unpack('<II', prefix[len(BUNDLE_MAGIC):])
+        if version != BUNDLE_VERSION:
+            return None
+        header = json.loads(f.read(length).decode())
+    header['start'] = -(-(len(BUNDLE_MAGIC) + 8 + length) // BUNDLE_ALIGN) * BUNDLE_ALIGN
+    return header
+
+
+class CalibrationBundle:
+    '''
+    A calibration bundle mapped into memory, with the same fields as StereoCalibration.
+
+    Opening one only reads the header, every array is a view into the mapped file made the first time
+    it's used, so pages that are never touched are never read. roi1 and roi2 are (4,) arrays.
+    '''
+    def __init__(self, path):
+        header = read_bundle_header(path)
+        if header is None:
+            raise IOError("'{}' isn't a version {} calibration bundle".format(path, BUNDLE_VERSION))
+        self.path = path
+        self.checksum = header['checksum']
+        self.image_size = tuple(header['image_size'])
+        self.devices = tuple(header['devices'])
+        self._header = header
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def __getattr__(self, name):
+        # only called for attributes not set yet, ie. arrays not used before
+        entries = self.__dict__.get('_header', {}).get('arrays', {})
+        if name not in entries:
+            raise AttributeError(name)
+        entry = entries[name]
+        array = np.ndarray(tuple(entry['shape']), np.dtype(entry['dtype']), self._map,
+                           self._header['start'] + entry['offset'])
+        setattr(self, name, array)
+        return array
+
+    def rectification_maps(self, cache_dir=None):
+        '''
+        :param cache_dir: unused, the maps are part of the bundle
+
+        :returns ((map1_left, map2_left), (map1_right, map2_right)) fixed point maps for cv2.remap
+        '''
+        return (self.left1, self.left2), (self.right1, self.right2)
+
+
+class Rectifier:
+    '''
+    Remaps raw camera frames into rectified ones with tables built once at startup.
+    In rectified images a point and its match on the other camera lie on the same row.
+    '''
+    def __init__(self, calibration, devices=(0, 1), cache_dir=CACHE_DIR):
+        left, right = calibration.rectification_maps(cache_dir)
+        self.maps = {devices[0]: left, devices[1]: right}
+
+    def remap(self, device, img, dst=None):
+        '''
+        :param device: device number the image came from
+        :param img: raw frame at the calibrated size
+        :param dst: optional preallocated output, must not be img
+
+        :returns rectified frame
+        '''
+        map1, map2 = self.maps[device]
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst)
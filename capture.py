@@ -0,0 +1,184 @@
+
+import threading
+import time
+from threading import Thread
+
+import cv2
+
+
+class CaptureReader:
+    '''
+    Grabs frames from one camera continuously on its own thread, so frames never queue up in the driver.
+
+    Grabbing only takes the frame off the device, it's cheap. A frame is only retrieved (decoded) when a
+    consumer asks for one with read(), and then it is the first frame grabbed after the request, so a
+    consumer always gets the newest frame and never a stale buffered one. Frames nobody asked for are
+    dropped undecoded. Readers of a stereo pair can share a threading.Barrier, every grab then waits
+    for the other camera so both are grabbed back to back and decoded after.
+
+    fields:
+        cap: cv2.VideoCapture, only used from the reader's thread once started
+        device: device number, used in messages
+        sync: optional threading.Barrier shared with the other camera's reader
+        grabbed: number of frames grabbed
+        skipped: number of grabbed frames nobody asked for
+        failed: True once a grab or retrieve failed, the reader stops then
+    '''
+    def __init__(self, cap, device, sync=None, sync_timeout=1.0):
+        self.cap = cap
+        self.device = device
+        self.sync = sync
+        self.sync_timeout = sync_timeout
+        self.grabbed = 0
+        self.skipped = 0
+        self.failed = False
+        self.stopped = threading.Event()
+        self._cond = threading.Condition()
+        self._request = None
+        self._result = None
+        self._thread = None
+        # don't let the driver keep a backlog, not every backend supports it
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def start(self):
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return None
+
+    def stop(self):
+        '''
+        Stops grabbing and wakes up a waiting read(), the capture isn't released
+
+        :returns None
+        '''
+        self.stopped.set()
+        if self.sync is not None:
+            self.sync.abort()
+        with self._cond:
+            self._cond.notify_all()
+        return None
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return None
+
+    def read(self, dst=None, timeout=None):
+        '''
+        Waits for the next frame grabbed and has it decoded
+
+        :param dst: optional image to decode into, eg. a FrameRing slot. A new one is made if its
+                    size or type doesn't fit
+        :param timeout: seconds to wait, forever if None
+
+        :returns (ret, timestamp, img) - ret False if the camera failed or the reader stopped,
+                 timestamp is time.monotonic() taken right after the grab
+        '''
+        self.request(dst)
+        return self.result(timeout)
+
+    def request(self, dst=None, cycle=None):
+        '''
+        Asks for a frame without waiting for it, see read()
+
+        :param cycle: number of the grab to decode, the next grab if None. Readers sharing a barrier
+                      grab in lockstep, so the same cycle is the same moment on every camera
+
+        :returns None
+        '''
+        with self._cond:
+            self._request = (dst, cycle)
+            self._result = None
+        return None
+
+    def result(self, timeout=None):
+        '''
+        Waits for the frame asked for with request()
+
+        :returns (ret, timestamp, img), see read()
+        '''
+        with self._cond:
+            self._cond.wait_for(lambda: self._result is not None or self.failed or self.stopped.is_set(), timeout)
+            result, self._request, self._result = self._result, None, None
+        if result is None:
+            return False, None, None
+        return result
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if self.sync is not None:
+                try:
+                    self.sync.wait(self.sync_timeout)
+                except threading.BrokenBarrierError:
+                    if self.stopped.is_set():
+                        break
+                    # the other camera stalled, keep going on our own rather than stall with it
+                    print("Camera {} grabs out of sync from now on".format(self.device))
+                    self.sync = None
+            ok = self.cap.grab()
+            timestamp = time.monotonic()
+            if not ok:
+                self._fail()
+                break
+            self.grabbed += 1
+
+            with self._cond:
+                request = self._request
+            if request is None or (request[1] is not None and self.grabbed < request[1]):
+                self.skipped += 1
+                continue
+            ok, img = self.cap.retrieve(request[0])
+            if not ok:
+                self._fail()
+                break
+            with self._cond:
+                if self._request is not request:
+                    # result() gave up on it and maybe asked again while we decoded, this frame
+                    # isn't in the new request's dst. a later grab serves that
+                    self.skipped += 1
+                    continue
+                # one frame per request, the next grabs are dropped until someone asks again
+                self._request = None
+                self._result = (True, timestamp, img)
+                self._cond.notify_all()
+        return None
+
+    def _fail(self):
+        with self._cond:
+            self.failed = True
+            self._cond.notify_all()
+        return None
+
+
+def read_together(readers, dsts, timeout=None):
+    '''
+    Asks every reader for a frame at the same moment. Readers sharing a barrier all decode the frame
+    of the same grab, the next one all of them can still make, others their own next grab.
+
+    :param readers: CaptureReaders of a stereo pair
+    :param dsts: image to decode into for every reader, or None
+
+    :returns list of (ret, timestamp, img), one per reader
+    '''
+    cycle = None
+    if all(reader.sync is not None for reader in readers):
+        cycle = max(reader.grabbed for reader in readers) + 1
+    for reader, dst in zip(readers, dsts):
+        reader.request(dst, cycle)
+    return [reader.result(timeout) for reader in readers]
+
+
+def open_readers(captures, devices, synced=True):
+    '''
+    :param captures: cv2.VideoCapture of every camera
+    :param devices: their device numbers
+    :param synced: grab all the cameras back to back
+
+    :returns list of started CaptureReader, one per camera
+    '''
+    sync = threading.Barrier(len(captures)) if synced and len(captures) > 1 else None
+    readers = [CaptureReader(cap, device, sync) for cap, device in zip(captures, devices)]
+    for reader in readers:
+        reader.start()
+    return readers
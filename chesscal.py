@@ -1,160 +1,379 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import cv2
-import time
-import sys
-import threading
 
+from calibration import build_bundle
+
+# most views collected, calibration stops earlier once the error converged
 CALIBRATION_COUNT = 50
 CORNERS_W, CORNERS_H = 9, 6
 DEVICES = [0, 1]
-
-timer = None
-
-def process_frame(device, img):
-    """ Process the captured frame, appending to the img_points array.
-
-        Returns: The corners, if found. Else, None.
-    """
-
-    global timer
-
-    # Name of the window to draw things in to
-    window = 'img-{}'.format(device)
-
-    # img = cv2.flip(img, -1)  # Camera returns images that are inverted on both axis -- flip 'em.
-    img = cv2.GaussianBlur(img, (3, 3), 0)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    # Find the chess board corners
-    found, corners = cv2.findChessboardCorners(gray, (CORNERS_W, CORNERS_H), None)
-
-    if found:
-        # Refine the corners and add
-        refined_corners = cv2.cornerSubPix(gray, corners, (5, 5), (-1, -1),
-                                           criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 150, 0.0001))
-
-        # Draw and display the corners
-        img = cv2.drawChessboardCorners(img, (CORNERS_H, CORNERS_W), refined_corners, found)
-        cv2.imshow(window, img)
-
-        return refined_corners
-    else:
-        cv2.imshow(window, gray)  # show the gray image if no corners were located
+IMAGE_SIZE = (640, 480)
+# views needed before the first running estimate, and new views between estimates
+MIN_VIEWS = 15
+ESTIMATE_EVERY = 5
+# the error converged once the RMS of every camera moved less than this many pixels over the last estimates
+CONVERGED_CHANGE = 0.02
+CONVERGED_ESTIMATES = 3
+# seconds between accepted live views, gives time to move the board
+CAPTURE_INTERVAL = 2.0
+
+
+def object_points(corners_w=CORNERS_W, corners_h=CORNERS_H):
+    '''
+    :returns (w * h, 3) float32 corners of the board in board squares, (0,0,0), (1,0,0), ... (w-1,h-1,0)
+    '''
+    points = np.zeros((corners_h * corners_w, 3), np.float32)
+    points[:, :2] = np.mgrid[0:corners_w, 0:corners_h].T.reshape(-1, 2)
+    return points
+
+
+def find_corners(img, fast=False):
+    '''
+    Finds and refines the chessboard corners of one view, safe to run on several threads at once
+
+    :param img: BGR or grayscale image
+    :param fast: give up quickly on images without a board, for live capture
+
+    :returns (w * h, 1, 2) float32 corners, or None if the board wasn't found
+    '''
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    gray = cv2.GaussianBlur(gray, (3, 3), 0)
+    flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE
+    if fast:
+        flags += cv2.CALIB_CB_FAST_CHECK
+    found, corners = cv2.findChessboardCorners(gray, (CORNERS_W, CORNERS_H), flags=flags)
+    if not found:
+        return None
+    return cv2.cornerSubPix(gray, corners, (5, 5), (-1, -1),
+                            criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 150, 0.0001))
+
+
+def rotation_matrices(rvecs):
+    '''
+    :param rvecs: (N, 3) Rodrigues rotation vectors
+
+    :returns (N, 3, 3) rotation matrices, cv2.Rodrigues for all of them at once
+    '''
+    rvecs = np.asarray(rvecs, dtype=float).reshape(-1, 3)
+    theta = np.linalg.norm(rvecs, axis=1)
+    axis = rvecs / np.where(theta > 1e-12, theta, 1)[:, None]
+    x, y, z = axis.T
+    zero = np.zeros_like(x)
+    K = np.stack([zero, -z, y, z, zero, -x, -y, x, zero], axis=1).reshape(-1, 3, 3)
+    sin, cos = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+    return np.eye(3) + sin * K + (1 - cos) * K @ K
+
+
+def reprojection_errors(obj_points, img_points, rvecs, tvecs, mtx, dist):
+    '''
+    Projects the board corners of every view through the pinhole and k1, k2, p1, p2, k3 distortion model
+    of cv2.projectPoints, all views at once
+
+    :param obj_points: (P, 3) board corners, the same for every view
+    :param img_points: (N, P, 1, 2) or (N, P, 2) detected corners of the N views
+    :param rvecs, tvecs: board poses calibrateCamera returned for the views
+    :param mtx, dist: camera matrix and distortion coefficients
+
+    :returns (N,) RMS reprojection error of every view, in pixels
+    '''
+    R = rotation_matrices(rvecs)
+    camera = np.asarray(obj_points, dtype=float) @ R.transpose(0, 2, 1) + np.asarray(tvecs, dtype=float).reshape(-1, 1, 3)
+    x, y = camera[..., 0] / camera[..., 2], camera[..., 1] / camera[..., 2]
+    k1, k2, p1, p2, k3 = np.pad(np.ravel(dist)[:5], (0, max(0, 5 - np.size(dist))))
+    r2 = x * x + y * y
+    radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+    u = mtx[0, 0] * xd + mtx[0, 1] * yd + mtx[0, 2]
+    v = mtx[1, 1] * yd + mtx[1, 2]
+    detected = np.asarray(img_points, dtype=float).reshape(len(R), -1, 2)
+    squared = (u - detected[..., 0]) ** 2 + (v - detected[..., 1]) ** 2
+    return np.sqrt(squared.mean(axis=1))
+
+
+def calibrate_camera(views, image_size=IMAGE_SIZE, guess=None):
+    '''
+    :param views: list of corners of one camera
+    :param guess: optional (mtx, dist) of an earlier estimate to start from
+
+    :returns (rms, mtx, dist, rvecs, tvecs)
+    '''
+    obj = [object_points()] * len(views)
+    if guess is None:
+        return cv2.calibrateCamera(obj, views, image_size, None, None)
+    mtx, dist = guess
+    return cv2.calibrateCamera(obj, views, image_size, mtx.copy(), dist.copy(),
+                               flags=cv2.CALIB_USE_INTRINSIC_GUESS)
+
+
+class Calibrator:
+    '''
+    Collects stereo views and keeps a running calibration of every camera.
+
+    Corners of both views of a pair are found on the worker threads at the same time and every
+    ESTIMATE_EVERY views every camera is calibrated again, in the background, starting from the
+    previous estimate. Collecting is done once the RMS reprojection error stopped moving or
+    CALIBRATION_COUNT views were collected.
+
+    fields:
+        devices: the camera labels, in (left, right) order
+        views: dict device -> list of corners, the same index is the same pair
+        estimates: dict device -> latest (rms, mtx, dist, rvecs, tvecs)
+        history: list of dicts device -> rms, one per running estimate
+        workers: number of corner detection and calibration threads
+    '''
+    def __init__(self, devices=DEVICES, image_size=IMAGE_SIZE, workers=None):
+        self.devices = list(devices)
+        self.image_size = image_size
+        self.views = {device: [] for device in self.devices}
+        self.estimates = {}
+        self.history = []
+        self._estimated = 0
+        self._pending = None
+        self.workers = workers or max(len(self.devices), os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(self.workers)
+
+    @property
+    def count(self):
+        return len(self.views[self.devices[0]])
+
+    @property
+    def converged(self):
+        if len(self.history) < CONVERGED_ESTIMATES:
+            return False
+        recent = self.history[-CONVERGED_ESTIMATES:]
+        return all(max(e[device] for e in recent) - min(e[device] for e in recent) < CONVERGED_CHANGE
+                   for device in self.devices)
+
+    @property
+    def done(self):
+        return self.converged or self.count >= CALIBRATION_COUNT
+
+    def find(self, pairs, fast=False):
+        '''
+        :param pairs: list of (left, right) images
+
+        :returns list with the (left, right) corners of every pair, None for pairs where a view has no board
+        '''
+        futures = [[self._executor.submit(find_corners, img, fast) for img in pair] for pair in pairs]
+        found = []
+        for pair in futures:
+            corners = [future.result() for future in pair]
+            found.append(None if any(c is None for c in corners) else corners)
+        return found
+
+    def add(self, corners):
+        '''
+        :param corners: (left, right) corners of one pair, as find() returned them
+
+        :returns None
+        '''
+        for device, points in zip(self.devices, corners):
+            self.views[device].append(points)
         return None
 
+    def update(self, wait=False):
+        '''
+        Collects a finished running estimate and starts the next one when enough new views came in
+
+        :param wait: block until the running estimate is finished, else only look if it is
+
+        :returns True if a new estimate was collected
+        '''
+        collected = False
+        if self._pending is not None and (wait or all(f.done() for f in self._pending.values())):
+            self.estimates = {device: future.result() for device, future in self._pending.items()}
+            self.history.append({device: estimate[0] for device, estimate in self.estimates.items()})
+            self._pending = None
+            collected = True
+        if self._pending is None and self.count >= MIN_VIEWS and self.count - self._estimated >= ESTIMATE_EVERY:
+            self._estimated = self.count
+            self._pending = {device: self._executor.submit(calibrate_camera, list(self.views[device]),
+                                                           self.image_size, self._guess(device))
+                             for device in self.devices}
+            if wait:
+                return self.update(wait) or collected
+        return collected
+
+    def calibrate(self):
+        '''
+        Final calibration of every camera on all views, then of the pair with the intrinsics fixed
+
+        :returns (solo, stereo), solo a dict device -> (rms, mtx, dist, rvecs, tvecs, per view errors) and
+                 stereo the (rms, R, T, E, F) of cv2.stereoCalibrate
+        '''
+        if self._pending is not None:
+            for future in self._pending.values():
+                future.result()
+        futures = {device: self._executor.submit(calibrate_camera, self.views[device], self.image_size,
+                                                 self._guess(device))
+                   for device in self.devices}
+        solo = {}
+        for device, future in futures.items():
+            rms, mtx, dist, rvecs, tvecs = future.result()
+            errors = reprojection_errors(object_points(), np.asarray(self.views[device]), rvecs, tvecs, mtx, dist)
+            solo[device] = (rms, mtx, dist, rvecs, tvecs, errors)
+
+        left, right = self.devices
+        rms, _, _, _, _, R, T, E, F = cv2.stereoCalibrate([object_points()] * self.count,
+                                                          self.views[left], self.views[right],
+                                                          solo[left][1], solo[left][2],
+                                                          solo[right][1], solo[right][2],
+                                                          self.image_size, flags=cv2.CALIB_FIX_INTRINSIC)
+        return solo, (rms, R, T, E, F)
+
+    def close(self):
+        self._executor.shutdown()
+        return None
 
-# prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-# Object Points. Used in calibrateCamera. Basically a whole set of dummy values.
-# Count up from (0, 0, 0), (1, 0, 0), ... (9, 7, 0)
-dummy_points = np.zeros((CORNERS_H * CORNERS_W, 3), np.float32)
-for h in range(CORNERS_H):
-    for w in range(CORNERS_W):
-        index = w + (h * CORNERS_W)
-        dummy_points[index][0] = w
-        dummy_points[index][1] = h
-
-# Collect data from both cameras at once
-img_points = {}
-obj_points = []  # the dummy obj_points array, one per img_points element
-vidcaps = {}
-for device in DEVICES:
-    cap = cv2.VideoCapture(device)
-    cap.set(5, 15)  # Limit FPS. Need to limit lower if using both cameras at once.
-    #cap.set(10, 0.3)  # Brightness
-    #cap.set(11, 0.4)  # Contrast
-    cap.set(12, 0)  # Saturation to 0 - capture in greyscale.
-    vidcaps[device] = cap
-    img_points[device] = []  # 2d points in image plane. One per device.
-
-first = True
-skip_frames = 0  # A number of frames are skipped after a successful detection to give time to move
-while all(len(pts) <= CALIBRATION_COUNT for pts in img_points.values()):
-    # Capture frames with no processing so they're as close together as possible
-    frames = {}
-    for device in DEVICES:
-        ok, img = vidcaps[device].read()
-        if not ok:
-            raise Exception("Error reading from device {}".format(device))
-
-        frames[device] = img
-
-    # Dump frames
-    if skip_frames > 0:
-        skip_frames -= 1
-
-        for device in DEVICES:
-            img = cv2.putText(frames[device], str(skip_frames), (120, 120), cv2.FONT_HERSHEY_DUPLEX, 4, (32, 32, 255), 3)
-            cv2.imshow('img-{}'.format(device), frames[device])
-        cv2.waitKey(10)
-
-        continue
-
-    # Now process them
-    found_points = {}
-    for device in DEVICES:
-        img = frames[device]
-
-        # Try to identify some corners
-        corners = process_frame(device, img)
-        if corners is not None:
-            found_points[device] = corners
-
-    # Only add them to img_points if both devices got it
-    if all(device in found_points for device in DEVICES):
-        if not first:
-            for device in DEVICES:
-                img_points[device].append(found_points[device])
-            obj_points.append(dummy_points)
-        first = False
-        skip_frames = 30
-        cv2.waitKey(200)
-
-    cv2.waitKey(10)
-
-# Close the devices
-for device in DEVICES:
-    vidcaps[device].release()
-
-# Perform solo calibration
-solo = {}
-for device in DEVICES:
-    dev_points = img_points[device]
-
-    # Generate and store the calibrations for the device
-    result, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(obj_points, dev_points, (640, 480), None, None)
-    print("Solo calibration result for {}: {}".format(device, result))
-
-    np.savetxt("device_{}_mtx.txt".format(device), mtx)
-    np.savetxt("device_{}_dist.txt".format(device), dist)
-    np.savetxt("device_{}_rvecs.txt".format(device), rvecs)
-    np.savetxt("device_{}_tvecs.txt".format(device), tvecs)
-
-    # Store the matrix and distance values for use in stereo calibration
-    solo.setdefault(device, {})["mtx"] = mtx
-    solo.setdefault(device, {})["dist"] = dist
-
-    # Calculate and report the error
-    total_error = 0
-    for i in range(len(obj_points)):
-        projected_points, _ = cv2.projectPoints(obj_points[i], rvecs[i], tvecs[i], mtx, dist)
-        error = cv2.norm(dev_points[i], projected_points, cv2.NORM_L2) / len(projected_points)
-        total_error += error
-    print("Error for device {}: {}".format(device, total_error / len(obj_points)))
-
-# Stereo calibration
-result, _, _, _, _, R, T, E, F = cv2.stereoCalibrate(obj_points,
-                                                     img_points[DEVICES[0]], img_points[DEVICES[1]],
-                                                     solo[DEVICES[0]]["mtx"], solo[DEVICES[0]]["dist"],
-                                                     solo[DEVICES[1]]["mtx"], solo[DEVICES[1]]["dist"],
-                                                     (640, 480),
-                                                     #criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 2000, 0.00001),
-                                                     flags=cv2.CALIB_FIX_INTRINSIC)
-print("Stereo calibration result: {}".format(result))
-
-# Store the calibration output
-np.savetxt("stereo_R.txt", R)
-np.savetxt("stereo_T.txt", T)
-np.savetxt("stereo_E.txt", E)
-np.savetxt("stereo_F.txt", F)
-
-cv2.destroyAllWindows()
+    def _guess(self, device):
+        estimate = self.estimates.get(device)
+        return None if estimate is None else (estimate[1], estimate[2])
+
+
+def saved_pairs(directory):
+    '''
+    :param directory: folder with left_<name>.png and right_<name>.png image pairs, eg. what --save wrote
+
+    :returns sorted list of (left path, right path) of the names that have both images
+    '''
+    pairs = []
+    for left in sorted(glob.glob(os.path.join(directory, 'left_*.png'))):
+        right = os.path.join(directory, 'right_' + os.path.basename(left)[len('left_'):])
+        if os.path.exists(right):
+            pairs.append((left, right))
+    return pairs
+
+
+def collect_saved(calibrator, directory):
+    '''
+    Finds the corners of saved pairs, ESTIMATE_EVERY pairs at a time, until the error converged
+
+    :returns None
+    '''
+    pairs = saved_pairs(directory)
+    print("{} image pairs in {}".format(len(pairs), directory))
+    batch = max(ESTIMATE_EVERY, calibrator.workers // 2)
+    for start in range(0, len(pairs), batch):
+        images = [(cv2.imread(left), cv2.imread(right)) for left, right in pairs[start:start + batch]]
+        for corners in calibrator.find(images):
+            if corners is not None and not calibrator.done:
+                calibrator.add(corners)
+        if calibrator.update(wait=True):
+            report(calibrator)
+        if calibrator.done:
+            break
+    return None
+
+
+def collect_live(calibrator, devices=DEVICES, save_dir=None):
+    '''
+    Captures from the cameras until the error converged, CALIBRATION_COUNT views were taken or esc was pressed.
+    A pair is tried at most every CAPTURE_INTERVAL seconds, the preview keeps running in between.
+
+    :param save_dir: optional folder accepted pairs are saved to, for a later run with --pairs
+
+    :returns None
+    '''
+    captures = []
+    for device in devices:
+        cap = cv2.VideoCapture(device)
+        cap.set(5, 15)  # Limit FPS. Need to limit lower if using both cameras at once.
+        cap.set(12, 0)  # Saturation to 0 - capture in greyscale.
+        captures.append(cap)
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    last = 0
+    try:
+        while not calibrator.done:
+            # grab both first so the two frames are as close together as possible, decode after
+            if not all(cap.grab() for cap in captures):
+                raise Exception("Error reading from devices {}".format(devices))
+            frames = [cap.retrieve()[1] for cap in captures]
+
+            corners = None
+            wait = CAPTURE_INTERVAL - (time.time() - last)
+            if wait <= 0:
+                corners = calibrator.find([frames], fast=True)[0]
+                if corners is not None:
+                    calibrator.add(corners)
+                    last = time.time()
+                    if save_dir is not None:
+                        for side, img in zip(('left', 'right'), frames):
+                            cv2.imwrite(os.path.join(save_dir, '{}_{:03d}.png'.format(side, calibrator.count)), img)
+            if calibrator.update():
+                report(calibrator)
+
+            for device, img, points in zip(devices, frames, corners or [None] * len(frames)):
+                if points is not None:
+                    img = cv2.drawChessboardCorners(img, (CORNERS_W, CORNERS_H), points, True)
+                text = "{} views".format(calibrator.count) if wait <= 0 else str(int(wait) + 1)
+                cv2.putText(img, text, (20, 60), cv2.FONT_HERSHEY_DUPLEX, 1.5, (32, 32, 255), 2)
+                cv2.imshow('img-{}'.format(device), img)
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
+    finally:
+        for cap in captures:
+            cap.release()
+        cv2.destroyAllWindows()
+    return None
+
+
+def report(calibrator):
+    print("{} views, RMS error: {}".format(calibrator.count, ", ".join(
+        "device {} {:.4f}".format(device, rms) for device, rms in calibrator.history[-1].items())))
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate a stereo pair from a chessboard")
+    parser.add_argument('--pairs', help="folder of saved left_*.png/right_*.png pairs to calibrate from "
+                                        "instead of the cameras")
+    parser.add_argument('--save', help="folder to save the live pairs used to, to calibrate again later")
+    parser.add_argument('--workers', type=int, default=0, help="corner detection threads, one per core if 0")
+    args = parser.parse_args()
+
+    calibrator = Calibrator(DEVICES, IMAGE_SIZE, args.workers or None)
+    try:
+        if args.pairs:
+            collect_saved(calibrator, args.pairs)
+        else:
+            collect_live(calibrator, DEVICES, args.save)
+        if calibrator.count < MIN_VIEWS:
+            print("Only {} views with the board in both cameras, need at least {}".format(calibrator.count, MIN_VIEWS))
+            return 1
+        print("Calibrating on {} views{}".format(calibrator.count, ", error converged" if calibrator.converged else ""))
+        solo, (rms, R, T, E, F) = calibrator.calibrate()
+    finally:
+        calibrator.close()
+
+    for device, (result, mtx, dist, rvecs, tvecs, errors) in solo.items():
+        print("Solo calibration result for {}: {}".format(device, result))
+        print("Error for device {}: mean {:.4f}, worst view {} {:.4f}".format(
+            device, errors.mean(), int(errors.argmax()), errors.max()))
+        np.savetxt("device_{}_mtx.txt".format(device), mtx)
+        np.savetxt("device_{}_dist.txt".format(device), dist)
+        np.savetxt("device_{}_rvecs.txt".format(device), np.reshape(rvecs, (-1, 3)))
+        np.savetxt("device_{}_tvecs.txt".format(device), np.reshape(tvecs, (-1, 3)))
+    print("Stereo calibration result: {}".format(rms))
+
+    # Store the calibration output
+    np.savetxt("stereo_R.txt", R)
+    np.savetxt("stereo_T.txt", T)
+    np.savetxt("stereo_E.txt", E)
+    np.savetxt("stereo_F.txt", F)
+    # and everything derived from it in one binary file, distances.py maps that instead of parsing the text
+    print("Calibration bundle written to {}".format(build_bundle(".", DEVICES, IMAGE_SIZE)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
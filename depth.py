@@ -0,0 +1,220 @@
+
+import math
+import threading
+
+import numpy as np
+
+
+class FloorPlane:
+    '''
+    Where the camera sits relative to the floor, used to work out how far away a face seen
+    on a given image row can be.
+
+    fields:
+        camera_height: height of the camera above the floor, in meters
+        pitch: how far the camera is tilted down from horizontal, in radians
+        face_heights: (lowest, highest) height of a face above the floor, in meters,
+                      eg. a sitting child to a tall adult standing
+    '''
+    def __init__(self, camera_height, pitch=0.0, face_heights=(1.0, 1.9)):
+        self.camera_height = camera_height
+        self.pitch = pitch
+        self.face_heights = face_heights
+
+    def distances(self, rows, focal, cy):
+        '''
+        :param rows: ndarray of image rows
+        :param focal: focal length in pixels
+        :param cy: row of the principal point
+
+        :returns (rows, heights) ndarray of distances at which a face of each height in
+                 face_heights is seen on each row, nan where it can't be seen on that row
+        '''
+        heights = np.linspace(self.face_heights[0], self.face_heights[1], 9)
+        # angle of every row below horizontal
+        below = self.pitch + np.arctan((np.asarray(rows, dtype=float) - cy) / focal)
+        drop = self.camera_height - heights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            along_floor = drop[None, :] / np.tan(below)[:, None]
+            distance = along_floor / np.cos(below)[:, None]
+        # a face above the camera is only seen looking up and one below it only looking down
+        distance[along_floor <= 0] = np.nan
+        return distance
+
+
+class DepthPrior:
+    '''
+    Limits the cascade search of one camera to the face sizes that can physically appear, band by band.
+
+    A face of FACE_SIZE meters at distance d is focal * FACE_SIZE / d pixels wide. The frame is split
+    into horizontal bands and every band gets a distance range, from the floor plane if one is set,
+    else from min_distance - max_distance. Distances triangulated on recent frames widen the range of
+    the band they were seen in, so a wrong floor plane can't hide people for long. Bands where nobody
+    can be are not searched, the others only between their smallest and largest face size. Body
+    detectors draw bigger boxes, BOX_SIZES gives the size of a person's box for every detector.
+
+    fields:
+        focal: focal length in pixels, P1[0, 0] from the calibration
+        cy: row of the principal point, P1[1, 2]
+        height: height of the frames searched
+        bands: number of horizontal bands
+        floor: optional FloorPlane
+        margin: fraction the size range of every band is widened by
+        memory: frames triangulated distances are remembered for
+    '''
+    # height of a face box as the frontal face cascade draws it, in meters
+    FACE_SIZE = 0.2
+    # (w, h) of the box every detector draws around a person, in meters, with the aspect of its window
+    BOX_SIZES = {'face': (FACE_SIZE, FACE_SIZE), 'upper': (0.6, 0.5), 'fullbody': (0.9, 1.8), 'hog': (1.0, 2.0)}
+    # detectors whose boxes are centred on the face, the bands' distances are those of faces on their rows
+    FACE_CENTRED = ('face',)
+
+    def __init__(self, focal, cy, height=480, bands=4, min_distance=0.5, max_distance=8.0, floor=None,
+                 margin=0.25, memory=15):
+        self.focal = focal
+        self.cy = cy
+        self.height = height
+        self.bands = bands
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.floor = floor
+        self.margin = margin
+        self.memory = memory
+        self.edges = np.linspace(0, height, bands + 1).astype(int)
+        self._base = self._floor_ranges()
+        self._seen = []
+        self._lock = threading.Lock()
+
+    def observe(self, points, distances):
+        '''
+        Remembers where people were triangulated, called for every located frame
+
+        :param points: (x, y) midpoints of the matched people on this camera
+        :param distances: their distances, in the same order
+
+        :returns None
+        '''
+        seen = [(y, d) for (x, y), d in zip(points, distances) if d > 0]
+        with self._lock:
+            self._seen.append(seen)
+            del self._seen[:-self.memory]
+        return None
+
+    def ranges(self):
+        '''
+        :returns list of (top, bottom, nearest, farthest) distance ranges of the bands, nearest is None for
+                 bands nobody can be in. neighbouring bands with the same range are merged
+        '''
+        ranges = list(self._base)
+        with self._lock:
+            seen = [point for frame in self._seen for point in frame]
+        for y, d in seen:
+            band = min(max(int(np.searchsorted(self.edges, y, side='right')) - 1, 0), self.bands - 1)
+            nearest, farthest = ranges[band]
+            if nearest is None:
+                ranges[band] = (d, d)
+            else:
+                ranges[band] = (min(nearest, d), max(farthest, d))
+
+        merged = []
+        for top, bottom, distances in zip(self.edges[:-1], self.edges[1:], ranges):
+            if merged and merged[-1][2:] == distances:
+                merged[-1] = (merged[-1][0], int(bottom)) + distances
+            else:
+                merged.append((int(top), int(bottom)) + distances)
+        return merged
+
+    def sizes(self, nearest, farthest, box=None):
+        '''
+        :param box: (w, h) of the detector's box in meters, see BOX_SIZES. a face's if None
+
+        :returns (min_size, max_size) (w, h) box sizes in pixels for people between the two distances
+        '''
+        box = box or (self.FACE_SIZE, self.FACE_SIZE)
+        smallest = tuple(max(int(self.focal * size / farthest * (1 - self.margin)), 1) for size in box)
+        largest = tuple(int(math.ceil(self.focal * size / nearest * (1 + self.margin))) for size in box)
+        return smallest, largest
+
+    def _floor_ranges(self):
+        if self.floor is None:
+            return [(self.min_distance, self.max_distance)] * self.bands
+        ranges = []
+        for top, bottom in zip(self.edges[:-1], self.edges[1:]):
+            distance = self.floor.distances(np.arange(top, bottom + 1, 4), self.focal, self.cy)
+            distance = distance[np.isfinite(distance)]
+            distance = distance[(distance >= self.min_distance) & (distance <= self.max_distance)]
+            if len(distance) == 0:
+                ranges.append((None, None))
+            else:
+                ranges.append((float(distance.min()), float(distance.max())))
+        return ranges
+
+
+class DepthAwareDetector:
+    '''
+    Wraps a Detector so every search is cut to the bands and box sizes a DepthPrior allows, sized for
+    the detector's own boxes. Has the same detect() as a Detector, so it can be handed to
+    Frame.detect_people, a MotionGate, a PersonTracker or a FusedDetector (one per member) in its place.
+
+    fields:
+        box: (w, h) of the detector's boxes in meters, from DepthPrior.BOX_SIZES
+        banded: searched band by band, only for boxes centred on the face the bands were worked out for
+    '''
+    def __init__(self, detector, prior):
+        self.detector = detector
+        self.prior = prior
+        self.name = detector.name
+        self.spec = detector.spec
+        self.box = prior.BOX_SIZES.get(detector.name, (prior.FACE_SIZE, prior.FACE_SIZE))
+        # detectors we don't know the boxes of are taken to find faces
+        self.banded = detector.name in prior.FACE_CENTRED or detector.name not in prior.BOX_SIZES
+
+    def detect(self, img, min_size=None, max_size=None):
+        '''
+        :param img: BGR frame, or a crop of one (eg. a MotionGate region)
+        :param min_size, max_size: optional (w, h) box size limits, on top of the prior's
+
+        :returns (N, 4) ndarray of (x, y, w, h) boxes
+        '''
+        searched = [r for r in self.prior.ranges() if r[2] is not None]
+        if not searched:
+            return np.empty((0, 4), dtype=int)
+        nearest, farthest = min(r[2] for r in searched), max(r[3] for r in searched)
+        # a crop, we don't know which rows it came from. search it with the sizes of every band
+        if img.shape[0] != self.prior.height or not self.banded:
+            return self._search(img, nearest, farthest, min_size, max_size)
+
+        # a face centred in a band can reach half its size beyond it, so band crops overlap.
+        # the smallest scale dominates the cost of a search, only split it up if that pays off
+        window_w, window_h = self.spec.min_size
+        plan = []
+        for top, bottom, near, far in searched:
+            (min_w, min_h), (_, max_h) = self.prior.sizes(near, far, self.box)
+            y0, y1 = max(top - max_h // 2, 0), min(bottom + max_h // 2, img.shape[0])
+            plan.append((y0, y1, top, bottom, near, far, (y1 - y0) / (max(min_w, window_w) * max(min_h, window_h))))
+        min_w, min_h = self.prior.sizes(nearest, farthest, self.box)[0]
+        single = img.shape[0] / (max(min_w, window_w) * max(min_h, window_h))
+        if len(plan) == 1 or single <= sum(step[-1] for step in plan):
+            return self._search(img, nearest, farthest, min_size, max_size)
+
+        found = []
+        for y0, y1, top, bottom, near, far, _ in plan:
+            boxes = self._search(img[y0:y1], near, far, min_size, max_size)
+            boxes[:, 1] += y0
+            centres = boxes[:, 1] + boxes[:, 3] / 2
+            found.append(boxes[(centres >= top) & (centres < bottom)])
+        return np.concatenate(found)
+
+    def _search(self, img, nearest, farthest, min_size=None, max_size=None):
+        (min_w, min_h), (max_w, max_h) = self.prior.sizes(nearest, farthest, self.box)
+        # the cascade can't find anything smaller than its window
+        min_w, min_h = max(min_w, self.spec.min_size[0]), max(min_h, self.spec.min_size[1])
+        max_w, max_h = min(max_w, img.shape[1]), min(max_h, img.shape[0])
+        if min_size is not None:
+            min_w, min_h = max(min_w, min_size[0]), max(min_h, min_size[1])
+        if max_size is not None:
+            max_w, max_h = min(max_w, max_size[0]), min(max_h, max_size[1])
+        if max_w < min_w or max_h < min_h:
+            return np.empty((0, 4), dtype=int)
+        boxes = self.detector.detect(img, (min_w, min_h), (max_w, max_h))
+        return np.asarray(boxes, dtype=int).reshape(-1, 4)
@@ -0,0 +1,259 @@
+
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class CascadeSpec:
+    '''
+    Describes a Haar cascade file and the detectMultiScale parameters used with it.
+
+    fields:
+        path: cascade XML file, relative to the project directory
+        scale_factor: how much the image is shrunk between scales, has to be > 1
+        min_neighbors: how many neighbouring hits a candidate needs to be kept
+        min_size: smallest (w, h) box the cascade looks for
+    '''
+    def __init__(self, path, scale_factor, min_neighbors, min_size):
+        self.path = path
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+
+
+class HogSpec:
+    '''
+    Describes OpenCV's default HOG people detector and the detectMultiScale parameters used with it.
+
+    fields:
+        win_stride: step of the detection window, lower = possibly better accuracy but slower
+        padding: pixels added around the image
+        scale_factor: how much the image is shrunk between scales, has to be > 1
+        min_size: smallest (w, h) box kept, the detector window is 64x128
+    '''
+    def __init__(self, win_stride, padding, scale_factor, min_size):
+        self.win_stride = win_stride
+        self.padding = padding
+        self.scale_factor = scale_factor
+        self.min_size = min_size
+
+
+# detectors we know about, keyed by the name Frame asks for
+CASCADES = {
+    'face': CascadeSpec("haarcascade_frontalface_default.xml", 1.1, 5, (30, 30)),
+    'upper': CascadeSpec("haarcascade_upperbody.xml", 1.05, 5, (50, 50)),
+    'fullbody': CascadeSpec("haarcascade_fullbody.xml", 1.03, 3, (50, 50)),
+    'hog': HogSpec((2, 2), (4, 4), 1.03, (64, 128)),
+}
+
+
+class Detector:
+    '''
+    Handle to a loaded cascade, safe to share between threads.
+
+    A CascadeClassifier keeps the state of the image it is searching, so two threads can't search with
+    the same one. Every thread that detects gets a classifier of its own, made on its first detect()
+    from the XML text the registry read once, so camera threads search in parallel and nothing is
+    read from disk again.
+
+    fields:
+        copies: number of classifiers made for threads other than the one that loaded the cascade
+    '''
+    def __init__(self, name, spec, classifier, make=None):
+        '''
+        :param classifier: CascadeClassifier loaded by the calling thread, it keeps using this one
+        :param make: function returning a new CascadeClassifier of the same cascade, for other threads
+        '''
+        self.name = name
+        self.spec = spec
+        # (w, h) the cascade was trained at, nothing smaller can be found
+        self.window = tuple(classifier.getOriginalWindowSize())
+        self.copies = 0
+        self._make = make
+        self._local = threading.local()
+        self._local.classifier = classifier
+
+    @property
+    def classifier(self):
+        '''
+        :returns the calling thread's CascadeClassifier
+        '''
+        classifier = getattr(self._local, 'classifier', None)
+        if classifier is None:
+            classifier = self._local.classifier = self._make()
+            self.copies += 1
+        return classifier
+
+    def detect(self, img, min_size=None, max_size=None):
+        '''
+        Runs the cascade over the image with the parameters from its spec
+
+        :param img: ndarray image, colour or grayscale
+        :param min_size: optional (w, h) of the smallest box to look for, the spec's min_size if None
+        :param max_size: optional (w, h) of the largest box to look for, scales above it are skipped.
+                         no limit if None
+
+        :returns ndarray of (x, y, w, h) boxes
+        '''
+        return self.classifier.detectMultiScale(img, scaleFactor=self.spec.scale_factor,
+                                                minNeighbors=self.spec.min_neighbors,
+                                                minSize=min_size or self.spec.min_size,
+                                                maxSize=max_size or (0, 0), flags=cv2.CASCADE_SCALE_IMAGE)
+
+
+class HogDetector:
+    '''
+    Handle to a HOG people detector, with the same detect() as a Detector. Every thread that detects
+    gets a HOGDescriptor of its own, like the classifiers of a Detector.
+    '''
+    def __init__(self, name, spec, hog, make=None):
+        self.name = name
+        self.spec = spec
+        self.window = tuple(hog.winSize)
+        self.copies = 0
+        self._make = make
+        self._local = threading.local()
+        self._local.hog = hog
+
+    @property
+    def hog(self):
+        '''
+        :returns the calling thread's HOGDescriptor
+        '''
+        hog = getattr(self._local, 'hog', None)
+        if hog is None:
+            hog = self._local.hog = self._make()
+            self.copies += 1
+        return hog
+
+    def detect(self, img, min_size=None, max_size=None):
+        '''
+        :param img: ndarray image, colour or grayscale
+        :param min_size, max_size: optional (w, h) limits of the boxes kept
+
+        :returns ndarray of (x, y, w, h) boxes
+        '''
+        boxes, _ = self.hog.detectMultiScale(img, winStride=self.spec.win_stride, padding=self.spec.padding,
+                                             scale=self.spec.scale_factor)
+        boxes = np.asarray(boxes, dtype=int).reshape(-1, 4)
+        min_w, min_h = min_size or self.spec.min_size
+        keep = (boxes[:, 2] >= min_w) & (boxes[:, 3] >= min_h)
+        if max_size:
+            keep &= (boxes[:, 2] <= max_size[0]) & (boxes[:, 3] <= max_size[1])
+        return boxes[keep]
+
+
+class DetectorRegistry:
+    '''
+    Loads each cascade (or HOG detector) once per process and lends out Detector handles to frames and threads.
+
+    fields:
+        specs: dict name -> CascadeSpec or HogSpec of detectors that can be loaded
+        base_dir: directory the cascade paths are relative to
+        parse_count: dict name -> how many times the cascade XML was parsed
+        parse_time: dict name -> total seconds spent parsing the cascade XML
+    '''
+    def __init__(self, specs=None, base_dir=None):
+        self.specs = dict(CASCADES if specs is None else specs)
+        self.base_dir = base_dir if base_dir is not None else os.path.dirname(os.path.abspath(__file__))
+        self.parse_count = {}
+        self.parse_time = {}
+        self._detectors = {}
+        self._lock = threading.Lock()
+
+    def load(self, names=None):
+        '''
+        Loads and validates the cascades up front, so a missing or broken XML fails at startup
+        instead of inside a camera thread. Already loaded cascades are not parsed again.
+
+        :param names: names of the cascades to load, all known cascades if None
+
+        :returns None
+        '''
+        for name in (self.specs if names is None else names):
+            self.borrow(name)
+        return None
+
+    def borrow(self, name):
+        '''
+        Gets the shared detector for a cascade, loading it on first use
+
+        :param name: key of the cascade in specs, eg. 'face'
+
+        :returns Detector
+        '''
+        detector = self._detectors.get(name)
+        if detector is not None:
+            return detector
+        with self._lock:
+            # another thread may have loaded it while we waited
+            if name not in self._detectors:
+                self._detectors[name] = self._parse(name)
+            return self._detectors[name]
+
+    def stats(self):
+        '''
+        :returns dict name -> (parse count, total parse seconds)
+        '''
+        return {name: (self.parse_count[name], self.parse_time[name]) for name in self.parse_count}
+
+    def _parse(self, name):
+        if name not in self.specs:
+            raise KeyError("Unknown cascade '{}'".format(name))
+        spec = self.specs[name]
+        if isinstance(spec, HogSpec):
+            start = time.perf_counter()
+            hog = _people_hog()
+            self.parse_count[name] = self.parse_count.get(name, 0) + 1
+            self.parse_time[name] = self.parse_time.get(name, 0.0) + time.perf_counter() - start
+            return HogDetector(name, spec, hog, _people_hog)
+        path = os.path.join(self.base_dir, spec.path)
+
+        start = time.perf_counter()
+        try:
+            with open(path) as f:
+                xml = f.read()
+        except OSError:
+            xml = ''
+        classifier = _read_cascade(xml)
+        elapsed = time.perf_counter() - start
+
+        self.parse_count[name] = self.parse_count.get(name, 0) + 1
+        self.parse_time[name] = self.parse_time.get(name, 0.0) + elapsed
+        # CascadeClassifier doesn't raise on a bad file, it just comes back empty
+        if classifier.empty():
+            raise IOError("Couldn't load cascade '{}' from {}".format(name, path))
+        return Detector(name, spec, classifier, lambda: _read_cascade(xml))
+
+
+def _people_hog():
+    hog = cv2.HOGDescriptor()
+    hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    return hog
+
+
+def _read_cascade(xml):
+    # an empty classifier if the text isn't a cascade, like CascadeClassifier(path) with a bad file
+    classifier = cv2.CascadeClassifier()
+    if xml:
+        storage = cv2.FileStorage(xml, cv2.FILE_STORAGE_READ | cv2.FILE_STORAGE_MEMORY)
+        classifier.read(storage.getFirstTopLevelNode())
+    return classifier
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    '''
+    :returns the process wide DetectorRegistry, created on first call
+    '''
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DetectorRegistry()
+        return _registry
@@ -1,218 +1,256 @@
 
 import cv2
-import numpy as np
-import queue as q
-from threading import Thread
 import sys
+import time
+import numpy as np
 
 
+from detectors import get_registry
 from frame import Frame
+from pipeline import StereoPipeline, RingBuffer
+from stereo import StereoMatcher, RectifiedMatcher
+from calibration import load_calibration, Rectifier
+from workers import ProcessDetector
+from shmring import FrameRing
+from preview import PreviewSink
+from tp17storage import TP17Storage
+from writer import RecordWriter
+from metrics import Metrics, MetricsServer, MetricsLogger
+from depth import DepthPrior, FloorPlane
+from fusion import FusedDetector
+from smoothing import TRACK_DTYPE, TrackSmoother, to_json
 
 DEVICES = [0, 1]
 ERROR = -1
 FPS = 15
-DONE = 1
-
-
-def match_points(left, right):
-    """
-    Find points that represent the same person on both cameras
-
-    Assumption based, only works if the same object is within +- 40px on both cameras
-    this probably needs adjusting for objects that are further away
-    """
-    match = []
-    for left_point in left:
-        for right_point in right:
-            if abs(left_point[0] - right_point[0]) < 40 and abs(left_point[1] - right_point[1]) < 40:
-                match.append([left_point, right_point])
-    return match
-
-
-def get_range(correlations, F, P1, P2):
-    """
-    Using the set of correlations produced by match_points, identify the distance of detected people in the scene.
-
-    :param correlations: List of correlations, each element a list of one or more pairs of points, to use to
-                         calculate distances
-    :returns: A list with the distances for each correlated point.
-    """
-
-    all_dist = []
-
-    for left_group, right_group in correlations:
-        # multiple intersection points are provided, average out the distances
-        left_corrected, right_corrected = cv2.correctMatches(F, np.array([[left_group]]).astype(float),
-                                                             np.array([[right_group]]).astype(float))
-        collection = cv2.triangulatePoints(P1, P2, left_corrected, right_corrected)
-        triangulated = np.mean(collection, axis=1).reshape(4, 1)  # Average the results of the triangulation
-
-        # print(left_group)
-        # print(left_corrected)
-        # print("before mean")
-        # print(collection)
-        # print(triangulated)
-
-        # homo to normal coords by dividing by last element. squares are 25mm.
-        # for some reason, was getting distances *10 of actual so divided the size of the square here by 10
-        in_m = (triangulated[0:3] / triangulated[3]) * 0.0025
-        x, y, z = (float(n) for n in in_m)
-
-        # z <= 0 means behind the camera -- not actually possible.
-        if z > 0:
-            # euclidean distance in 3d space with known coords. camera would be (0,0,0)
-            distance = (x ** 2 + y ** 2 + z ** 2) ** 0.5  # length of vector to get distance to object
-
-            # reference the distance against the average of the intersection points for each image.
-#             left_range[tuple(np.mean(left_group, axis=0))] = (distance, x, y, z)
-#             right_range[tuple(np.mean(right_group, axis=0))] = (distance, x, y, z)
-            all_dist.append(distance)
-            print(distance)
-            print("---------------")
-
-    return all_dist
-
-
-def finished(code):
-    captures[0].release()
-    captures[1].release()
+# left and right frames captured further apart than this (seconds) are not paired, half a frame at FPS
+PAIR_TOLERANCE = 0.5 / FPS
+# frames each ring buffer between the stages holds, and what to drop when one is full
+BUFFER_SIZE = 4
+DROP_POLICY = RingBuffer.DROP_OLDEST
+# worker processes for detection, 0 runs detection in each camera's detection thread
+DETECTION_PROCESSES = 0
+# skip the cascade on frames where nothing moved, only applies when detection runs in the camera threads
+MOTION_GATE = False
+# run the cascade every this many frames and track people in between, None detects on every frame.
+# only applies when detection runs in the camera threads, takes precedence over MOTION_GATE
+DETECT_EVERY = None
+# rectify frames as they are captured, matching becomes a search along rows and depth comes from disparity
+RECTIFIED = False
+# run without any windows, nothing gets drawn. stop with ctrl+c
+HEADLESS = False
+# most frames per second drawn and shown when not headless
+PREVIEW_FPS = 5
+# where section counts and movements of every frame are stored, written on a background thread
+STORAGE_DIR = 'tp17db'
+# frame records waiting for the writer, when it falls this far behind new records are dropped and counted
+WRITE_QUEUE = 1024
+# preallocated frames shared by all the stages, has to cover every frame held in the buffers at once
+FRAME_SLOTS = 32
+# size of a chessboard square used in calibration, in meters. squares are 25mm.
+# for some reason, was getting distances *10 of actual so divided the size of the square here by 10
+SQUARE_SIZE = 0.0025
+# detectors run on every frame, see detectors.CASCADES. with more than one they run as one stage over shared
+# grayscale buffers and overlapping boxes are merged, the first one listed wins. only the first one is used
+# when detection runs in worker processes
+DETECTORS = ['face']
+# run the detectors of a multi detector stage at the same time
+PARALLEL_DETECTORS = True
+# equalize the grayscale copy before detection, helps in poorly or unevenly lit rooms
+EQUALIZE = False
+# size of the grayscale copy the cascade searches relative to the 640x480 frame, eg. 0.5 detects at 320x240.
+# boxes come back in frame pixels. lower is faster, but faces smaller than 24 / DETECTION_SCALE pixels are missed
+DETECTION_SCALE = 1.0
+# only search for faces of the sizes people can have at their possible distances, row band by row band.
+# only applies when detection runs in the camera threads
+DEPTH_AWARE = False
+# height of the cameras above the floor in meters and their downward tilt in radians, limits the distances
+# people can be at on every row when DEPTH_AWARE is on. None if unknown, the whole frame is searched
+# with the sizes between DEPTH_RANGE then
+CAMERA_HEIGHT = None
+CAMERA_PITCH = 0.0
+# nearest and farthest a person can be from the cameras, in meters
+DEPTH_RANGE = (0.5, 8.0)
+# serve stage latencies, frame rates, buffer depths and counters at http://127.0.0.1:METRICS_PORT/metrics,
+# None to not serve them
+METRICS_PORT = None
+# print the same metrics on one line every this many seconds, None to not print them
+METRICS_LOG_EVERY = None
+# smooth every person's position over the last SMOOTHING_WINDOW frames, 'median' or 'kalman'.
+# None to use the distance triangulated on each frame alone
+SMOOTHING = 'median'
+SMOOTHING_WINDOW = 8
+# grab both cameras back to back on their reader threads, so a pair is as close in time as the cameras allow
+SYNC_GRAB = True
+# write the people located on every pair as JSON lines to this file, '-' for stdout, None to not write them
+RANGES_LOG = None
+
+
+def finished(code, captures, pipeline=None, preview=None, writer=None, reporters=()):
+    for reporter in reporters:
+        reporter.close()
+    if pipeline is not None:
+        pipeline.stop()
+        pipeline.join(1)
+        if pipeline.backend is not None:
+            pipeline.backend.close()
+        pipeline.ring.close()
+        for name, value in pipeline.stats().items():
+            print("{}: {}".format(name, value))
+    if writer is not None:
+        writer.close()
+        print("records written: {}, dropped: {}".format(writer.written, writer.dropped))
+    # should read 1 parse per cascade, anything more means a frame built its own classifier
+    for name, (count, seconds) in get_registry().stats().items():
+        print("Cascade '{}' parsed {} time(s) in {:.3f} s".format(name, count, seconds))
+    for cap in captures:
+        cap.release()
+    if preview is not None:
+        preview.close()
     sys.exit(code)
 
 
-def process_frames(cap, device):
+def analyse(pair, prev_counts, writer, ranges_log=None):
     """
-    Reads frame from the capture, detects people and displays the processed frame with distances
+    Analysis stage, stores distances, section counts and movements on both frames of a stereo pair
+    and queues them for storage. Nothing is drawn here, see PreviewSink for that.
 
-    :param device: integer indicating device number 0 - left camera, 1 - right camera
-    :param cap: OpenCV VideoCapture object
+    :param pair: StereoPair from the pipeline
+    :param prev_counts: dict device -> list of section counts on the camera's previous frame, updated in place
+    :param writer: RecordWriter the frame records go to
+    :param ranges_log: optional file the located people are written to, one JSON line per pair
     :return: None
     """
-    while 1:
-        ret, captured_frame = cap.read()
-        # frame read ok
-        if ret:
-            frame = Frame(captured_frame)
-            detection_points = frame.detect_people()
-            # if people were found, we first check which thread it is then use corresponding queue to pass the points
-            # to the main
-            if len(detection_points) > 0:
-                # left camera
-                if device == DEVICES[0]:
-                    left_q.put(detection_points)
-                # right camera
-                else:
-                    right_q.put(detection_points)
-            # if no people were found, we need to pass the 0 to main in order to be able to get a response and continue
-            # displaying frame without distance
-            else:
-                if device == DEVICES[0]:
-                    left_q.put(0)
-                else:
-                    right_q.put(0)
-            # get message from the main, if matching points were found between the 2 threads, this will contain the
-            # distances of people
-            dist = main_q.get()
-            # if main sends DONE confirmation, clean up, send confirmation back and return
-            if dist == DONE:
-                cv2.destroyAllWindows()
-                left_q.put(DONE)
-                right_q.put(DONE)
-                return None
-            # write the distance if matches were found
-            elif dist != 0:
-                # just to be sure, in case there is a synchronisation issue
-                if len(dist) == len(detection_points):
-                    for j in range(len(dist)):
-                        frame.write_distance(detection_points[j], dist[j])
-            # draw the rest of the stuff in any case
-            frame.draw_boundaries()
-            frame.write_time()
-            # pick window
-            if device == DEVICES[0]:
-                frame.show("left")
-            else:
-                frame.show("right")
-            # if 'q' key was pressed, send done signal to the main thread to start shutdown
-            if cv2.waitKey(int(1000 / FPS)) & 0xFF == ord('q'):
-                left_q.put(DONE)
-                right_q.put(DONE)
-
-        # failed to read frame
-        else:
-            print("Couldn't read frame.")
-            left_q.put(DONE)
-            right_q.put(DONE)
-
-
-# load all the matrices we got from calibration
-F = np.loadtxt(open("stereo_F.txt"))
-E = np.loadtxt(open("stereo_E.txt"))
-R = np.loadtxt(open("stereo_R.txt"))
-T = np.loadtxt(open("stereo_T.txt"))
-camera_matrix1 = np.loadtxt("device_0_mtx.txt")
-camera_matrix2 = np.loadtxt("device_1_mtx.txt")
-dist_coef1 = np.loadtxt("device_0_dist.txt")
-dist_coef2 = np.loadtxt("device_1_dist.txt")
-image_size = (640, 480)
-
-# to get projection matrices P, as they are needed for triangulation
-R1, R2, P1, P2, _, _, _ = cv2.stereoRectify(camera_matrix1, dist_coef1, camera_matrix2,dist_coef2, image_size, R, T,
-                                            alpha=0)
-
-captures = []
-# start capture on both cameras, set the frame rate to 15 and set capture in grayscale
-# lowering the frame rate is necessary if it is a cheap "3D" camera - eg. 2 cams on 1 usb port not enough bandwidth
-captures.append(cv2.VideoCapture(DEVICES[0]))
-captures[0].set(5, FPS)
-captures[0].set(12, 0)
-captures.append(cv2.VideoCapture(DEVICES[1]))
-captures[1].set(5, FPS)
-captures[1].set(12, 0)
-dropped_frames = 0
-
-
-left_q = q.Queue()
-right_q = q.Queue()
-main_q = q.Queue()
-
-if captures[0].isOpened() and captures[1].isOpened():
-
-    # start a thread for each of the cameras to improve performance
-    for i in range(len(DEVICES)):
-        cam_thread = Thread(target=process_frames, args=(captures[i], DEVICES[i]))
-        cam_thread.daemon = True
-        cam_thread.start()
-
-    while 1:
-
-        # read the coords of center points of detected people from each thread
-        points_left = left_q.get()
-        points_right = right_q.get()
-        # a sort of 3-way handshake in order to exit gracefully destroying all the windows as they belong to individual
-        # threads. If a thread detects 'q' has been pressed, instead of points list it will send DONE signal (1)
-        if points_left == DONE or points_right == DONE:
-            print("Exiting...")
-            # main confirms it has got the quit signal and sends it back to both threads
-            main_q.put(DONE)
-            main_q.put(DONE)
-            # after they clean up, both cam threads send confirmation back and return
-            left_done = left_q.get()
-            right_done = right_q.get()
-            finished(0)
-        # if both threads have detected people, try to match the points
-        elif points_left != 0 and points_right != 0:
-            matched = match_points(points_left, points_right)
-            if len(matched) > 0:
-                distances = get_range(matched, F, P1, P2)
-                main_q.put(distances)
-                main_q.put(distances)
-            else:
-                main_q.put(0)
-                main_q.put(0)
-        else:
-            main_q.put(0)
-            main_q.put(0)
-
-print("Couldnt start capture. Exiting...")
-finished(ERROR)
-
+    # smoothed positions when there are any, a person without a usable frame keeps the one of this frame
+    ranges = pair.ranges
+    if pair.tracks is not None:
+        smoothed = (pair.tracks['frames'] > 0)[:, None]
+        ranges = np.where(smoothed, np.column_stack((pair.tracks['position'], pair.tracks['distance'])), ranges)
+    for column, packet in enumerate((pair.left, pair.right)):
+        frame = packet.frame
+        # pairs hold (left index, right index) of each range
+        frame.add_distances(pair.pairs[:, column], ranges)
+        frame.count_sections()
+        frame.update_movements(prev_counts[packet.device])
+        writer.submit(frame, packet.device)
+    if ranges_log is not None and len(pair.ranges):
+        tracks = pair.tracks
+        if tracks is None:
+            tracks = np.zeros(len(pair.ranges), dtype=TRACK_DTYPE)
+            tracks['track'] = -1
+            tracks['position'] = pair.ranges[:, :3]
+            tracks['distance'] = pair.ranges[:, 3]
+            tracks['frames'] = 1
+        ranges_log.write(to_json(tracks, time=round(pair.left.timestamp, 3)) + "\n")
+    return None
+
+
+def main():
+    captures = []
+    # start capture on both cameras, set the frame rate to 15 and set capture in grayscale
+    # lowering the frame rate is necessary if it is a cheap "3D" camera - eg. 2 cams on 1 usb port not enough bandwidth
+    for device in DEVICES:
+        cap = cv2.VideoCapture(device)
+        cap.set(5, FPS)
+        cap.set(12, 0)
+        captures.append(cap)
+
+    if not all(cap.isOpened() for cap in captures):
+        print("Couldnt start capture. Exiting...")
+        finished(ERROR, captures)
+
+    # load all the matrices we got from calibration, stereoRectify in there gives the projection matrices P
+    # needed for triangulation. after the first start they come mapped from the calibration bundle
+    calibration = load_calibration(devices=DEVICES)
+    if RECTIFIED:
+        # the remap tables are part of the bundle, nothing is rebuilt
+        rectifier = Rectifier(calibration, DEVICES)
+        matcher = RectifiedMatcher(calibration.Q, SQUARE_SIZE)
+    else:
+        rectifier = None
+        matcher = StereoMatcher(calibration.F, calibration.P1, calibration.P2, SQUARE_SIZE)
+
+    Frame.DETECTION_SCALE = DETECTION_SCALE
+    Frame.EQUALIZE = EQUALIZE
+    ring = FrameRing(FRAME_SLOTS)
+    backend = None
+    if DETECTION_PROCESSES > 0:
+        # every worker loads its own cascade
+        backend = ProcessDetector(ring, DETECTION_PROCESSES, DETECTORS[0], scale=DETECTION_SCALE)
+    else:
+        # parse and validate the cascades once, the detection threads borrow the same detectors
+        get_registry().load(DETECTORS)
+    detector = None
+    if len(DETECTORS) > 1:
+        detector = FusedDetector([get_registry().borrow(name) for name in DETECTORS], PARALLEL_DETECTORS)
+    elif DETECTORS != ['face']:
+        detector = get_registry().borrow(DETECTORS[0])
+
+    writer = RecordWriter(TP17Storage(STORAGE_DIR), WRITE_QUEUE)
+    metrics = None
+    reporters = []
+    if METRICS_PORT is not None or METRICS_LOG_EVERY is not None:
+        metrics = Metrics()
+        metrics.add_collector(lambda: {'records_written': writer.written, 'records_dropped': writer.dropped,
+                                       'records_pending': writer.pending()})
+        if METRICS_PORT is not None:
+            reporters.append(MetricsServer(metrics, METRICS_PORT))
+        if METRICS_LOG_EVERY is not None:
+            reporters.append(MetricsLogger(metrics, METRICS_LOG_EVERY))
+
+    # capture, detection and pairing run on their own threads, analysis and the preview stay here as
+    # HighGUI windows have to be driven from one thread
+    priors = None
+    if DEPTH_AWARE:
+        floor = FloorPlane(CAMERA_HEIGHT, CAMERA_PITCH) if CAMERA_HEIGHT is not None else None
+        # rectified frames are seen through the rectified projections, raw ones through the camera matrices
+        cameras = (calibration.P1, calibration.P2) if RECTIFIED else (calibration.camera_matrix1,
+                                                                       calibration.camera_matrix2)
+        priors = {device: DepthPrior(camera[0, 0], camera[1, 2], Frame.HEIGHT, min_distance=DEPTH_RANGE[0],
+                                     max_distance=DEPTH_RANGE[1], floor=floor)
+                  for device, camera in zip(DEVICES, cameras)}
+
+    smoother = TrackSmoother(matcher, SMOOTHING_WINDOW, SMOOTHING) if SMOOTHING is not None else None
+    ranges_log = None
+    if RANGES_LOG == '-':
+        ranges_log = sys.stdout
+    elif RANGES_LOG is not None:
+        ranges_log = open(RANGES_LOG, 'a', buffering=1)
+        # closed with the other reporters when we finish
+        reporters.append(ranges_log)
+
+    pipeline = StereoPipeline(captures, DEVICES, matcher, PAIR_TOLERANCE, BUFFER_SIZE, DROP_POLICY, backend,
+                              ring, MOTION_GATE, DETECT_EVERY, rectifier, metrics, priors,
+                              detector, smoother, SYNC_GRAB)
+    preview = None if HEADLESS else PreviewSink(PREVIEW_FPS)
+    prev_counts = {device: [0] * (Frame.SPLIT_DIV ** 2) for device in DEVICES}
+
+    pipeline.start()
+    try:
+        while not pipeline.stopped.is_set():
+            began = time.perf_counter()
+            pair = pipeline.paired.get(timeout=0.5)
+            if pair is not None:
+                analysed = time.perf_counter()
+                analyse(pair, prev_counts, writer, ranges_log)
+                shown = time.perf_counter()
+                if preview is not None:
+                    preview.submit(pair)
+                if metrics is not None:
+                    metrics.observe('paired_wait', analysed - began)
+                    metrics.observe('analyse', shown - analysed)
+                    metrics.observe('preview', time.perf_counter() - shown)
+                # frames are analysed and shown, their ring slots can be reused
+                pair.release()
+            # if 'q' key was pressed, shut the pipeline down
+            if preview is not None and preview.poll():
+                print("Exiting...")
+                finished(0, captures, pipeline, preview, writer, reporters)
+    except KeyboardInterrupt:
+        print("Exiting...")
+        finished(0, captures, pipeline, preview, writer, reporters)
+    finished(ERROR, captures, pipeline, preview, writer, reporters)
+
+
+if __name__ == '__main__':
+    main()
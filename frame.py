@@ -1,23 +1,37 @@
 
 import cv2
 import numpy as np
-from section import Section
-from person import Person
-from imutils.object_detection import non_max_suppression
+from section import SectionGrid
+from person import make_people, PERSON_DTYPE
 from datetime import datetime
 from tp17storage import TP17Storage
+from detectors import get_registry
+from pyramid import ImagePyramid, PyramidDetector
+from depth import DepthAwareDetector
+from fusion import FusedDetector
 
 
 class Frame:
     """
     Represents a single frame taken from a video capture.
+
+    Detection and counting only fill in the fields below, nothing is drawn on the image until
+    render() is called, so frames that are never displayed don't pay for drawing.
+
     fields:
         img_data: ndarray representation of a frame from a video
-        movements: list of movements in/out/nochange + count how many for the section
-        sections: 9 equal rectangles that frame is split into. defined by top left coordinates
-                    width and height. list of Section objects
-        people: people detected in the frame, list of Person objects
-        hog: OpenCV classifier object used for detection
+        time_now: datetime the frame was created at
+        movements: int ndarray with the change in people count of every section since the previous frame,
+                   positive - people went in, negative - went out, 0 - no change
+        sections: SPLIT_DIV x SPLIT_DIV equal rectangles that frame is split into. defined by top left
+                    coordinates width and height. list of Section objects shared by all frames of this size
+        counts: ndarray with the number of people in each section, set by count_sections()
+        people: people detected in the frame, person.PERSON_DTYPE ndarray with their boxes, midpoints, the
+                detector that found them, track ids and, once matched on both cameras, positions and distances
+        detection_path: how people were found - 'full' cascade run, or with a motion gate also
+                        'static' (previous detections reused) or 'regions' (only changed regions searched),
+                        with a tracker 'tracked' (people followed from the previous frame)
+        pyramid: ImagePyramid of the frame, the grayscale copies detection runs on
 
     constants:
         .........
@@ -33,13 +47,15 @@ class Frame:
     LINE_WIDTH = 1
     # to split height and width by to give us section width/height
     SPLIT_DIV = 3
+    # how a person is put into a section, SectionGrid.CENTRE (centre of the box) or SectionGrid.AREA
+    # (section holding most of the box)
+    COUNT_MODE = SectionGrid.CENTRE
     FONT = cv2.FONT_HERSHEY_SIMPLEX
-    # 'steps' used during classification , lower stride = possibly better accuracy but slower
-    # choose values between 1 and 16 for best results (higher for larger images)
-    STRIDE = (2,2)
-    PADDING = (4,4)
-    # scale used for classification, has to be > 1, lower scale = better accuracy but slower
-    SCALE = 1.03
+    # size of the grayscale copy the cascades search relative to the frame, eg. 0.5 detects at 320x240.
+    # boxes are mapped back to frame pixels, faces smaller than the cascade window / DETECTION_SCALE are missed
+    DETECTION_SCALE = 1.0
+    # equalize the histogram of the grayscale copy before detection, helps in poorly or unevenly lit rooms
+    EQUALIZE = False
 
 
     def __init__(self,img_data):
@@ -52,22 +68,28 @@ class Frame:
         advice:
             Load a image file using opencv first , then create a new Frame with that
         """
-        #resize the image to improve performance if neccessary
-        self.img_data = cv2.resize(img_data, (self.WIDTH, self.HEIGHT))
-        self.sections = []
-        self.people = []
-        #self.hog = cv2.HOGDescriptor()
-        #use default OpenCV pedestrian detector, to improve - train own detector and replace this
-        #self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+        #resize the image to improve performance if neccessary, frames that already fit are used as they are
+        #so a frame living in shared memory is drawn on in place instead of copied
+        if img_data.shape[:2] == (self.HEIGHT, self.WIDTH):
+            self.img_data = img_data
+        else:
+            self.img_data = cv2.resize(img_data, (self.WIDTH, self.HEIGHT))
+        self.grid = SectionGrid.get(self.WIDTH, self.HEIGHT, self.SPLIT_DIV, self.SPLIT_DIV)
+        self.sections = self.grid.sections
+        self.pyramid = ImagePyramid(self.img_data, self.EQUALIZE)
+        self.counts = None
+        self.people = np.zeros(0, dtype=PERSON_DTYPE)
+        self.time_now = datetime.now()
+        self.detection_path = None
 
 
-        self.movements = []
+        self.movements = None
 
 
 
     def draw_boundaries(self):
         """
-        Splits the frame into 9 equal rectangles, counts persons belonging to each of those
+        Splits the frame into equal rectangles, counts persons belonging to each of those
         and displays the number of people in each.
 
         :returns None
@@ -75,94 +97,133 @@ class Frame:
         usage:
             mustn't use before people are detected using detect_people()
         """
-        sec_height = int(self.HEIGHT/self.SPLIT_DIV)
-        sec_width = int(self.WIDTH/self.SPLIT_DIV)
-        x = 0
-        y = 0
-        #this will essentialy be 4 iterations with default settings as we are splitting the frame
-        #into 9 sections but include edge lines
-        while x <= self.WIDTH:
+        for x in self.grid.x_edges:
             #draw vertical (y is constant, x changes as a start point)
-            self.draw_line(x)
+            self.draw_line(int(x))
+        for y in self.grid.y_edges:
             #draw horizontal (x is constant, y changes as a start point)
-            self.draw_line(y,'h')
-            #section top left x
-            sec_tl = 0
-            #we calc the section top left coords by getting the x while the y is constant
-            #then y will change in the next outer while and we do the next lot
-            while sec_tl < self.WIDTH-2 and len(self.sections) < 9:
-                self.sections.append(Section(sec_tl,y,sec_width,sec_height))
-                sec_tl += sec_width
-            x += sec_width
-            y += sec_height
+            self.draw_line(int(y),'h')
 
         #count people in each section and write numbers at their top left
-        for sec in self.sections:
-            sec.count_people(self.people)
-            cv2.putText(self.img_data,str(sec.people_count), (sec.x+10,sec.y+15),self.FONT,0.5,self.RED,1,cv2.LINE_AA)
+        if self.counts is None:
+            self.count_sections()
+        for sec, count in zip(self.sections, self.counts):
+            cv2.putText(self.img_data,str(count), (sec.x+10,sec.y+15),self.FONT,0.5,self.RED,1,cv2.LINE_AA)
 
         return None
 
-    def detect_people(self):
+    def count_sections(self):
         """
-        Detects people in the whole frame and draws green rectangles around them
-        Stores people in a list of objects type Person, so we can use them when counting
-        people in each section later.
+        Counts people in every section in one pass over the detected boxes
 
-        :returns None
+        :returns ndarray of counts, one per section
         """
-        # (rects, weights) = self.hog.detectMultiScale(self.img_data, winStride=self.STRIDE,padding=self.PADDING, scale=self.SCALE)
-        # # for (x, y, w, h) in rects:
-        # #     cv2.rectangle(self.img_data, (x, y), (x + w, y + h), (0, 0, 255), 2)
-        # #     self.people.append(Person(x,y,w, h))
-        # # apply non-maxima suppression to the bounding boxes using a
-        # # fairly large overlap threshold to try to maintain overlapping
-        # # boxes that are still people
-        # rects = np.array([[x, y, x + w, y + h] for (x, y, w, h) in rects])
-        # people = non_max_suppression(rects, probs=None, overlapThresh=0.65)
-        #
-        midpoints = []
-        # # draw the final bounding boxes
-        # for (xA, yA, xB, yB) in people:
-        #     cv2.rectangle(self.img_data, (xA, yA), (xB, yB), self.GREEN, 2)
-        #     self.people.append(Person(xA,yA,xB - xA, yB - yA))
-        #     #point in the middle of the detected rectangle
-        #     midpoints.append((int((xB-xA)/2), int((yB - yA)/2)))
-        face_detector = cv2.CascadeClassifier("haarcascade_frontalface_default.xml")
-
-        faces = face_detector.detectMultiScale(self.img_data, scaleFactor = 1.1, minNeighbors = 5, minSize = (30,30),
-                                               flags = cv2.CASCADE_SCALE_IMAGE)
-        for(x,y,w,h) in faces:
-            cv2.rectangle(self.img_data, (x,y), (x+w, y+h), self.GREEN, 2)
-            self.people.append(Person(x,y,w, h))
-            midpoints.append((int(x+w/2), int(y+h/2)))
-        return midpoints
+        self.counts = self.grid.count(self.people['box'], self.COUNT_MODE)
+        return self.counts
 
-    def detect_upper(self):
-        midpoints = []
+    def detect_people(self, detector=None, gate=None, tracker=None, prior=None):
+        """
+        Detects people in the whole frame.
+        Stores them in people, so we can use them when counting people in each section later.
+
+        :param detector: Detector borrowed from the DetectorRegistry or a FusedDetector, the shared face
+                         cascade if None
+        :param gate: optional MotionGate of the camera, skips the cascade where nothing moved
+        :param tracker: optional PersonTracker of the camera, runs the cascade only every few frames
+                        and gives people persistent track ids. Takes precedence over the gate.
+        :param prior: optional DepthPrior of the camera, limits the search to the face sizes people
+                      can have in each part of the frame
+
+        :returns (N, 2) ndarray of (x, y) midpoints of the detected people, a view of people['midpoint']
+        """
+        if detector is None:
+            detector = get_registry().borrow('face')
+        detector = self._bind(detector, prior)
+        if tracker is not None:
+            self.detection_path, boxes, ids = tracker.update(detector, self.img_data)
+            return self.add_people(boxes, ids, detector.name)
+        if gate is None:
+            return self._detect(detector)
+        self.detection_path, boxes = gate.detect(detector, self.img_data)
+        return self.add_people(boxes, labels=detector.name)
+
+    def detect_upper(self, detector=None):
+        if detector is None:
+            detector = get_registry().borrow('upper')
+        return self._detect(self._bind(detector))
+
+    def detect_fullbody(self, detector=None):
+        if detector is None:
+            detector = get_registry().borrow('fullbody')
+        return self._detect(self._bind(detector))
+
+    def detect_all(self, fused=None):
+        """
+        Detects people with several detectors in one stage, sharing the grayscale buffers,
+        and keeps one record per person found
 
-        upperbody_detector = cv2.CascadeClassifier("haarcascade_upperbody.xml")
+        :param fused: FusedDetector to use, face, upper body and full body cascades if None
 
-        bodies = upperbody_detector.detectMultiScale(self.img_data, scaleFactor=1.05, minNeighbors=5, minSize=(50, 50),
-                                                     flags=cv2.CASCADE_SCALE_IMAGE)
-        for(x, y, w, h) in bodies:
-            cv2.rectangle(self.img_data, (x,y), (x+w, y+h), self.GREEN, 2)
-            self.people.append(Person(x,y,w, h))
-            midpoints.append((int(x+w/2), int(y+h/2)))
-        return midpoints
+        :returns (N, 2) ndarray of (x, y) midpoints of the detected people
+        """
+        if fused is None:
+            registry = get_registry()
+            fused = FusedDetector([registry.borrow(name) for name in ('face', 'upper', 'fullbody')])
+        return self._detect(self._bind(fused))
 
-    def detect_fullbody(self):
-        midpoints = []
+    def _bind(self, detector, prior=None):
+        """
+        Makes a detector search this frame's pyramid at DETECTION_SCALE, and only the sizes the prior allows
 
-        fullbody_detector = cv2.CascadeClassifier("haarcascade_fullbody.xml")
+        :returns object with the same detect() as a Detector
+        """
+        def bound(member):
+            member = PyramidDetector(self.pyramid, member, self.DETECTION_SCALE)
+            return member if prior is None else DepthAwareDetector(member, prior)
+
+        if isinstance(detector, FusedDetector):
+            # make the shared level here, so members searching in parallel don't all make it
+            self.pyramid.level(self.DETECTION_SCALE)
+            # every member gets the prior with its own box sizes, the fused detector still labels the boxes
+            return detector.bind(bound)
+        return bound(detector)
+
+    def _detect(self, detector):
+        """
+        Runs a borrowed detector over the frame and stores the hits in people
 
-        bodies = fullbody_detector.detectMultiScale(self.img_data, scaleFactor = 1.03, minNeighbors=3, minSize=(50, 50),
-                                                    flags=cv2.CASCADE_SCALE_IMAGE)
-        for(x, y, w, h) in bodies:
-            cv2.rectangle(self.img_data, (x,y), (x+w, y+h), self.GREEN, 2)
-            self.people.append(Person(x,y,w, h))
-            midpoints.append((int(x+w/2), int(y+h/2)))
-        return midpoints
+        :param detector: Detector handle from the DetectorRegistry
+
+        :returns (N, 2) ndarray of (x, y) midpoints of the detected boxes
+        """
+        self.detection_path = 'full'
+        if hasattr(detector, 'detect_labelled'):
+            boxes, labels = detector.detect_labelled(self.img_data)
+            return self.add_people(boxes, labels=labels)
+        return self.add_people(detector.detect(self.img_data), labels=detector.name)
+
+    def add_people(self, boxes, track_ids=None, labels=None):
+        """
+        Stores boxes detected elsewhere, eg. by a tracker, in people
+
+        :param boxes: (x, y, w, h) boxes in frame coordinates
+        :param track_ids: optional track id of each box
+        :param labels: optional name of the detector that found each box, or one name for all
+
+        :returns (N, 2) ndarray of (x, y) midpoints of all the people of the frame
+        """
+        return self.add_records(make_people(boxes, track_ids, labels))
+
+    def add_records(self, people):
+        """
+        Stores people already made into records, eg. by a worker process
+
+        :param people: person.PERSON_DTYPE ndarray
+
+        :returns (N, 2) ndarray of (x, y) midpoints of all the people of the frame
+        """
+        self.people = people if len(self.people) == 0 else np.concatenate((self.people, people))
+        return self.people['midpoint']
 
     def draw_line(self, start, orientation='v'):
         """
@@ -182,14 +243,14 @@ class Frame:
 
     def write_time(self):
         """
-        Writes system time at the bottom right corner of the frame
+        Writes the time the frame was created at the bottom right corner of the frame
 
         :returns None
 
         usage:
             frame.write_time() - at any time after initializing the frame
         """
-        time_now = str(datetime.now())
+        time_now = str(self.time_now)
         loc = (self.WIDTH - 4*len(time_now), self.HEIGHT - 10)
 
         cv2.putText(self.img_data, time_now, loc, self.FONT, 0.24, self.RED, 1, cv2.LINE_AA)
@@ -205,20 +266,44 @@ class Frame:
 
         :returns prev_counts: updated counts for each section
         """
-        for i in range(len(self.sections)):
-            cur = self.sections[i].people_count
-            prev = prev_counts[i]
-            # find out how many people went in/out of the section
-            if cur > prev:
-                self.movements.append(str(cur-prev) + ' IN')
-            elif cur < prev:
-                self.movements.append(str(prev-cur)+ ' OUT')
-            else:
-                self.movements.append('NO CHANGE')
-            prev_counts[i] = self.sections[i].people_count
+        if self.counts is None:
+            self.count_sections()
+        # how many people went in (positive) or out (negative) of every section
+        self.movements = self.counts - np.asarray(prev_counts)
+        prev_counts[:] = self.counts
 
         return prev_counts
 
+    def add_distances(self, indices, ranges):
+        """
+        Stores where people matched on both cameras are
+
+        :param indices: index in people of every matched person
+        :param ranges: (K, 4) array like of their (x, y, z, distance) in meters, row k is person indices[k]
+
+        :returns None
+        """
+        ranges = np.asarray(ranges, dtype=float).reshape(-1, 4)
+        self.people['position'][indices] = ranges[:, :3]
+        self.people['distance'][indices] = ranges[:, 3]
+        return None
+
+    def render(self):
+        """
+        Draws everything known about the frame onto the image - people, sections with their counts,
+        distances and time. Only needed when the frame is going to be displayed.
+
+        :returns None
+        """
+        for x, y, w, h in self.people['box'].tolist():
+            cv2.rectangle(self.img_data, (x,y), (x+w, y+h), self.GREEN, 2)
+        self.draw_boundaries()
+        matched = np.isfinite(self.people['distance'])
+        for point, dist in zip(self.people['midpoint'][matched].tolist(), self.people['distance'][matched].tolist()):
+            self.write_distance(tuple(point), dist)
+        self.write_time()
+        return None
+
     def write_distance(self, point, dist):
         cv2.putText(self.img_data, "{0:.2f}".format(dist) + " m", point, self.FONT, 0.4, (self.BLUE), 1, cv2.LINE_AA)
         return None
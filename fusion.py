@@ -0,0 +1,105 @@
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# boxes overlapping by more than this fraction of the smaller box are taken to be the same person
+OVERLAP = 0.65
+
+
+def non_max_suppression(boxes, scores, overlap=OVERLAP):
+    '''
+    Greedy non-maximum suppression, highest score first. Overlap is measured as the intersection over
+    the smaller box, so a face box inside the upper body box of the same person is suppressed too.
+
+    :param boxes: (N, 4) array like of (x, y, w, h) boxes
+    :param scores: (N,) array like, higher boxes win
+    :param overlap: fraction of the smaller box above which the lower scored box is dropped
+
+    :returns int ndarray of the indices of the kept boxes, highest score first
+    '''
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.empty(0, dtype=int)
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
+    area = boxes[:, 2] * boxes[:, 3]
+    # every pair at once, only the greedy pass below is a loop
+    inter = (np.clip(np.minimum(x1[:, None], x1[None, :]) - np.maximum(x0[:, None], x0[None, :]), 0, None) *
+             np.clip(np.minimum(y1[:, None], y1[None, :]) - np.maximum(y0[:, None], y0[None, :]), 0, None))
+    covered = inter / np.maximum(np.minimum(area[:, None], area[None, :]), 1)
+
+    order = np.argsort(-np.asarray(scores, dtype=float), kind='stable')
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    kept = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        kept.append(i)
+        suppressed |= covered[i] > overlap
+    return np.array(kept, dtype=int)
+
+
+class FusedDetector:
+    '''
+    Runs several detectors over the same frame as one detection stage and merges what they find.
+
+    Frame binds every member to its ImagePyramid, so the grayscale (and equalized) buffers are made
+    once and shared by all of them. With parallel on, the members search at the same time, OpenCV
+    releases the GIL while detecting. Overlapping boxes are merged with non_max_suppression, members
+    listed first win, so list the detector with the most useful box (eg. 'face' for distances) first.
+    Has the same detect() as a Detector, detect_labelled() also says which member found each box.
+
+    fields:
+        detectors: member detectors, in order of preference
+        name: names of the members joined with '+'
+        spec: spec of the first member
+        overlap: see non_max_suppression
+    '''
+    def __init__(self, detectors, parallel=False, overlap=OVERLAP, executor=None):
+        self.detectors = list(detectors)
+        self.parallel = parallel
+        self.overlap = overlap
+        self.name = '+'.join(detector.name for detector in self.detectors)
+        self.spec = self.detectors[0].spec
+        self.window = getattr(self.detectors[0], 'window', self.spec.min_size)
+        self._executor = executor
+        if parallel and executor is None:
+            self._executor = ThreadPoolExecutor(len(self.detectors))
+
+    def bind(self, wrap):
+        '''
+        :param wrap: function taking a member detector and returning the detector to use in its place
+
+        :returns FusedDetector over the wrapped members, sharing this one's threads
+        '''
+        return FusedDetector([wrap(detector) for detector in self.detectors], self.parallel, self.overlap,
+                             self._executor)
+
+    def detect(self, img, min_size=None, max_size=None):
+        return self.detect_labelled(img, min_size, max_size)[0]
+
+    def detect_labelled(self, img, min_size=None, max_size=None):
+        '''
+        :param img: BGR frame, or a crop of one
+        :param min_size, max_size: optional (w, h) box size limits handed to every member
+
+        :returns ((N, 4) int ndarray of (x, y, w, h) boxes, list of the name of the member that found each)
+        '''
+        search = lambda detector: np.asarray(detector.detect(img, min_size, max_size), dtype=int).reshape(-1, 4)
+        if self._executor is not None:
+            found = list(self._executor.map(search, self.detectors))
+        else:
+            found = [search(detector) for detector in self.detectors]
+
+        boxes = np.concatenate(found)
+        member = np.repeat(np.arange(len(found)), [len(f) for f in found])
+        # earlier members first, larger boxes first within a member
+        scores = (len(found) - member) * 1e9 + boxes[:, 2] * boxes[:, 3]
+        kept = non_max_suppression(boxes, scores, self.overlap)
+        return boxes[kept], [self.detectors[m].name for m in member[kept]]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        return None
@@ -0,0 +1,228 @@
+
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# achieved frame rate is measured over this many seconds
+FPS_WINDOW = 5.0
+# prefix of every exported metric name
+PREFIX = 'peopledetection_'
+
+
+class Histogram:
+    '''
+    Latency histogram with fixed buckets, cheap enough to observe every frame.
+
+    Not locked, every histogram is written by the one thread that runs its stage.
+
+    fields:
+        counts: observations per bucket, the last one counts everything above the largest bound
+        total: sum of all observed values
+        count: number of observations
+    '''
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+        return None
+
+    def quantile(self, q):
+        '''
+        :returns upper bound of the bucket holding the q quantile, inf if it is above every bucket
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    '''
+    Stage latencies, achieved frame rates and counters of a running pipeline.
+
+    Stages report how long they took with observe(), cameras report every captured frame with frame().
+    Counters and buffer depths the pipeline already keeps are read through collectors, functions
+    returning a dict of name -> value, only when the metrics are rendered.
+
+    fields:
+        histograms: dict (stage, device) -> Histogram, device is None for stages shared by both cameras
+        collectors: functions called on every render
+    '''
+    def __init__(self, fps_window=FPS_WINDOW):
+        self.fps_window = fps_window
+        self.histograms = {}
+        self.collectors = []
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, device=None):
+        '''
+        Records how long one run of a stage took
+
+        :returns None
+        '''
+        histogram = self.histograms.get((stage, device))
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault((stage, device), Histogram())
+        histogram.observe(seconds)
+        return None
+
+    def frame(self, device):
+        '''
+        Records a frame captured by a camera
+
+        :returns None
+        '''
+        times = self._frames.get(device)
+        if times is None:
+            with self._lock:
+                times = self._frames.setdefault(device, deque(maxlen=1024))
+        times.append(time.monotonic())
+        return None
+
+    def fps(self):
+        '''
+        :returns dict device -> frames per second captured over the last fps_window seconds
+        '''
+        now = time.monotonic()
+        rates = {}
+        with self._lock:
+            frames = list(self._frames.items())
+        for device, times in frames:
+            recent = [t for t in list(times) if t >= now - self.fps_window]
+            rates[device] = (len(recent) - 1) / (recent[-1] - recent[0]) if len(recent) > 1 and recent[-1] > recent[0] else 0.0
+        return rates
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+        return None
+
+    def collect(self):
+        '''
+        :returns dict name -> value from every collector
+        '''
+        values = {}
+        for collector in self.collectors:
+            values.update(collector())
+        return values
+
+    def render(self):
+        '''
+        :returns the metrics in the Prometheus text format
+        '''
+        lines = []
+        histograms = self._histograms()
+        stages = sorted({stage for (stage, _), _ in histograms})
+        for stage in stages:
+            name = PREFIX + stage + '_seconds'
+            lines.append('# TYPE {} histogram'.format(name))
+            for (s, device), histogram in histograms:
+                if s != stage:
+                    continue
+                label = '' if device is None else 'device="{}",'.format(device)
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, label, le, cumulative))
+                label = '{' + label.rstrip(',') + '}' if label else ''
+                lines.append('{}_sum{} {}'.format(name, label, histogram.total))
+                lines.append('{}_count{} {}'.format(name, label, histogram.count))
+
+        lines.append('# TYPE {}fps gauge'.format(PREFIX))
+        for device, rate in sorted(self.fps().items()):
+            lines.append('{}fps{{device="{}"}} {:.3f}'.format(PREFIX, device, rate))
+        for name, value in sorted(self.collect().items()):
+            lines.append('{}{} {}'.format(PREFIX, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''
+        :returns one line with the frame rates, median and p99 stage latencies and the collected values
+        '''
+        parts = ['fps {}'.format(' '.join('{}={:.1f}'.format(d, r) for d, r in sorted(self.fps().items())))]
+        for (stage, device), histogram in self._histograms():
+            name = stage if device is None else '{}[{}]'.format(stage, device)
+            parts.append('{} p50<={:g}ms p99<={:g}ms'.format(name, histogram.quantile(0.5) * 1e3,
+                                                              histogram.quantile(0.99) * 1e3))
+        parts.extend('{}={}'.format(name, value) for name, value in sorted(self.collect().items()))
+        return ' | '.join(parts)
+
+    def _histograms(self):
+        # stage threads add new keys while the server or logger thread reads, iterate over a copy
+        with self._lock:
+            histograms = list(self.histograms.items())
+        return sorted(histograms, key=lambda item: str(item[0]))
+
+
+class MetricsServer:
+    '''
+    Serves Metrics.render() at http://host:port/metrics from a background thread
+    '''
+    def __init__(self, metrics, port=9017, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes would flood the console
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        return None
+
+
+class MetricsLogger:
+    '''
+    Prints Metrics.summary() every interval seconds from a background thread
+    '''
+    def __init__(self, metrics, interval=10.0):
+        self.metrics = metrics
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        return None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            print(self.metrics.summary())
+        return None
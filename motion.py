@@ -0,0 +1,163 @@
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    '''
+    Cheap change detector run before the cascade, one per camera.
+
+    Every frame is shrunk to a small grayscale copy and diffed against the copy the cascade last
+    searched, so slow movement adds up over frames until it counts as a change. A static scene
+    skips the cascade and reuses the last detections, small changes run the cascade only over the
+    regions that changed, grown over the people last found in them, large changes (or every
+    refresh_every frames) run it over the whole frame.
+
+    fields:
+        boxes: (N, 4) ndarray of the last (x, y, w, h) detections, in frame coordinates
+        paths: dict path -> how many frames took it
+    '''
+    STATIC = 'static'
+    REGIONS = 'regions'
+    FULL = 'full'
+
+    def __init__(self, scale=0.25, threshold=25, min_changed=0.002, max_changed=0.3, margin=24,
+                 refresh_every=30):
+        '''
+        :param scale: size of the diffed copy relative to the frame
+        :param threshold: grey level difference that counts as a changed pixel
+        :param min_changed: fraction of changed pixels below which the scene is static
+        :param max_changed: fraction of changed pixels (or of area covered by regions) above which
+                            the whole frame is searched
+        :param margin: pixels added around each changed region, so a face moving into it fits
+        :param refresh_every: run a full detection at least this often, in frames
+        '''
+        self.scale = scale
+        self.threshold = threshold
+        self.min_changed = min_changed
+        self.max_changed = max_changed
+        self.margin = margin
+        self.refresh_every = refresh_every
+        self.boxes = np.empty((0, 4), dtype=int)
+        self.paths = {self.STATIC: 0, self.REGIONS: 0, self.FULL: 0}
+        self._previous = None
+        self._since_full = 0
+
+    def changed_regions(self, img):
+        '''
+        Compares the image with what the cascade last searched, doesn't change the gate
+
+        :param img: BGR frame
+
+        :returns (path, regions, small) - which path the frame should take, for REGIONS a list of
+                 (x, y, w, h) changed regions in frame coordinates, and the small grayscale copy
+                 of the frame that was compared
+        '''
+        small = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        previous = self._previous
+        if previous is None or self._since_full + 1 >= self.refresh_every:
+            return self.FULL, [], small
+
+        _, mask = cv2.threshold(cv2.absdiff(small, previous), self.threshold, 255, cv2.THRESH_BINARY)
+        changed = cv2.countNonZero(mask) / float(mask.size)
+        if changed < self.min_changed:
+            return self.STATIC, [], small
+        if changed > self.max_changed:
+            return self.FULL, [], small
+
+        contours, _ = cv2.findContours(cv2.dilate(mask, None, iterations=2), cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_SIMPLE)
+        height, width = img.shape[:2]
+        regions, area = [], 0
+        for contour in contours:
+            x, y, w, h = (int(v / self.scale) for v in cv2.boundingRect(contour))
+            x0, y0 = max(x - self.margin, 0), max(y - self.margin, 0)
+            x1, y1 = min(x + w + self.margin, width), min(y + h + self.margin, height)
+            regions.append((x0, y0, x1 - x0, y1 - y0))
+            area += (x1 - x0) * (y1 - y0)
+        if area > self.max_changed * width * height:
+            return self.FULL, [], small
+        return self.REGIONS, regions, small
+
+    def detect(self, detector, img):
+        '''
+        Runs the detector only where the scene changed
+
+        :param detector: Detector borrowed from the DetectorRegistry
+        :param img: BGR frame
+
+        :returns (path, boxes) - path the frame took and (N, 4) ndarray of (x, y, w, h) detections
+        '''
+        path, regions, small = self.changed_regions(img)
+        self._since_full += 1
+        if path == self.FULL:
+            self.boxes = np.asarray(detector.detect(img), dtype=int).reshape(-1, 4)
+            self._previous = small
+            self._since_full = 0
+        elif path == self.REGIONS:
+            regions = _grow(regions, self.boxes)
+            self.boxes = self._detect_regions(detector, img, regions)
+            # only the searched regions are what the cascade saw last, changes too small to count
+            # elsewhere keep adding up
+            for (x, y, w, h) in regions:
+                x0, y0 = int(x * self.scale), int(y * self.scale)
+                x1, y1 = int(np.ceil((x + w) * self.scale)), int(np.ceil((y + h) * self.scale))
+                self._previous[y0:y1, x0:x1] = small[y0:y1, x0:x1]
+        self.paths[path] += 1
+        return path, self.boxes
+
+    def _detect_regions(self, detector, img, regions):
+        min_w, min_h = detector.spec.min_size
+        # keep what we found last time outside the changed regions, it hasn't moved. regions were
+        # grown over every box they touch, so the others are searched again whole
+        kept = [box for box in self.boxes if not any(_overlaps(box, region) for region in regions)]
+        found = []
+        for (x, y, w, h) in regions:
+            # a region smaller than the cascade window can't contain anything
+            if w < min_w or h < min_h:
+                continue
+            for (bx, by, bw, bh) in detector.detect(img[y:y + h, x:x + w]):
+                found.append((bx + x, by + y, bw, bh))
+        return np.array(kept + found, dtype=int).reshape(-1, 4)
+
+
+def _grow(regions, boxes):
+    '''
+    A changed region can be narrower than the person in it, eg. only the edges that moved. Grows
+    every region over the boxes it touches and merges regions that then overlap, until no region
+    cuts through a box or another region
+
+    :param regions: list of (x, y, w, h) changed regions
+    :param boxes: (N, 4) previous detections
+
+    :returns list of (x, y, w, h) regions
+    '''
+    regions = [tuple(int(v) for v in region) for region in regions]
+    boxes = [tuple(int(v) for v in box) for box in boxes]
+    grown = True
+    while grown:
+        grown = False
+        for i in range(len(regions)):
+            for other in boxes + regions[:i] + regions[i + 1:]:
+                if _overlaps(regions[i], other) and not _contains(regions[i], other):
+                    regions[i] = _union(regions[i], other)
+                    grown = True
+        # a region grown over another one covers it, keep one of every region left
+        regions = [region for i, region in enumerate(regions)
+                   if not any(_contains(other, region) and (other != region or j < i)
+                              for j, other in enumerate(regions) if j != i)]
+    return regions
+
+
+def _overlaps(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def _contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and b[0] + b[2] <= a[0] + a[2] and b[1] + b[3] <= a[1] + a[3]
+
+
+def _union(a, b):
+    x, y = min(a[0], b[0]), min(a[1], b[1])
+    return x, y, max(a[0] + a[2], b[0] + b[2]) - x, max(a[1] + a[3], b[1] + b[3]) - y
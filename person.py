@@ -1,16 +1,57 @@
 
-class Person:
+import numpy as np
+
+from detectors import CASCADES
+
+# one person detected by opencv detection mechanism, the people of a frame are one ndarray of these
+#   box: (x, y, w, h) bounding box surrounding the person, top left point, width and height
+#   midpoint: (x, y) centre of the box, the point matched between the cameras
+#   detector: index in LABELS of the detector that found the person, -1 if not known
+#   track_id: id given by a PersonTracker, stays the same across frames. -1 if not tracked
+#   position: (x, y, z) in meters with the left camera at (0, 0, 0), nan until matched on both cameras
+#   distance: from the left camera in meters, nan until matched on both cameras
+PERSON_DTYPE = np.dtype([('box', np.int32, 4), ('midpoint', np.int32, 2), ('detector', np.int8),
+                         ('track_id', np.int32), ('position', np.float32, 3), ('distance', np.float32)])
+# detector names, in the same order in every process so the codes mean the same everywhere
+LABELS = tuple(CASCADES)
+NO_TRACK = -1
+
+
+def make_people(boxes, track_ids=None, labels=None):
+    '''
+    :param boxes: (N, 4) array like of (x, y, w, h) boxes
+    :param track_ids: optional track id of each box, None entries are stored as NO_TRACK
+    :param labels: optional name of the detector that found each box, or one name for all of them
+
+    :returns (N,) PERSON_DTYPE ndarray, not matched on both cameras yet
     '''
-    Represents a person detected by opencv detection mechanism
+    boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+    people = np.zeros(len(boxes), dtype=PERSON_DTYPE)
+    people['box'] = boxes
+    # same rounding as int(x + w / 2)
+    people['midpoint'] = boxes[:, :2] + boxes[:, 2:] // 2
+    people['detector'] = -1
+    people['track_id'] = NO_TRACK
+    people['position'] = np.nan
+    people['distance'] = np.nan
+    if labels is not None:
+        if isinstance(labels, str):
+            labels = [labels] * len(boxes)
+        people['detector'] = [label_code(label) for label in labels]
+    if track_ids is not None:
+        people['track_id'] = [NO_TRACK if track_id is None else track_id for track_id in track_ids]
+    return people
 
-    fields:
-        x: x coordinate of the top left point of the bounding box surrounding the person
-        y: y coordinate of the top left point
-        height: height of the bounding box
-        width: width of the bounding box
+
+def label_code(name):
+    '''
+    :returns index of the detector name in LABELS, -1 for None or a name not in it
+    '''
+    return LABELS.index(name) if name in LABELS else -1
+
+
+def label_name(code):
+    '''
+    :returns detector name of a code from label_code, None for -1
     '''
-    def __init__(self,x,y,width,height):
-        self.x = x
-        self.y = y
-        self.height = height
-        self.width = width
+    return LABELS[code] if 0 <= code < len(LABELS) else None
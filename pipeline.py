@@ -0,0 +1,470 @@
+
+import threading
+import time
+from collections import deque
+from threading import Thread
+
+import cv2
+
+from capture import open_readers, read_together
+from frame import Frame
+from motion import MotionGate
+from tracker import PersonTracker
+
+
+class RingBuffer:
+    '''
+    Bounded FIFO joining two pipeline stages.
+
+    When the buffer is full the drop policy decides what goes: DROP_OLDEST evicts the item at the
+    head so consumers always see fresh frames, DROP_NEWEST rejects the incoming item.
+    Every dropped item is counted.
+
+    fields:
+        capacity: maximum number of items held
+        policy: DROP_OLDEST or DROP_NEWEST
+        dropped: number of items dropped because the buffer was full
+        on_drop: optional function called with every dropped item, eg. to release its frame slot
+    '''
+    DROP_OLDEST = 'oldest'
+    DROP_NEWEST = 'newest'
+
+    def __init__(self, capacity, policy=DROP_OLDEST, on_drop=None):
+        if policy not in (self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError("Unknown drop policy '{}'".format(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.dropped = 0
+        self.on_drop = on_drop
+        self.closed = False
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        '''
+        Adds an item, dropping one according to the policy if the buffer is full
+
+        :returns True if the item was added
+        '''
+        dropped = None
+        with self._cond:
+            if self.closed:
+                dropped = item
+            elif len(self._items) >= self.capacity:
+                self.dropped += 1
+                if self.policy == self.DROP_NEWEST:
+                    dropped = item
+                else:
+                    dropped = self._items.popleft()
+            if dropped is not item:
+                self._items.append(item)
+                # a producer may be waiting in wait_empty() too, wake everyone
+                self._cond.notify_all()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+        return dropped is not item
+
+    def get(self, timeout=None):
+        '''
+        Takes the oldest item, waiting for one if the buffer is empty
+
+        :param timeout: seconds to wait, forever if None
+
+        :returns the item, or None on timeout or once the buffer is closed and empty
+        '''
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self.closed, timeout)
+            if self._items:
+                item = self._items.popleft()
+                self._cond.notify_all()
+                return item
+            return None
+
+    def wait_empty(self, timeout=None):
+        '''
+        Waits until the consumer took everything, for producers that would rather make an item late
+        than have it wait in the buffer
+
+        :returns True if the buffer is empty, False on timeout or once it is closed
+        '''
+        with self._cond:
+            self._cond.wait_for(lambda: not self._items or self.closed, timeout)
+            return not self._items and not self.closed
+
+    def close(self):
+        '''
+        Wakes up every waiting consumer, no more items are accepted after this
+
+        :returns None
+        '''
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        return None
+
+    def __len__(self):
+        return len(self._items)
+
+
+class Packet:
+    '''
+    A single camera frame travelling through the pipeline.
+
+    fields:
+        device: device number of the camera it came from
+        timestamp: time.monotonic() taken right after the frame was read
+        img: captured image
+        frame: Frame built from the image, set by the detection stage
+        points: (N, 2) ndarray of the midpoints of people detected in the frame, a view of frame.people['midpoint'],
+                set by the detection stage
+        track_ids: track id of each point when tracking is on, else None
+        slot: shmring.Slot holding img, None if the image isn't in a FrameRing
+    '''
+    def __init__(self, device, timestamp, img, slot=None):
+        self.device = device
+        self.timestamp = timestamp
+        self.img = img
+        self.frame = None
+        self.points = []
+        self.track_ids = None
+        self.slot = slot
+
+    def release(self):
+        '''
+        Gives the frame slot back to the ring, the packet's image must not be used after this
+        '''
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+        return None
+
+
+class StereoPair:
+    '''
+    Left and right packets captured at (nearly) the same time, with the triangulated ranges.
+
+    fields:
+        left, right: Packet from each camera
+        ranges: (K, 4) ndarray of (x, y, z, distance) for matched people
+        pairs: (K, 2) ndarray of (left index, right index) into the packets' points
+        tracks: (K,) smoothing.TRACK_DTYPE ndarray of the smoothed position and velocity of every range,
+                None if smoothing is off
+    '''
+    def __init__(self, left, right, ranges, pairs, tracks=None):
+        self.left = left
+        self.right = right
+        self.ranges = ranges
+        self.pairs = pairs
+        self.tracks = tracks
+
+    def release(self):
+        self.left.release()
+        self.right.release()
+        return None
+
+
+class StereoPipeline:
+    '''
+    Capture -> detection -> stereo pairing stages, each on its own thread and joined by RingBuffers.
+
+    Every camera gets its own capture.CaptureReader grabbing continuously and its own detection thread,
+    so a slow detection never holds up the other camera. The capture stage asks both readers for the
+    newest frame once detection is ready for it, frames grabbed in between are dropped undecoded.
+    The pairing stage matches frames from both cameras by capture timestamp, frames that find no
+    partner within the tolerance are dropped and counted.
+    Rendering is left to the caller, which takes finished pairs from the paired buffer,
+    so drawing can stay on the main thread.
+
+    fields:
+        devices: (left, right) device numbers
+        tolerance: largest capture time difference (seconds) of a left/right pair
+        captured: dict device -> RingBuffer of captured Packets
+        detected: RingBuffer of Packets with detections, from both cameras
+        paired: RingBuffer of StereoPairs ready to be rendered
+        failed_reads: number of frames a camera failed to deliver, or didn't deliver within read_timeout
+        failed_detections: number of frames dropped because a detection worker raised on them
+        unpaired: number of frames dropped because no partner frame was close enough in time
+        backend: optional workers.ProcessDetector, detection runs in the camera's detection thread if None
+        ring: optional shmring.FrameRing, frames are captured straight into its slots instead of new arrays
+        rectifier: optional calibration.Rectifier, frames are rectified as they are captured. The matcher
+                   has to be a stereo.RectifiedMatcher then.
+        ring_exhausted: number of frames skipped because every ring slot was in use
+        gates: dict device -> MotionGate when motion gating is on, only used by in-thread detection
+        trackers: dict device -> PersonTracker when tracking is on, only used by in-thread detection.
+                  Left/right pairs of track ids matched on one frame are kept on the next.
+        priors: dict device -> depth.DepthPrior when depth aware detection is on, only used by in-thread
+                detection. The cascade only searches the face sizes people can have in each part of the
+                frame, the ranges located on a pair are fed back to both cameras' priors.
+        detector: detector used by in-thread detection, eg. a fusion.FusedDetector. The face cascade if None
+        metrics: optional metrics.Metrics, every stage reports how long it took and stats() is
+                 added as a collector
+        smoother: optional smoothing.TrackSmoother, the matches of every pair are smoothed over the last
+                  frames. People are keyed by their left and right track ids when tracking is on.
+        synced: grab both cameras back to back, see capture.CaptureReader
+        read_timeout: seconds the capture stage waits for a frame before it gives up on it and asks again.
+                      four frame periods (8 * tolerance, tolerance being half a frame) if None
+        readers: dict device -> capture.CaptureReader grabbing the camera, set by start()
+    '''
+    def __init__(self, captures, devices, matcher, tolerance, capacity=4, policy=RingBuffer.DROP_OLDEST,
+                 backend=None, ring=None, motion=False, detect_every=None, rectifier=None, metrics=None,
+                 priors=None, detector=None, smoother=None, synced=True, read_timeout=None):
+        self.captures = captures
+        self.devices = devices
+        self.matcher = matcher
+        self.tolerance = tolerance
+        self.capacity = capacity
+        self.backend = backend
+        self.ring = ring
+        self.rectifier = rectifier
+        release = lambda item: item.release()
+        self.captured = {device: RingBuffer(capacity, policy, release) for device in devices}
+        self.detected = RingBuffer(capacity * len(devices), policy, release)
+        self.paired = RingBuffer(capacity, policy, release)
+        self.failed_reads = 0
+        self.failed_detections = 0
+        self.unpaired = 0
+        self.ring_exhausted = 0
+        self.gates = {device: MotionGate() for device in devices} if motion else {}
+        self.trackers = {device: PersonTracker(detect_every) for device in devices} if detect_every else {}
+        # left track id -> right track id of the last matched pair
+        self._track_pairs = {}
+        self.priors = priors or {}
+        self.detector = detector
+        self.smoother = smoother
+        self.synced = synced
+        self.read_timeout = read_timeout if read_timeout is not None else 8 * tolerance
+        self.readers = {}
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.add_collector(self.stats)
+        self.stopped = threading.Event()
+        self._threads = []
+
+    @property
+    def dropped_frames(self):
+        '''
+        Frames that never made it to rendering, dropped by a full buffer or left without a partner
+        '''
+        buffers = list(self.captured.values()) + [self.detected, self.paired]
+        return sum(buffer.dropped for buffer in buffers) + self.unpaired
+
+    def start(self):
+        '''
+        Starts all the stage threads
+
+        :returns None
+        '''
+        self.readers = dict(zip(self.devices, open_readers(self.captures, self.devices, self.synced)))
+        # one capture thread asks both cameras for a frame at the same moment, so the frames pair up
+        self._spawn(self._capture)
+        for device in self.devices:
+            self._spawn(self._detect if self.backend is None else self._detect_pooled, device)
+        self._spawn(self._pair)
+        return None
+
+    def stop(self):
+        '''
+        Signals every stage to finish and wakes up anything waiting on a buffer
+
+        :returns None
+        '''
+        self.stopped.set()
+        for reader in self.readers.values():
+            reader.stop()
+        for buffer in list(self.captured.values()) + [self.detected, self.paired]:
+            buffer.close()
+        return None
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+        for reader in self.readers.values():
+            reader.join(timeout)
+        return None
+
+    def stats(self):
+        '''
+        :returns dict of counters and current buffer depths
+        '''
+        stats = {'dropped_frames': self.dropped_frames, 'unpaired': self.unpaired,
+                 'failed_reads': self.failed_reads, 'failed_detections': self.failed_detections,
+                 'ring_exhausted': self.ring_exhausted,
+                 'detected_depth': len(self.detected), 'paired_depth': len(self.paired)}
+        if self.ring is not None:
+            stats['ring_in_use'] = self.ring.in_use()
+        for device, counter in list(self.gates.items()) + list(self.trackers.items()):
+            for path, count in counter.paths.items():
+                stats['{}_frames_{}'.format(path, device)] = count
+        for device, buffer in self.captured.items():
+            stats['captured_depth_{}'.format(device)] = len(buffer)
+        for device, reader in self.readers.items():
+            stats['grabbed_{}'.format(device)] = reader.grabbed
+            stats['skipped_{}'.format(device)] = reader.skipped
+        return stats
+
+    def _spawn(self, target, *args):
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _capture(self):
+        devices = self.devices
+        # raw frames are read into these and rectified into the slots, remap can't work in place
+        raw = {device: None for device in devices}
+        readers = [self.readers[device] for device in devices]
+        while not self.stopped.is_set():
+            # only ask for frames once detection took the last ones, frames grabbed meanwhile are
+            # dropped by the readers without being decoded, so detection never starts on a stale frame
+            if not all(self.captured[device].wait_empty(0.1) for device in devices):
+                continue
+            slots = [None] * len(devices)
+            if self.ring is not None:
+                slots = [self.ring.acquire(timeout=0.1) for device in devices]
+                if any(slot is None for slot in slots):
+                    # everything downstream is still holding frames, the readers drop what they grab meanwhile
+                    self.ring_exhausted += 1
+                    for slot in slots:
+                        if slot is not None:
+                            slot.release()
+                    continue
+            began = time.perf_counter()
+            # the newest frames, grabbed after we asked
+            dsts = [raw[device] if self.rectifier is not None else (slot.img if slot is not None else None)
+                    for device, slot in zip(devices, slots)]
+            results = read_together(readers, dsts, self.read_timeout)
+            if self.stopped.is_set() or not all(ret for ret, _, _ in results):
+                for slot in slots:
+                    if slot is not None:
+                        slot.release()
+                if self.stopped.is_set():
+                    break
+                if not any(reader.failed for reader in readers):
+                    # a camera stalled without failing, the readers drop the late frame, ask again
+                    self.failed_reads += 1
+                    continue
+                # failed to read frame
+                self.failed_reads += 1
+                print("Couldn't read frame.")
+                self.stop()
+                return None
+
+            for device, slot, (_, timestamp, img) in zip(devices, slots, results):
+                if self.rectifier is not None:
+                    raw[device] = img
+                    img = self.rectifier.remap(device, img, slot.img if slot is not None else None)
+                # the camera doesn't deliver frames of the slot's size, resize into the slot instead
+                if slot is not None and img is not slot.img:
+                    cv2.resize(img, (slot.img.shape[1], slot.img.shape[0]), dst=slot.img)
+                    img = slot.img
+                if self.metrics is not None:
+                    self.metrics.observe('capture', time.perf_counter() - began, device)
+                    self.metrics.frame(device)
+                self.captured[device].put(Packet(device, timestamp, img, slot))
+        return None
+
+    def _detect(self, device):
+        source = self.captured[device]
+        gate = self.gates.get(device)
+        tracker = self.trackers.get(device)
+        prior = self.priors.get(device)
+        while not self.stopped.is_set():
+            began = time.perf_counter()
+            packet = source.get()
+            if packet is None:
+                continue
+            waited = time.perf_counter()
+            packet.frame = Frame(packet.img)
+            packet.points = packet.frame.detect_people(self.detector, gate, tracker, prior)
+            if tracker is not None:
+                packet.track_ids = packet.frame.people['track_id']
+            if self.metrics is not None:
+                self.metrics.observe('detect_wait', waited - began, device)
+                self.metrics.observe('detect', time.perf_counter() - waited, device)
+            self.detected.put(packet)
+        return None
+
+    def _detect_pooled(self, device):
+        source = self.captured[device]
+        # frames sent to the workers, oldest first. results are taken in this order so frames
+        # from one camera leave the stage in capture order even if workers finish out of order
+        in_flight = deque()
+        while not self.stopped.is_set():
+            packet = source.get(timeout=0.005 if in_flight else None)
+            if packet is not None:
+                packet.frame = Frame(packet.img)
+                in_flight.append((packet, self.backend.submit(packet.frame.img_data, packet.slot),
+                                  time.perf_counter()))
+            while in_flight and (in_flight[0][1].ready() or len(in_flight) >= self.backend.max_in_flight):
+                done, result, submitted = in_flight.popleft()
+                try:
+                    people = result.get()
+                except Exception as error:
+                    # drop the frame and keep going, the other camera's frames just go unpaired
+                    print("Detection failed on a frame of camera {}: {!r}".format(device, error))
+                    self.failed_detections += 1
+                    done.release()
+                    continue
+                done.points = done.frame.add_records(people)
+                if self.metrics is not None:
+                    # includes the time the frame waited for a free worker
+                    self.metrics.observe('detect', time.perf_counter() - submitted, device)
+                self.detected.put(done)
+        return None
+
+    def _pair(self):
+        left_device, right_device = self.devices
+        pending = {device: deque() for device in self.devices}
+        while not self.stopped.is_set():
+            packet = self.detected.get()
+            if packet is None:
+                continue
+            waiting = pending[packet.device]
+            waiting.append(packet)
+            # the other camera may have stalled, don't hold on to more frames than a buffer would
+            if len(waiting) > self.capacity:
+                waiting.popleft().release()
+                self.unpaired += 1
+
+            left, right = pending[left_device], pending[right_device]
+            while left and right:
+                difference = left[0].timestamp - right[0].timestamp
+                if abs(difference) <= self.tolerance:
+                    began = time.perf_counter()
+                    pair = self._locate(left.popleft(), right.popleft())
+                    if self.metrics is not None:
+                        self.metrics.observe('locate', time.perf_counter() - began)
+                    self.paired.put(pair)
+                # the older frame can't be paired with anything newer, drop it
+                elif difference < 0:
+                    left.popleft().release()
+                    self.unpaired += 1
+                else:
+                    right.popleft().release()
+                    self.unpaired += 1
+        return None
+
+    def _locate(self, left, right):
+        if left.track_ids is None or right.track_ids is None:
+            ranges, pairs = self.matcher.locate(left.points, right.points)
+        else:
+            # reuse the matches of the previous pair for people still tracked on both cameras
+            right_index = {track_id: j for j, track_id in enumerate(right.track_ids)}
+            known = [(i, right_index[self._track_pairs[track_id]]) for i, track_id in enumerate(left.track_ids)
+                     if self._track_pairs.get(track_id) in right_index]
+            ranges, pairs = self.matcher.locate(left.points, right.points, known)
+            self._track_pairs = {left.track_ids[i]: right.track_ids[j] for i, j in pairs}
+
+        for column, packet in enumerate((left, right)):
+            prior = self.priors.get(packet.device)
+            if prior is not None:
+                prior.observe(packet.points[pairs[:, column]], ranges[:, 3])
+
+        tracks = None
+        if self.smoother is not None:
+            keys = None
+            if left.track_ids is not None and right.track_ids is not None:
+                keys = [(left.track_ids[i], right.track_ids[j]) for i, j in pairs]
+            tracks = self.smoother.update(left.timestamp, left.points[pairs[:, 0]], right.points[pairs[:, 1]], keys,
+                                          ranges[:, :3])
+        return StereoPair(left, right, ranges, pairs, tracks)
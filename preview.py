@@ -0,0 +1,53 @@
+
+import time
+
+import cv2
+
+
+class PreviewSink:
+    '''
+    Displays stereo pairs in HighGUI windows at a lower rate than they are analysed.
+
+    Only pairs that are actually shown get drawn on, the rest go through untouched.
+    Windows have to be driven from one thread, so submit and poll belong on the main thread.
+
+    fields:
+        fps: most pairs shown per second
+        windows: names of the (left, right) windows
+        shown: number of pairs displayed
+    '''
+    def __init__(self, fps=5, windows=("left", "right")):
+        self.fps = fps
+        self.windows = windows
+        self.shown = 0
+        self._last = None
+
+    def submit(self, pair):
+        '''
+        Renders and shows the pair if it's time for the next preview frame
+
+        :param pair: StereoPair from the pipeline, analysed already
+
+        :returns True if the pair was shown
+        '''
+        now = time.monotonic()
+        if self._last is not None and now - self._last < 1.0 / self.fps:
+            return False
+        self._last = now
+        for packet, window in zip((pair.left, pair.right), self.windows):
+            packet.frame.render()
+            packet.frame.show(window)
+        self.shown += 1
+        return True
+
+    def poll(self):
+        '''
+        Lets HighGUI process window events
+
+        :returns True if 'q' was pressed
+        '''
+        return cv2.waitKey(1) & 0xFF == ord('q')
+
+    def close(self):
+        cv2.destroyAllWindows()
+        return None
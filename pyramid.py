@@ -0,0 +1,115 @@
+
+import cv2
+import numpy as np
+
+
+class ImagePyramid:
+    '''
+    Grayscale copies of one frame at the scales detection asks for, each made at most once.
+
+    fields:
+        img: the full resolution BGR frame
+        equalize: equalize the histogram of the grayscale copy, every level is made from the equalized one
+    '''
+    def __init__(self, img, equalize=False):
+        self.img = img
+        self.equalize = equalize
+        self._gray = None
+        self._levels = {}
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY) if self.img.ndim == 3 else self.img
+            if self.equalize:
+                self._gray = cv2.equalizeHist(self._gray)
+        return self._gray
+
+    def level(self, scale):
+        '''
+        :param scale: size of the level relative to the frame, 1 is the full resolution
+
+        :returns grayscale frame resized by scale
+        '''
+        if scale == 1:
+            return self.gray
+        level = self._levels.get(scale)
+        if level is None:
+            level = self._levels[scale] = cv2.resize(self.gray, None, fx=scale, fy=scale,
+                                                     interpolation=cv2.INTER_AREA)
+        return level
+
+    def region_of(self, img):
+        '''
+        :param img: an image that may be a crop (slice) of the frame
+
+        :returns (x, y, w, h) of img in the frame, or None if it isn't a view of the frame
+        '''
+        if img is self.img:
+            return 0, 0, img.shape[1], img.shape[0]
+        if not isinstance(img, np.ndarray) or img.strides != self.img.strides or \
+                not np.shares_memory(img, self.img):
+            return None
+        offset = img.__array_interface__['data'][0] - self.img.__array_interface__['data'][0]
+        y, rest = divmod(offset, self.img.strides[0])
+        return rest // self.img.strides[1], y, img.shape[1], img.shape[0]
+
+    def detect(self, detector, scale=1.0, region=None, min_size=None, max_size=None):
+        '''
+        Runs a detector on a level of the pyramid and maps the boxes back to the full resolution
+
+        :param detector: Detector borrowed from the DetectorRegistry
+        :param scale: level to detect on
+        :param region: optional (x, y, w, h) part of the frame to search, in full resolution pixels
+        :param min_size, max_size: optional (w, h) box size limits in full resolution pixels,
+                                   the detector spec's min_size if None
+
+        :returns (N, 4) int ndarray of (x, y, w, h) boxes in full resolution pixels
+        '''
+        level = self.level(scale)
+        x0 = y0 = 0
+        if region is not None:
+            x, y, w, h = region
+            x0, y0 = int(x * scale), int(y * scale)
+            level = level[y0:int((y + h) * scale), x0:int((x + w) * scale)]
+
+        # the spec's sizes are in full resolution pixels, but the cascade can't go below its own window
+        window = detector.window
+        min_size = min_size or detector.spec.min_size
+        level_min = (max(int(min_size[0] * scale), window[0]), max(int(min_size[1] * scale), window[1]))
+        level_max = None
+        if max_size is not None:
+            level_max = (int(np.ceil(max_size[0] * scale)), int(np.ceil(max_size[1] * scale)))
+            if level_max[0] < level_min[0] or level_max[1] < level_min[1]:
+                return np.empty((0, 4), dtype=int)
+        if level.shape[0] < level_min[1] or level.shape[1] < level_min[0]:
+            return np.empty((0, 4), dtype=int)
+
+        boxes = np.asarray(detector.detect(level, level_min, level_max), dtype=float).reshape(-1, 4)
+        boxes[:, :2] += (x0, y0)
+        return np.rint(boxes / scale).astype(int)
+
+
+class PyramidDetector:
+    '''
+    Has the same detect() as a Detector, but searches a downscaled grayscale copy from the frame's
+    ImagePyramid. Images that are crops of the frame (eg. MotionGate regions) are cut from the
+    cached level instead of being converted again. Boxes come back in full resolution pixels.
+    '''
+    def __init__(self, pyramid, detector, scale=1.0):
+        self.pyramid = pyramid
+        self.detector = detector
+        self.scale = scale
+        self.name = detector.name
+        self.spec = detector.spec
+
+    def detect(self, img, min_size=None, max_size=None):
+        region = self.pyramid.region_of(img)
+        if region is None:
+            # not part of this frame, give it a pyramid of its own
+            pyramid = ImagePyramid(img, self.pyramid.equalize)
+            return pyramid.detect(self.detector, self.scale, None, min_size, max_size)
+        boxes = self.pyramid.detect(self.detector, self.scale, region, min_size, max_size)
+        # callers expect boxes relative to the image they passed in
+        boxes[:, :2] -= region[:2]
+        return boxes
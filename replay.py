@@ -0,0 +1,223 @@
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from calibration import load_calibration, Rectifier
+from detectors import get_registry
+from frame import Frame
+from stereo import StereoMatcher, RectifiedMatcher
+from tp17storage import TP17Storage
+
+# device numbers the left and right recording are stored under, same as the live cameras
+DEVICES = (0, 1)
+# frame rate assumed for image sequences and videos that don't report one
+FPS = 15
+# size of a chessboard square used in calibration, in meters, see distances.py
+SQUARE_SIZE = 0.0025
+
+
+def frame_count(path):
+    '''
+    :param path: video file, or image sequence pattern like 'left/%04d.png'
+
+    :returns number of frames in the recording
+    '''
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError("Couldn't open recording '{}'".format(path))
+    count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return count
+
+
+def shard_ranges(count, shards):
+    '''
+    Splits frames [0, count) into contiguous, nearly equal time ranges
+
+    :returns list of (first, last) frame index ranges, last not included
+    '''
+    edges = np.linspace(0, count, shards + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+class Replay:
+    '''
+    Runs the detection, stereo matching and storage stages over a recorded pair of videos
+    or image sequences, as fast as the frames can be processed and without any display.
+
+    Frames are taken in lockstep from both recordings, so nothing is dropped or left unpaired
+    and the results only depend on the recording. Frame times are the recording's start time
+    plus the frame's position, not the time it was processed.
+
+    fields:
+        left, right: paths of the left and right recording, anything cv2.VideoCapture opens
+        start_time: datetime the recording started at. by default the left recording's modification time,
+                    which is when it stopped being written, less the recording's length
+        fps: frame rate of the recording
+        cascade: detector used, see detectors.CASCADES
+        rectified: rectify frames before detection and match along rows, see calibration.Rectifier
+    '''
+    def __init__(self, left, right, start_time=None, fps=None, cascade='face', rectified=False,
+                 calibration_dir='.', square_size=SQUARE_SIZE):
+        self.left = left
+        self.right = right
+        self.fps = fps or self._recorded_fps() or FPS
+        if start_time is None:
+            # image sequence patterns aren't files, take them as just recorded
+            end = os.path.getmtime(left) if os.path.exists(left) else time.time()
+            start_time = datetime.fromtimestamp(end - frame_count(left) / self.fps)
+        self.start_time = start_time
+        self.cascade = cascade
+        self.rectified = rectified
+        self.calibration_dir = calibration_dir
+        self.square_size = square_size
+
+    def run(self, first=0, last=None, storage=None):
+        '''
+        Processes frames [first, last) of both recordings
+
+        :param first: index of the first frame
+        :param last: index after the last frame, the end of the shorter recording if None
+        :param storage: TP17Storage the section counts and movements go to, nothing is stored if None
+
+        :returns dict of counters - frames, people, ranges and seconds spent
+        '''
+        calibration = load_calibration(self.calibration_dir, DEVICES)
+        if self.rectified:
+            rectifier = Rectifier(calibration, DEVICES)
+            matcher = RectifiedMatcher(calibration.Q, self.square_size)
+        else:
+            rectifier = None
+            matcher = StereoMatcher(calibration.F, calibration.P1, calibration.P2, self.square_size)
+        detector = get_registry().borrow(self.cascade)
+
+        captures = [cv2.VideoCapture(path) for path in (self.left, self.right)]
+        stats = {'frames': 0, 'people': 0, 'ranges': 0}
+        began = time.monotonic()
+        try:
+            # start a frame early so the first stored movements are relative to the frame before the
+            # range and not to an empty room, that frame is only counted
+            warmup = 1 if first > 0 else 0
+            for cap in captures:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, first - warmup)
+            prev_counts = {device: [0] * (Frame.SPLIT_DIV ** 2) for device in DEVICES}
+
+            index = first - warmup
+            while last is None or index < last:
+                images = []
+                for cap, device in zip(captures, DEVICES):
+                    ret, img = cap.read()
+                    if not ret:
+                        break
+                    images.append(rectifier.remap(device, img) if rectifier is not None else img)
+                # one of the recordings ended
+                if len(images) < 2:
+                    break
+
+                timestamp = self.start_time.timestamp() + index / self.fps
+                frames = [Frame(img) for img in images]
+                points = [frame.detect_people(detector) for frame in frames]
+                ranges, pairs = matcher.locate(points[0], points[1])
+                for column, (frame, device) in enumerate(zip(frames, DEVICES)):
+                    frame.time_now = datetime.fromtimestamp(timestamp)
+                    frame.add_distances(pairs[:, column], ranges)
+                    frame.update_movements(prev_counts[device])
+                    if index >= first:
+                        if storage is not None:
+                            storage.add_row(timestamp, device, frame.counts, frame.movements)
+                        stats['people'] += len(frame.people)
+                if index >= first:
+                    stats['frames'] += 1
+                    stats['ranges'] += len(ranges)
+                index += 1
+        finally:
+            for cap in captures:
+                cap.release()
+        stats['seconds'] = time.monotonic() - began
+        return stats
+
+    def run_sharded(self, storage, processes=None):
+        '''
+        Splits the recording into one time range per process, replays the ranges in parallel
+        and merges what they stored into one storage, in time order
+
+        :param storage: TP17Storage the merged results go to
+        :param processes: number of worker processes, one per core if None
+
+        :returns dict of counters summed over the shards, seconds is the wall clock time
+        '''
+        processes = processes or mp.cpu_count()
+        ranges = shard_ranges(min(frame_count(self.left), frame_count(self.right)), processes)
+        # every shard writes its own storage, so the workers never share files
+        directories = [os.path.join(storage.directory, 'shard_{:03d}'.format(k)) for k in range(len(ranges))]
+        began = time.monotonic()
+        with mp.Pool(len(ranges)) as pool:
+            results = pool.starmap(_run_shard, [(self, first, last, directory)
+                                                for (first, last), directory in zip(ranges, directories)])
+
+        stats = {name: sum(result[name] for result in results) for name in ('frames', 'people', 'ranges')}
+        for directory in directories:
+            for columns in TP17Storage(directory).scan():
+                for row in zip(*columns):
+                    storage.add_row(*row)
+            shutil.rmtree(directory)
+        storage.save()
+        stats['seconds'] = time.monotonic() - began
+        return stats
+
+    def _recorded_fps(self):
+        cap = cv2.VideoCapture(self.left)
+        fps = cap.get(cv2.CAP_PROP_FPS) if cap.isOpened() else 0
+        cap.release()
+        return fps if fps > 0 else None
+
+
+def _run_shard(replay, first, last, directory):
+    """
+    Runs in a worker process, replays one time range into its own storage
+
+    :returns the counters from Replay.run
+    """
+    storage = TP17Storage(directory)
+    stats = replay.run(first, last, storage)
+    storage.save()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded stereo pair through detection, "
+                                                 "stereo matching and storage")
+    parser.add_argument('left', help="left video file or image sequence pattern, eg. left/%%04d.png")
+    parser.add_argument('right', help="right video file or image sequence pattern")
+    parser.add_argument('--storage', default='tp17db_replay', help="storage directory the results go to")
+    parser.add_argument('--processes', type=int, default=1, help="shard the recording over this many processes")
+    parser.add_argument('--fps', type=float, help="frame rate of the recording, read from the video if not set")
+    parser.add_argument('--start', help="time the recording started, eg. 2019-05-01T10:00:00. modification "
+                                        "time of the left recording less its length if not set")
+    parser.add_argument('--cascade', default='face')
+    parser.add_argument('--rectified', action='store_true')
+    args = parser.parse_args()
+
+    start = datetime.fromisoformat(args.start) if args.start else None
+    replay = Replay(args.left, args.right, start, args.fps, args.cascade, args.rectified)
+    storage = TP17Storage(args.storage)
+    if args.processes > 1:
+        stats = replay.run_sharded(storage, args.processes)
+    else:
+        stats = replay.run(storage=storage)
+        storage.save()
+    for name, value in stats.items():
+        print("{}: {}".format(name, value))
+    rate = stats['frames'] / max(stats['seconds'], 1e-9)
+    print("{:.1f} frames per second, {:.1f}x real time".format(rate, rate / replay.fps))
+
+
+if __name__ == '__main__':
+    main()
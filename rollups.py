@@ -0,0 +1,307 @@
+
+import math
+import os
+
+import numpy as np
+
+# bucket widths kept up to date, in seconds
+GRANULARITIES = (1, 60, 3600)
+# how long buckets of each width are kept, in seconds. None keeps them forever
+RETENTION = {1: 2 * 86400, 60: None, 3600: None}
+
+
+class _Bucket:
+    def __init__(self, start, sections):
+        self.start = start
+        self.frames = 0
+        self.count_sum = np.zeros(sections, dtype=np.float64)
+        self.count_max = np.zeros(sections, dtype=np.int32)
+        self.ins = np.zeros(sections, dtype=np.int32)
+        self.outs = np.zeros(sections, dtype=np.int32)
+
+
+class Rollup:
+    '''
+    Per-camera aggregates of section counts and movements over fixed width time buckets.
+
+    Each bucket holds the number of frames, the sum and maximum of every section's count and
+    the people that went in and out of every section. Buckets being filled are kept apart,
+    a bucket is moved into the column arrays once a frame from the next bucket shows up.
+
+    fields:
+        seconds: width of a bucket
+        sections: number of sections per frame
+        retention: seconds of buckets kept, None keeps everything
+    '''
+    def __init__(self, seconds, sections, retention=None, capacity=1024):
+        self.seconds = seconds
+        self.sections = sections
+        self.retention = retention
+        self.columns = self._allocate(capacity)
+        self.rows = 0
+        self._open = {}
+        self._prefix = 'rollup_{}'.format(seconds)
+        # closed rows already in a part file, they are the first ones
+        self._saved = 0
+        self._parts = []
+        self._next_part = 0
+
+    def add(self, time, camera, counts, movements, rig=0):
+        '''
+        Adds one frame
+
+        :param time: seconds since the epoch
+        :param camera: device number
+        :param counts: people count of every section
+        :param movements: signed change of every section's count since the camera's previous frame
+        :param rig: id of the stereo rig the camera belongs to
+
+        :returns None
+        '''
+        start = math.floor(time / self.seconds) * self.seconds
+        key = (rig, camera)
+        bucket = self._open.get(key)
+        if bucket is None or start > bucket.start:
+            if bucket is not None:
+                self._close(key, bucket)
+            bucket = self._open[key] = _Bucket(start, self.sections)
+        counts = np.asarray(counts[:self.sections])
+        movements = np.asarray(movements[:self.sections])
+        bucket.frames += 1
+        bucket.count_sum += counts
+        np.maximum(bucket.count_max, counts, out=bucket.count_max)
+        bucket.ins += np.clip(movements, 0, None)
+        bucket.outs -= np.clip(movements, None, 0)
+        return None
+
+    def buckets(self, start=None, end=None, camera=None, rig=None):
+        '''
+        Buckets that start within [start, end), closed and still open ones
+
+        :returns dict column name -> ndarray, see _allocate for the columns
+        '''
+        columns = {name: column[:self.rows] for name, column in self.columns.items()}
+        if self._open:
+            opened = self._rows_of(self._open)
+            columns = {name: np.concatenate((columns[name], opened[name])) for name in columns}
+        keep = np.ones(len(columns['start']), dtype=bool)
+        if start is not None:
+            keep &= columns['start'] >= start
+        if end is not None:
+            keep &= columns['start'] < end
+        if camera is not None:
+            keep &= columns['camera'] == camera
+        if rig is not None:
+            keep &= columns['rig'] == rig
+        return {name: column[keep] for name, column in columns.items()}
+
+    def save(self, directory):
+        '''
+        Appends the buckets closed since the last save as a new part file and rewrites the small
+        file of open buckets, open ones are merged back in by query(). Closed buckets are written
+        once, so a save costs the same however much history is kept. Parts that only hold buckets
+        older than the retention are deleted.
+
+        :returns None
+        '''
+        if self.rows > self._saved:
+            closed = {name: column[self._saved:self.rows] for name, column in self.columns.items()}
+            # sequence number and start of the latest bucket in the part, in seconds
+            name = '{}_{:08d}_{}.npz'.format(self._prefix, self._next_part, int(closed['start'].max()))
+            _write(os.path.join(directory, name), closed)
+            self._parts.append(name)
+            self._next_part += 1
+            self._saved = self.rows
+        # a crash between writing a part and this leaves open buckets that are in the part already,
+        # the number of the part they follow tells load() to skip them
+        _write(os.path.join(directory, self._prefix + '_open.npz'),
+               dict(self._rows_of(self._open), part=self._next_part - 1))
+
+        if self.retention is not None and self.rows > 0:
+            oldest = self.columns['start'][:self.rows].max() - self.retention
+            # the newest part is kept whatever it holds, its number is what the open buckets follow
+            expired = [name for name in self._parts[:-1] if _part_latest(name) < oldest]
+            for name in expired:
+                os.remove(os.path.join(directory, name))
+            self._parts = [name for name in self._parts if name not in expired]
+        return None
+
+    def load(self, directory):
+        '''
+        Adds the buckets saved in a directory as closed buckets, skipping parts older than the retention
+
+        :returns None
+        '''
+        opened = self._prefix + '_open.npz'
+        self._parts = sorted(name for name in os.listdir(directory)
+                             if name.startswith(self._prefix + '_') and name.endswith('.npz') and name != opened)
+        parts = self._parts
+        if parts and self.retention is not None:
+            newest = max(_part_latest(name) for name in parts)
+            parts = [name for name in parts if _part_latest(name) >= newest - self.retention]
+        for name in parts:
+            self._load(os.path.join(directory, name))
+        self._saved = self.rows
+        if self.retention is not None and self.rows > 0:
+            # a part can straddle the retention, its older buckets go too
+            self._expire()
+        last = int(self._parts[-1].split('_')[2]) if self._parts else -1
+        self._next_part = last + 1
+
+        # buckets still open at the last save, they aren't in a part yet so they go into the next one
+        path = os.path.join(directory, opened)
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                follows = int(saved['part'])
+            if follows == last:
+                self._load(path)
+        return None
+
+    def _load(self, path):
+        with np.load(path) as saved:
+            saved = {name: saved[name] for name in self.columns}
+        n = len(saved['start'])
+        if self.rows + n > len(self.columns['start']):
+            self._make_room(n)
+        for name, column in self.columns.items():
+            column[self.rows:self.rows + n] = saved[name]
+        self.rows += n
+        return None
+
+    def _close(self, key, bucket):
+        self._append(self._rows_of({key: bucket}, single=True))
+        return None
+
+    def _append(self, row):
+        if self.rows == len(self.columns['start']):
+            self._make_room()
+        for name, column in self.columns.items():
+            column[self.rows] = row[name]
+        self.rows += 1
+        return None
+
+    def _make_room(self, needed=1):
+        capacity = len(self.columns['start'])
+        if self.retention is not None and self.rows > 0:
+            self._expire()
+            # only grow if dropping old buckets didn't free at least a quarter
+            if self.rows + needed <= 0.75 * capacity:
+                return None
+        grown = self._allocate(max(2 * capacity, self.rows + needed))
+        for name, column in self.columns.items():
+            grown[name][:self.rows] = column[:self.rows]
+        self.columns = grown
+        return None
+
+    def _expire(self):
+        # drops the closed buckets older than the retention, counted back from the newest one
+        n = self.rows
+        keep = self.columns['start'][:n] >= self.columns['start'][:n].max() - self.retention
+        kept = int(keep.sum())
+        for column in self.columns.values():
+            column[:kept] = column[:n][keep]
+        self.rows = kept
+        # dropping keeps the order, the saved rows that are left are still the first ones
+        self._saved = int(keep[:self._saved].sum())
+        return None
+
+    def _allocate(self, capacity):
+        return {'start': np.empty(capacity, dtype=np.float64),
+                'rig': np.empty(capacity, dtype=np.int16),
+                'camera': np.empty(capacity, dtype=np.int16),
+                'frames': np.empty(capacity, dtype=np.int32),
+                'count_sum': np.empty((capacity, self.sections), dtype=np.float64),
+                'count_max': np.empty((capacity, self.sections), dtype=np.int32),
+                'ins': np.empty((capacity, self.sections), dtype=np.int32),
+                'outs': np.empty((capacity, self.sections), dtype=np.int32)}
+
+    def _rows_of(self, buckets, single=False):
+        keys = sorted(buckets)
+        rows = {'start': np.array([buckets[k].start for k in keys], dtype=np.float64),
+                'rig': np.array([rig for rig, _ in keys], dtype=np.int16),
+                'camera': np.array([camera for _, camera in keys], dtype=np.int16),
+                'frames': np.array([buckets[k].frames for k in keys], dtype=np.int32)}
+        for name in ('count_sum', 'count_max', 'ins', 'outs'):
+            rows[name] = np.array([getattr(buckets[k], name) for k in keys]).reshape(-1, self.sections)
+        if single:
+            return {name: column[0] for name, column in rows.items()}
+        return rows
+
+
+class RollupIndex:
+    '''
+    Keeps Rollups at 1 s, 1 min and 1 h granularity so range queries read buckets instead of raw frames.
+
+    fields:
+        rollups: dict bucket width in seconds -> Rollup
+    '''
+    def __init__(self, sections, granularities=GRANULARITIES, retention=RETENTION):
+        self.rollups = {seconds: Rollup(seconds, sections, retention.get(seconds)) for seconds in granularities}
+
+    def add(self, time, camera, counts, movements, rig=0):
+        '''
+        Adds one frame to every granularity, see Rollup.add
+
+        :returns None
+        '''
+        for rollup in self.rollups.values():
+            rollup.add(time, camera, counts, movements, rig)
+        return None
+
+    def query(self, seconds, start=None, end=None, camera=None, rig=None):
+        '''
+        Aggregates over buckets of any width that is a multiple of a kept granularity,
+        eg. 300 s buckets are built from the 60 s ones
+
+        :param seconds: width of the returned buckets
+        :param start: only buckets starting at or after this time (seconds since the epoch)
+        :param end: only buckets starting before this time
+        :param camera: only this camera, all cameras if None
+        :param rig: only this rig, all rigs if None
+
+        :returns dict column name -> ndarray, sorted by bucket start, rig and camera. columns are
+                 start, rig, camera, frames, mean (average count per section), count_max, ins and outs
+        '''
+        usable = [g for g in self.rollups if seconds % g == 0]
+        if not usable:
+            raise ValueError("{} s isn't a multiple of any of {}".format(seconds, sorted(self.rollups)))
+        buckets = self.rollups[max(usable)].buckets(start, end, camera, rig)
+        if len(buckets['start']) == 0:
+            buckets['mean'] = buckets.pop('count_sum')
+            return buckets
+
+        # group by (bucket start, rig, camera), this also merges buckets split over a save/load
+        keys = np.floor(buckets['start'] / seconds) * seconds
+        order = np.lexsort((buckets['camera'], buckets['rig'], keys))
+        keys, rigs, cameras = keys[order], buckets['rig'][order], buckets['camera'][order]
+        first = np.flatnonzero(np.r_[True, (np.diff(keys) != 0) | (np.diff(rigs) != 0) | (np.diff(cameras) != 0)])
+        result = {'start': keys[first], 'rig': rigs[first], 'camera': cameras[first]}
+        result['frames'] = np.add.reduceat(buckets['frames'][order], first)
+        result['mean'] = np.add.reduceat(buckets['count_sum'][order], first) / result['frames'][:, None]
+        result['count_max'] = np.maximum.reduceat(buckets['count_max'][order], first)
+        result['ins'] = np.add.reduceat(buckets['ins'][order], first)
+        result['outs'] = np.add.reduceat(buckets['outs'][order], first)
+        return result
+
+    def save(self, directory):
+        for rollup in self.rollups.values():
+            rollup.save(directory)
+        return None
+
+    def load(self, directory):
+        for rollup in self.rollups.values():
+            rollup.load(directory)
+        return None
+
+
+def _write(path, columns):
+    # write under a temporary name first so a reader never sees half a file
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(path + '.tmp', path)
+    return None
+
+
+def _part_latest(name):
+    # start of the latest bucket in a part file, from its name
+    return int(name[:-len('.npz')].split('_')[3])
@@ -1,4 +1,7 @@
 
+import numpy as np
+
+
 class Section:
     '''
     Represents a section of the Frame (image).
@@ -17,24 +20,84 @@ class Section:
         self.y = y
         self.height = height
         self.width = width
-        self.people_count = 0
 
-    def count_people(self,person_list):
+
+class SectionGrid:
+    '''
+    Splits a frame into rows x cols sections and counts people per section.
+
+    A grid only depends on the frame geometry, so build it once with SectionGrid.get and share it
+    between frames. Sections are numbered row by row from the top left, the same order
+    as the sections list and the returned counts.
+
+    fields:
+        width, height: size of the frame - pixels
+        rows, cols: number of sections vertically and horizontally
+        x_edges, y_edges: pixel coordinates of the section boundaries, including the frame edges
+        sections: list of Section objects, row by row
+    '''
+    # count a person in the section holding the centre of their box
+    CENTRE = 'centre'
+    # count a person in the section covering the largest part of their box
+    AREA = 'area'
+
+    _grids = {}
+
+    def __init__(self, width, height, rows, cols):
+        self.width = width
+        self.height = height
+        self.rows = rows
+        self.cols = cols
+        self.x_edges = np.arange(cols + 1) * width // cols
+        self.y_edges = np.arange(rows + 1) * height // rows
+        self.sections = [Section(int(x), int(y), int(x1 - x), int(y1 - y))
+                         for y, y1 in zip(self.y_edges[:-1], self.y_edges[1:])
+                         for x, x1 in zip(self.x_edges[:-1], self.x_edges[1:])]
+
+    @classmethod
+    def get(cls, width, height, rows, cols):
+        '''
+        :returns the shared grid for this geometry, built on first use
+        '''
+        key = (width, height, rows, cols)
+        grid = cls._grids.get(key)
+        if grid is None:
+            grid = cls._grids[key] = cls(width, height, rows, cols)
+        return grid
+
+    def count(self, boxes, mode=CENTRE):
+        '''
+        Counts the people in every section in one pass over all boxes
+
+        :param boxes: (N, 4) array like of (x, y, w, h) person boxes
+        :param mode: CENTRE or AREA
+
+        :returns int ndarray of rows * cols counts, row by row
+        '''
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        if mode == self.CENTRE:
+            cells = self.cells_of(boxes[:, 0] + boxes[:, 2] / 2, boxes[:, 1] + boxes[:, 3] / 2)
+        elif mode == self.AREA:
+            cells = self._largest_overlap(boxes)
+        else:
+            raise ValueError("Unknown counting mode '{}'".format(mode))
+        return np.bincount(cells, minlength=self.rows * self.cols)
+
+    def cells_of(self, x, y):
         '''
-        Counts the detected people that fit into this section.
+        :param x, y: arrays of point coordinates
 
-        :param person_list: List of objects of type Person, representing the persons detected in the
-                            whole frame
-        :returns None
+        :returns int ndarray of the section index of each point, points off the frame go to the nearest section
         '''
-        for person in person_list:
-            #area of the person, we want only to count if its more than 50% in this section
-            #problem. what if its split between 4 sections and neither has 50% ? pick largest, have to change implementation
-            #p_area = person.width * person.height
-            #TODO intersects and overlaps, hardest part
-            #then count based on area
-            #basic implementation - if the top left corner fits in
-            if person.x > self.x and person.y > self.y and person.x <= (self.x + self.width) and person.y <= (self.y + self.height):
-                self.people_count += 1
+        col = np.clip(np.searchsorted(self.x_edges, x, side='right') - 1, 0, self.cols - 1)
+        row = np.clip(np.searchsorted(self.y_edges, y, side='right') - 1, 0, self.rows - 1)
+        return row * self.cols + col
 
-        return None
+    def _largest_overlap(self, boxes):
+        x0, y0 = boxes[:, 0, None], boxes[:, 1, None]
+        x1, y1 = x0 + boxes[:, 2, None], y0 + boxes[:, 3, None]
+        # overlap of every box with every column and every row. the area a section covers is the
+        # product of the two, so the largest area is the largest row overlap times the largest column one
+        overlap_x = np.clip(np.minimum(x1, self.x_edges[1:]) - np.maximum(x0, self.x_edges[:-1]), 0, None)
+        overlap_y = np.clip(np.minimum(y1, self.y_edges[1:]) - np.maximum(y0, self.y_edges[:-1]), 0, None)
+        return overlap_y.argmax(axis=1) * self.cols + overlap_x.argmax(axis=1)
@@ -0,0 +1,123 @@
+
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from frame import Frame
+
+
+class Slot:
+    '''
+    One preallocated frame in a FrameRing.
+
+    fields:
+        index: position of the slot in the ring
+        img: ndarray view of the slot's memory, writing to it writes to shared memory
+    '''
+    def __init__(self, ring, index, img):
+        self.ring = ring
+        self.index = index
+        self.img = img
+
+    def retain(self):
+        self.ring.retain(self)
+        return self
+
+    def release(self):
+        self.ring.release(self)
+        return None
+
+
+class FrameRing:
+    '''
+    Fixed number of preallocated frame slots in one shared memory block.
+
+    Producers take a free slot with acquire() and write the frame straight into slot.img, every
+    consumer gets a NumPy view of the same memory, so frames are never copied between stages or
+    pickled for worker processes. A slot keeps a reference count, the producer holds the first
+    reference, each extra consumer calls retain() and everyone calls release() when done.
+    The slot goes back to the free list only when the count drops to zero.
+    Reference counts live in the process that created the ring, worker processes only read slots
+    and their references are taken and dropped by the parent on their behalf.
+
+    fields:
+        count: number of slots
+        shape: shape of a frame in a slot
+        name: name of the shared memory block, workers attach to it with attach()
+    '''
+    def __init__(self, count, shape=(Frame.HEIGHT, Frame.WIDTH, 3)):
+        self.count = count
+        self.shape = tuple(shape)
+        self._shm = shared_memory.SharedMemory(create=True, size=count * int(np.prod(shape)))
+        self.name = self._shm.name
+        self.frames = np.ndarray((count,) + self.shape, dtype=np.uint8, buffer=self._shm.buf)
+        self._slots = [Slot(self, i, self.frames[i]) for i in range(count)]
+        self._refs = [0] * count
+        self._free = list(range(count))
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def attach(name, count, shape):
+        '''
+        Maps an existing ring into this process, used by worker processes
+
+        :returns (SharedMemory, ndarray of all frames) - keep the SharedMemory alive while using the frames
+        '''
+        shm = shared_memory.SharedMemory(name=name)
+        return shm, np.ndarray((count,) + tuple(shape), dtype=np.uint8, buffer=shm.buf)
+
+    def acquire(self, timeout=None):
+        '''
+        Takes a free slot, with one reference held by the caller
+
+        :param timeout: seconds to wait for a slot to be freed, forever if None
+
+        :returns Slot, or None if nothing was freed in time
+        '''
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                return None
+            index = self._free.pop()
+            self._refs[index] = 1
+            return self._slots[index]
+
+    def retain(self, slot):
+        with self._cond:
+            if self._refs[slot.index] == 0:
+                raise ValueError("Slot {} is not in use".format(slot.index))
+            self._refs[slot.index] += 1
+        return None
+
+    def release(self, slot):
+        with self._cond:
+            if self._refs[slot.index] == 0:
+                raise ValueError("Slot {} released more times than it was retained".format(slot.index))
+            self._refs[slot.index] -= 1
+            if self._refs[slot.index] == 0:
+                self._free.append(slot.index)
+                self._cond.notify()
+        return None
+
+    def in_use(self):
+        '''
+        :returns number of slots currently held by someone
+        '''
+        with self._cond:
+            return self.count - len(self._free)
+
+    def close(self):
+        '''
+        Frees the shared memory, no slot may be used after this
+
+        :returns None
+        '''
+        self._slots = []
+        self.frames = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # a view is still held somewhere, the mapping goes away with the process
+            pass
+        self._shm.unlink()
+        return None
@@ -0,0 +1,253 @@
+
+import json
+import warnings
+
+import numpy as np
+
+MEDIAN = 'median'
+KALMAN = 'kalman'
+# one smoothed person: smoother's track id, position and velocity in meters (per second), distance
+# from the camera, speed and how many frames of the window the person was triangulated on
+TRACK_DTYPE = np.dtype([('track', np.int64), ('position', np.float64, 3), ('velocity', np.float64, 3),
+                        ('distance', np.float64), ('speed', np.float64), ('frames', np.int32)])
+
+
+def median_filter(positions, times):
+    '''
+    :param positions: (N, K, 3) positions of N tracks over a window of K frames, nan where a track wasn't seen
+    :param times: (K,) timestamps of the frames, in seconds
+
+    :returns (position, velocity) - (N, 3) median position of every track and (N, 3) velocity, the
+             least squares slope of its positions over the window, 0 if seen on one frame only
+    '''
+    valid = np.isfinite(positions[..., 0])
+    with warnings.catch_warnings():
+        # tracks without a single valid frame are left as nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        position = np.nanmedian(positions, axis=1)
+        mean = np.nanmean(positions, axis=1)
+    t = np.where(valid, np.asarray(times, dtype=float)[None, :], 0.0)
+    count = np.maximum(valid.sum(axis=1), 1)
+    centred_t = np.where(valid, t - (t.sum(axis=1) / count)[:, None], 0.0)
+    centred_p = np.where(valid[..., None], positions - mean[:, None, :], 0.0)
+    variance = (centred_t ** 2).sum(axis=1)
+    covariance = (centred_t[..., None] * centred_p).sum(axis=1)
+    velocity = covariance / np.where(variance > 0, variance, 1.0)[:, None]
+    velocity[variance <= 0] = 0.0
+    return position, velocity
+
+
+def kalman_filter(positions, times, process_noise=1.0, measurement_noise=0.05):
+    '''
+    Constant velocity Kalman filter run over the window, every axis of every track at once
+
+    :param positions: (N, K, 3) positions of N tracks over a window of K frames, nan where a track wasn't seen
+    :param times: (K,) timestamps of the frames, in seconds
+    :param process_noise: standard deviation of the acceleration people have, in m/s^2
+    :param measurement_noise: standard deviation of a triangulated position, in meters
+
+    :returns (position, velocity) - (N, 3) filtered state of every track after the last frame
+    '''
+    shape = positions.shape[0], 3
+    p, v = np.full(shape, np.nan), np.zeros(shape)
+    # covariance of [p, v] per axis, it's symmetric so three numbers
+    p00, p01, p11 = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    q, r = process_noise ** 2, measurement_noise ** 2
+    previous = None
+    for k, now in enumerate(times):
+        if previous is not None:
+            dt = now - previous
+            p = p + v * dt
+            p00 = p00 + dt * (2 * p01 + dt * p11) + q * dt ** 4 / 4
+            p01 = p01 + dt * p11 + q * dt ** 3 / 2
+            p11 = p11 + q * dt ** 2
+        previous = now
+
+        z = positions[:, k]
+        seen = np.isfinite(z)
+        start = seen & np.isnan(p)
+        # the first measurement of a track starts it standing still, with an uncertain velocity
+        p = np.where(start, z, p)
+        v = np.where(start, 0.0, v)
+        p00, p01, p11 = np.where(start, r, p00), np.where(start, 0.0, p01), np.where(start, 1.0, p11)
+
+        update = seen & ~start
+        gain0 = p00 / (p00 + r)
+        gain1 = p01 / (p00 + r)
+        innovation = np.where(update, z - p, 0.0)
+        gain0, gain1 = np.where(update, gain0, 0.0), np.where(update, gain1, 0.0)
+        p, v = p + gain0 * innovation, v + gain1 * innovation
+        p00, p01, p11 = (1 - gain0) * p00, (1 - gain0) * p01, p11 - gain1 * p01
+    return p, v
+
+
+FILTERS = {MEDIAN: median_filter, KALMAN: kalman_filter}
+
+
+def smooth_tracks(matcher, left, right, times, method=MEDIAN, ids=None, **filter_args):
+    '''
+    Triangulates the matched points of N tracks over a window of K frames with one matcher.triangulate
+    call and smooths every track over time
+
+    :param matcher: stereo.StereoMatcher or RectifiedMatcher
+    :param left, right: (N, K, 2) matched image points of every track on every frame, nan where missing
+    :param times: (K,) timestamps of the frames, in seconds
+    :param method: MEDIAN or KALMAN
+    :param ids: optional (N,) track ids to put in the result, 0..N-1 if None
+    :param filter_args: passed on to the filter, eg. process_noise of the Kalman filter
+
+    :returns (N,) TRACK_DTYPE ndarray, tracks without a usable frame have nan positions and 0 frames
+    '''
+    left = np.asarray(left, dtype=float)
+    right = np.asarray(right, dtype=float)
+    valid = np.isfinite(left).all(axis=-1) & np.isfinite(right).all(axis=-1)
+    positions = np.full(left.shape[:2] + (3,), np.nan)
+    if valid.any():
+        xyz = matcher.triangulate(left[valid], right[valid])[:, :3]
+        # behind the camera, not actually possible
+        xyz[xyz[:, 2] <= 0] = np.nan
+        positions[valid] = xyz
+
+    position, velocity = FILTERS[method](positions, times, **filter_args)
+    return _tracks(np.arange(len(left)) if ids is None else ids, positions, position, velocity)
+
+
+def _tracks(ids, positions, position, velocity):
+    tracks = np.zeros(len(ids), dtype=TRACK_DTYPE)
+    tracks['track'] = ids
+    tracks['position'] = position
+    tracks['velocity'] = velocity
+    tracks['distance'] = np.linalg.norm(position, axis=1)
+    tracks['speed'] = np.linalg.norm(velocity, axis=1)
+    tracks['frames'] = np.isfinite(positions[..., 0]).sum(axis=1)
+    return tracks
+
+
+def to_json(tracks, **fields):
+    '''
+    :param tracks: TRACK_DTYPE ndarray
+    :param fields: extra top level fields, eg. time and camera
+
+    :returns one line of JSON with the fields and a list of people, nan positions as null
+    '''
+    people = []
+    for track in tracks:
+        person = {'track': int(track['track']), 'frames': int(track['frames'])}
+        for name in ('position', 'velocity', 'distance', 'speed'):
+            value = np.round(track[name], 4)
+            person[name] = None if not np.all(np.isfinite(value)) else value.tolist()
+        people.append(person)
+    return json.dumps(dict(fields, people=people))
+
+
+class TrackSmoother:
+    '''
+    Keeps the positions of every person over the last window frames and gives back smoothed
+    positions, distances and velocities instead of the noisy ones of a single frame.
+
+    Every update triangulates the matches of the frame in one call and keeps the result, the window
+    of earlier frames is never triangulated again, so smoothing costs the same per frame however long
+    the window is. People are told apart by the keys the caller gives, eg. the pair of left and right
+    track ids. Without keys, a point continues the track whose last left point is nearest, if that is
+    within max_jump pixels.
+
+    fields:
+        matcher: stereo matcher that triangulates the points
+        window: number of frames every track is smoothed over
+        method: MEDIAN or KALMAN
+        max_jump: largest distance, in pixels, a person moves on the left image between frames
+        filter_args: passed on to the filter
+    '''
+    def __init__(self, matcher, window=8, method=MEDIAN, max_jump=40.0, **filter_args):
+        if method not in FILTERS:
+            raise ValueError("Unknown smoothing method '{}', use one of {}".format(method, sorted(FILTERS)))
+        self.matcher = matcher
+        self.window = window
+        self.method = method
+        self.max_jump = max_jump
+        self.filter_args = filter_args
+        self._times = np.full(window, np.nan)
+        self._positions = np.empty((0, window, 3))
+        self._last = np.empty((0, 2))
+        self._keys = []
+        self._ids = np.empty(0, dtype=np.int64)
+        self._next_id = 1
+
+    def update(self, timestamp, left, right, keys=None, positions=None):
+        '''
+        Adds the points matched on one frame and smooths everyone on it
+
+        :param timestamp: capture time of the frame, in seconds
+        :param left, right: (M, 2) matched left and right points, row m of one matches row m of the other
+        :param keys: optional hashable key of every match that stays the same for the person across frames
+        :param positions: optional (M, 3) positions of the matches in meters, if the caller triangulated
+                          them already
+
+        :returns (M,) TRACK_DTYPE ndarray, row m is the person of match m
+        '''
+        left = np.asarray(left, dtype=float).reshape(-1, 2)
+        right = np.asarray(right, dtype=float).reshape(-1, 2)
+        self._advance(timestamp)
+        if keys is None:
+            keys = self._associate(left)
+        rows = self._rows(keys)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=TRACK_DTYPE)
+        if positions is None:
+            xyz = self.matcher.triangulate(left, right)[:, :3]
+        else:
+            xyz = np.array(positions, dtype=float).reshape(-1, 3)
+        xyz[xyz[:, 2] <= 0] = np.nan
+        self._positions[rows, -1] = xyz
+        self._last[rows] = left
+
+        # frames before the first full window have no time yet
+        filled = np.isfinite(self._times)
+        positions = self._positions[rows][:, filled]
+        position, velocity = FILTERS[self.method](positions, self._times[filled], **self.filter_args)
+        return _tracks(self._ids[rows], positions, position, velocity)
+
+    def _advance(self, timestamp):
+        self._times = np.roll(self._times, -1)
+        self._times[-1] = timestamp
+        self._positions = np.roll(self._positions, -1, axis=1)
+        self._positions[:, -1] = np.nan
+        # forget people not seen for a whole window
+        seen = np.isfinite(self._positions[..., 0]).any(axis=1)
+        if not seen.all():
+            self._positions, self._last, self._ids = self._positions[seen], self._last[seen], self._ids[seen]
+            self._keys = [key for key, keep in zip(self._keys, seen) if keep]
+        return None
+
+    def _associate(self, left):
+        if len(self._keys) == 0 or len(left) == 0:
+            return [None] * len(left)
+        # nearest pairs of new point and last point of a track first
+        distance = np.linalg.norm(left[:, None, :] - self._last[None, :, :], axis=2)
+        keys, taken = [None] * len(left), set()
+        for i, j in zip(*np.unravel_index(np.argsort(distance, axis=None), distance.shape)):
+            if distance[i, j] > self.max_jump:
+                break
+            if keys[i] is None and j not in taken:
+                keys[i] = self._keys[j]
+                taken.add(j)
+        return keys
+
+    def _rows(self, keys):
+        index = {key: row for row, key in enumerate(self._keys)}
+        rows, added = [], []
+        for key in keys:
+            row = index.get(key) if key is not None else None
+            if row is None:
+                row = len(self._keys) + len(added)
+                added.append(key)
+            rows.append(row)
+        if added:
+            ids = np.arange(self._next_id, self._next_id + len(added))
+            self._next_id += len(added)
+            self._ids = np.concatenate((self._ids, ids))
+            self._positions = np.concatenate((self._positions, np.full((len(added), self.window, 3), np.nan)))
+            self._last = np.concatenate((self._last, np.full((len(added), 2), np.nan)))
+            # keyless tracks are keyed by their own id
+            self._keys += [key if key is not None else int(track_id) for key, track_id in zip(added, ids)]
+        return np.array(rows, dtype=int)
@@ -0,0 +1,201 @@
+
+import cv2
+import numpy as np
+
+# scipy gives an optimal assignment, without it we fall back to a greedy one
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+class StereoMatcher:
+    '''
+    Matches detections between the left and right camera and triangulates all the matches at once.
+
+    Every left point is compared with every right point in one NumPy pass. A pair is allowed if
+    the points are close to each other's epipolar lines and the horizontal disparity is within
+    limits, and each point ends up in at most one pair.
+
+    fields:
+        F: fundamental matrix from stereo calibration
+        P1, P2: projection matrices of the left and right camera from stereoRectify
+        scale: size of the calibration chessboard square, converts triangulated units to meters
+        max_epipolar: largest allowed distance (pixels) of a point from its epipolar line
+        min_disparity, max_disparity: allowed range of left x - right x (pixels)
+    '''
+    def __init__(self, F, P1, P2, scale, max_epipolar=40.0, min_disparity=-40, max_disparity=40):
+        self.F = np.asarray(F, dtype=float)
+        self.P1 = np.asarray(P1, dtype=float)
+        self.P2 = np.asarray(P2, dtype=float)
+        self.scale = scale
+        self.max_epipolar = max_epipolar
+        self.min_disparity = min_disparity
+        self.max_disparity = max_disparity
+
+    def cost_matrix(self, left, right):
+        '''
+        Builds the left x right matching cost, the symmetric epipolar distance of each pair.
+        Pairs that break the epipolar or disparity limits get infinite cost.
+
+        :param left: (L, 2) array like of left image points
+        :param right: (R, 2) array like of right image points
+
+        :returns (L, R) ndarray of costs
+        '''
+        left = np.asarray(left, dtype=float).reshape(-1, 2)
+        right = np.asarray(right, dtype=float).reshape(-1, 2)
+        left_h = np.hstack((left, np.ones((len(left), 1))))
+        right_h = np.hstack((right, np.ones((len(right), 1))))
+
+        # epipolar lines of the left points in the right image and the other way round
+        lines_right = left_h.dot(self.F.T)
+        lines_left = right_h.dot(self.F)
+        # |x_r^T F x_l| is the same numerator for both distances
+        residual = np.abs(lines_right.dot(right_h.T))
+        norm_right = np.hypot(lines_right[:, 0], lines_right[:, 1])[:, None]
+        norm_left = np.hypot(lines_left[:, 0], lines_left[:, 1])[None, :]
+        cost = 0.5 * (residual / np.maximum(norm_right, 1e-12) + residual / np.maximum(norm_left, 1e-12))
+
+        disparity = left[:, None, 0] - right[None, :, 0]
+        rejected = ((cost > self.max_epipolar) | (disparity < self.min_disparity) |
+                    (disparity > self.max_disparity))
+        cost[rejected] = np.inf
+        return cost
+
+    def match(self, left, right, known=None):
+        '''
+        Finds the one-to-one pairing of left and right points with the lowest total cost
+
+        :param left: (L, 2) array like of left image points
+        :param right: (R, 2) array like of right image points
+        :param known: optional (left index, right index) pairs matched on an earlier frame, eg. by
+                      track id. They are kept as long as they still pass the epipolar and disparity
+                      limits and only the remaining points are assigned.
+
+        :returns (K, 2) int ndarray, each row is (left index, right index)
+        '''
+        if len(left) == 0 or len(right) == 0:
+            return np.empty((0, 2), dtype=int)
+        cost = self.cost_matrix(left, right)
+        kept = np.empty((0, 2), dtype=int)
+        if known is not None and len(known) > 0:
+            known = np.asarray(known, dtype=int).reshape(-1, 2)
+            kept = known[np.isfinite(cost[known[:, 0], known[:, 1]])]
+            cost[kept[:, 0], :] = np.inf
+            cost[:, kept[:, 1]] = np.inf
+        valid = np.isfinite(cost)
+        if not valid.any():
+            return kept
+
+        if linear_sum_assignment is not None:
+            # the solver needs finite costs, anything over every real cost works as "no match"
+            rows, cols = linear_sum_assignment(np.where(valid, cost, cost[valid].max() * 2 + 1))
+            keep = valid[rows, cols]
+            return np.vstack((kept, np.stack((rows[keep], cols[keep]), axis=1)))
+
+        # greedy: take the cheapest remaining pair until nothing is left
+        candidates = np.argwhere(valid)
+        order = np.argsort(cost[valid], kind='stable')
+        used_left, used_right, pairs = set(), set(), []
+        for i, j in candidates[order]:
+            if i not in used_left and j not in used_right:
+                used_left.add(i)
+                used_right.add(j)
+                pairs.append((i, j))
+        return np.vstack((kept, np.array(pairs, dtype=int).reshape(-1, 2)))
+
+    def triangulate(self, left, right):
+        '''
+        Corrects and triangulates all matched pairs with a single correctMatches/triangulatePoints call
+
+        :param left: (K, 2) left points, row k matches row k of right
+        :param right: (K, 2) right points
+
+        :returns (K, 4) ndarray of (x, y, z, distance) in meters, camera at (0, 0, 0)
+        '''
+        left = np.asarray(left, dtype=float).reshape(1, -1, 2)
+        right = np.asarray(right, dtype=float).reshape(1, -1, 2)
+        if left.shape[1] == 0:
+            return np.empty((0, 4))
+        left_corrected, right_corrected = cv2.correctMatches(self.F, left, right)
+        homogeneous = cv2.triangulatePoints(self.P1, self.P2, left_corrected.reshape(-1, 2).T,
+                                            right_corrected.reshape(-1, 2).T)
+        # homo to normal coords by dividing by last element, then chessboard squares to meters
+        xyz = (homogeneous[:3] / homogeneous[3]).T * self.scale
+        return np.hstack((xyz, np.linalg.norm(xyz, axis=1)[:, None]))
+
+    def locate(self, left, right, known=None):
+        '''
+        Matches the detections from both cameras and finds where each matched person is
+
+        :param left: midpoints detected on the left camera
+        :param right: midpoints detected on the right camera
+        :param known: optional pairs matched on an earlier frame, see match
+
+        :returns (ranges, pairs) - (K, 4) ndarray of (x, y, z, distance) and the (K, 2) index pairs
+                 they belong to. Points triangulated behind the camera are dropped.
+        '''
+        pairs = self.match(left, right, known)
+        if len(pairs) == 0:
+            return np.empty((0, 4)), pairs
+        left = np.asarray(left, dtype=float).reshape(-1, 2)
+        right = np.asarray(right, dtype=float).reshape(-1, 2)
+        ranges = self.triangulate(left[pairs[:, 0]], right[pairs[:, 1]])
+        # z <= 0 means behind the camera -- not actually possible.
+        in_front = ranges[:, 2] > 0
+        return ranges[in_front], pairs[in_front]
+
+
+class RectifiedMatcher(StereoMatcher):
+    '''
+    StereoMatcher for points detected on rectified frames.
+
+    After rectification a person sits on the same row in both images, so matching is a 1-D search
+    along rows and depth follows straight from the disparity through Q, no correctMatches or
+    triangulatePoints needed.
+
+    fields:
+        Q: disparity to depth matrix from stereoRectify
+        max_row_diff: largest allowed row difference (pixels) of a pair
+        min_disparity, max_disparity: allowed disparity range (pixels), measured in the direction
+                                      that puts the point in front of the cameras
+    '''
+    def __init__(self, Q, scale, max_row_diff=8.0, min_disparity=0.1, max_disparity=320):
+        self.Q = np.asarray(Q, dtype=float)
+        self.scale = scale
+        self.max_row_diff = max_row_diff
+        self.min_disparity = min_disparity
+        self.max_disparity = max_disparity
+        # which sign of left x - right x gives positive depth depends on the order of the cameras
+        self.direction = 1.0 if self.Q[3, 2] > 0 else -1.0
+
+    def cost_matrix(self, left, right):
+        '''
+        :returns (L, R) ndarray of row differences, infinite where the row or disparity limits are broken
+        '''
+        left = np.asarray(left, dtype=float).reshape(-1, 2)
+        right = np.asarray(right, dtype=float).reshape(-1, 2)
+        cost = np.abs(left[:, None, 1] - right[None, :, 1])
+        disparity = (left[:, None, 0] - right[None, :, 0]) * self.direction
+        rejected = ((cost > self.max_row_diff) | (disparity < self.min_disparity) |
+                    (disparity > self.max_disparity))
+        cost[rejected] = np.inf
+        return cost
+
+    def triangulate(self, left, right):
+        '''
+        Closed form depth from disparity for all pairs at once
+
+        :returns (K, 4) ndarray of (x, y, z, distance) in meters, left camera at (0, 0, 0)
+        '''
+        left = np.asarray(left, dtype=float).reshape(-1, 2)
+        right = np.asarray(right, dtype=float).reshape(-1, 2)
+        if len(left) == 0:
+            return np.empty((0, 4))
+        # [X Y Z W] = Q [x y d 1], row averaged over both cameras as they should agree
+        points = np.column_stack((left[:, 0], (left[:, 1] + right[:, 1]) / 2, left[:, 0] - right[:, 0],
+                                  np.ones(len(left))))
+        homogeneous = points.dot(self.Q.T)
+        xyz = homogeneous[:, :3] / homogeneous[:, 3:] * self.scale
+        return np.hstack((xyz, np.linalg.norm(xyz, axis=1)[:, None]))
@@ -0,0 +1,261 @@
+
+import json
+import sys
+import threading
+from threading import Thread
+
+import cv2
+
+from calibration import load_calibration, Rectifier
+from detectors import get_registry
+from frame import Frame
+from pipeline import StereoPipeline, RingBuffer
+from shmring import FrameRing
+from stereo import StereoMatcher, RectifiedMatcher
+from tp17storage import TP17Storage
+from workers import ProcessDetector
+from writer import RecordWriter
+
+# rig settings used when the config doesn't give them
+DEFAULTS = {
+    'calibration': '.',
+    'calibration_devices': [0, 1],
+    'rectified': False,
+    'fps': 15,
+    'square_size': 0.0025,
+}
+# frames of the shared ring every rig can hold at once
+SLOTS_PER_RIG = 16
+
+
+def load_config(path):
+    '''
+    Reads a rig config, eg.
+
+        {"processes": 4, "storage": "tp17db",
+         "rigs": [{"id": 1, "name": "entrance", "sources": [0, 1], "calibration": "calib/entrance"},
+                  {"id": 2, "sources": ["rtsp://10.0.0.5/left", "rtsp://10.0.0.5/right"],
+                   "calibration": "calib/bar", "rectified": true}]}
+
+    sources are device indices or stream URLs, anything cv2.VideoCapture opens. calibration is the
+    directory chesscal.py wrote the rig's matrices to, calibration_devices the device numbers in
+    their file names. processes is the size of the detection pool shared by every rig, one per core if 0.
+
+    :returns dict with the config, rig settings not given are filled in from DEFAULTS
+    '''
+    with open(path) as f:
+        config = json.load(f)
+    ids = set()
+    for rig in config['rigs']:
+        for name, value in DEFAULTS.items():
+            rig.setdefault(name, value)
+        rig.setdefault('name', str(rig['id']))
+        if len(rig['sources']) != 2:
+            raise ValueError("Rig {} needs a left and a right source".format(rig['id']))
+        if rig['id'] in ids:
+            raise ValueError("Rig id {} is used twice".format(rig['id']))
+        ids.add(rig['id'])
+    config.setdefault('processes', 0)
+    config.setdefault('storage', 'tp17db')
+    return config
+
+
+class Rig:
+    '''
+    One stereo camera pair with a pipeline of its own.
+
+    Every rig has its own capture, pairing and analysis threads, so a rig that stalls or loses a camera
+    only stops itself. Detection goes to the pool shared by all rigs and results go to the shared
+    writer, tagged with the rig id.
+
+    fields:
+        id: rig id the stored rows are tagged with
+        name: name used in log lines
+        pipeline: the rig's StereoPipeline, set by start()
+        analysed: number of stereo pairs analysed
+    '''
+    # device labels of the left and right camera inside a rig, also the camera column in storage
+    DEVICES = (0, 1)
+
+    def __init__(self, settings):
+        self.id = settings['id']
+        self.name = settings['name']
+        self.settings = settings
+        self.captures = []
+        self.pipeline = None
+        self.analysed = 0
+        self._thread = None
+
+    def start(self, ring, backend, writer, capacity=4, policy=RingBuffer.DROP_OLDEST):
+        '''
+        Opens the cameras and starts the rig's pipeline and analysis thread
+
+        :param ring: FrameRing shared by every rig
+        :param backend: ProcessDetector shared by every rig
+        :param writer: RecordWriter shared by every rig
+
+        :returns False if a camera couldn't be opened, nothing is started then
+        '''
+        settings = self.settings
+        calibration = load_calibration(settings['calibration'], settings['calibration_devices'])
+        rectifier = None
+        if settings['rectified']:
+            rectifier = Rectifier(calibration, self.DEVICES)
+            matcher = RectifiedMatcher(calibration.Q, settings['square_size'])
+        else:
+            matcher = StereoMatcher(calibration.F, calibration.P1, calibration.P2, settings['square_size'])
+
+        for source in settings['sources']:
+            cap = cv2.VideoCapture(source)
+            cap.set(cv2.CAP_PROP_FPS, settings['fps'])
+            self.captures.append(cap)
+        if not all(cap.isOpened() for cap in self.captures):
+            print("Rig {}: couldn't start capture".format(self.name))
+            self.release()
+            return False
+
+        self.pipeline = StereoPipeline(self.captures, self.DEVICES, matcher, 0.5 / settings['fps'], capacity, policy,
+                                       backend, ring, rectifier=rectifier)
+        self._thread = Thread(target=self._analyse, args=(writer,))
+        self._thread.daemon = True
+        self.pipeline.start()
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline.join(1)
+        if self._thread is not None:
+            self._thread.join(1)
+        self.release()
+        return None
+
+    def release(self):
+        for cap in self.captures:
+            cap.release()
+        return None
+
+    @property
+    def running(self):
+        return self.pipeline is not None and not self.pipeline.stopped.is_set()
+
+    def _analyse(self, writer):
+        prev_counts = {device: [0] * (Frame.SPLIT_DIV ** 2) for device in self.DEVICES}
+        while not self.pipeline.stopped.is_set():
+            pair = self.pipeline.paired.get(timeout=0.5)
+            if pair is None:
+                continue
+            for column, packet in enumerate((pair.left, pair.right)):
+                frame = packet.frame
+                frame.add_distances(pair.pairs[:, column], pair.ranges)
+                frame.update_movements(prev_counts[packet.device])
+                writer.submit(frame, packet.device, self.id)
+            self.analysed += 1
+            pair.release()
+        return None
+
+
+class Supervisor:
+    '''
+    Runs every rig of a config in one process, with one detection pool and one store.
+
+    Frames of all rigs live in one shared FrameRing and are detected by one ProcessDetector pool, so
+    the pool keeps every core busy whichever rigs are busy and rigs don't each pay for their own workers.
+    The pool only lets a bounded number of frames in flight, a rig that captures faster than its share
+    waits for a free worker and its capture buffers drop the oldest frames, the other rigs keep their turns.
+
+    fields:
+        rigs: list of Rig
+        storage: TP17Storage every rig writes to, rows are tagged with the rig id
+        writer: RecordWriter shared by the rigs
+    '''
+    def __init__(self, config, report_every=10.0):
+        self.config = config
+        self.report_every = report_every
+        self.rigs = [Rig(settings) for settings in config['rigs']]
+        self.ring = None
+        self.backend = None
+        self.storage = None
+        self.writer = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        '''
+        Starts the shared pool and writer, then every rig
+
+        :returns number of rigs running
+        '''
+        self.ring = FrameRing(SLOTS_PER_RIG * len(self.rigs))
+        self.backend = ProcessDetector(self.ring, self.config['processes'] or None,
+                                       max_in_flight=self.config.get('max_in_flight'))
+        self.storage = TP17Storage(self.config['storage'])
+        self.writer = RecordWriter(self.storage, self.config.get('write_queue', 1024))
+        started = [rig for rig in self.rigs if rig.start(self.ring, self.backend, self.writer)]
+        for rig in started:
+            print("Rig {} ({}) started".format(rig.name, rig.id))
+        return len(started)
+
+    def run(self):
+        '''
+        Starts everything and reports until every rig stopped or ctrl+c
+
+        :returns None
+        '''
+        if self.start() == 0:
+            print("No rig could be started. Exiting...")
+            self.stop()
+            return None
+        try:
+            while not self.stopped.wait(self.report_every):
+                if not any(rig.running for rig in self.rigs):
+                    break
+                self.report()
+        except KeyboardInterrupt:
+            print("Exiting...")
+        self.stop()
+        return None
+
+    def report(self):
+        for rig in self.rigs:
+            if rig.pipeline is None:
+                continue
+            stats = rig.pipeline.stats()
+            print("Rig {}: {} pairs, {} dropped, {} unpaired{}".format(
+                rig.name, rig.analysed, stats['dropped_frames'], stats['unpaired'],
+                "" if rig.running else ", stopped"))
+        print("records written: {}, dropped: {}".format(self.writer.written, self.writer.dropped))
+        return None
+
+    def stop(self):
+        '''
+        Stops every rig, then the pool, and writes out everything still queued
+
+        :returns None
+        '''
+        self.stopped.set()
+        for rig in self.rigs:
+            rig.stop()
+        if self.writer is not None:
+            self.report()
+            self.writer.close()
+        if self.backend is not None:
+            self.backend.close()
+        if self.ring is not None:
+            self.ring.close()
+        return None
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: python supervisor.py rigs.json")
+        return 1
+    config = load_config(sys.argv[1])
+    # parse the cascade once up front so a broken XML fails here and not in every worker
+    get_registry().load(['face'])
+    Supervisor(config).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from motion import MotionGate
+
+WIDTH, HEIGHT = 640, 480
+PATCH = 80
+
+
+class PatchDetector:
+    '''
+    Stands in for a cascade: finds the bounding box of everything brighter than the black background
+    '''
+    spec = SimpleNamespace(min_size=(30, 30))
+
+    def detect(self, img):
+        ys, xs = np.nonzero(img.max(axis=2))
+        if len(xs) == 0:
+            return []
+        return [(xs.min(), ys.min(), xs.max() + 1 - xs.min(), ys.max() + 1 - ys.min())]
+
+
+def drifting_patch(step, frames):
+    '''
+    :returns generator of (img, x) - frames of a textured patch moving step pixels to the right
+             every frame, and the patch's left edge
+    '''
+    texture = np.random.default_rng(0).integers(1, 256, (PATCH, PATCH, 3), dtype=np.uint8)
+    for k in range(frames):
+        x = 100 + step * k
+        img = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+        img[200:200 + PATCH, x:x + PATCH] = texture
+        yield img, x
+
+
+def test_slow_drift_is_followed():
+    for step in (3, 6):
+        gate = MotionGate()
+        paths = []
+        for img, x in drifting_patch(step, 40):
+            path, boxes = gate.detect(PatchDetector(), img)
+            paths.append(path)
+            assert len(boxes) == 1
+            # stale by a few frames at most, until the drift adds up to a change
+            assert abs(boxes[0][0] - x) <= 24
+        assert gate.paths[MotionGate.REGIONS] > 0
+        assert paths.count(MotionGate.FULL) == 2
+
+
+def test_regions_search_whole_people():
+    gate = MotionGate()
+    for img, x in drifting_patch(6, 20):
+        path, boxes = gate.detect(PatchDetector(), img)
+        # a region made of the moving edges only would cut the patch
+        assert tuple(boxes[0][2:]) == (PATCH, PATCH)
@@ -1,53 +1,231 @@
 
 
+import os
+
+import numpy as np
 import pandas as pd
 
+from rollups import RollupIndex
 
 
 class TP17Storage:
     '''
-    Basic database for storing frame information.
-    Developed using pandas DataFrame
+    Append-only database for storing frame information.
+
+    Rows are buffered in preallocated NumPy column arrays and written out batch_rows at a time
+    as a segment file, so adding a row costs the same no matter how much is stored and memory
+    use is fixed by batch_rows. Segments are named after the time range they hold, queries
+    skip the ones outside the asked range and only load the ones they need. Every row also
+    goes into 1 s, 1 min and 1 h rollups, so counts and movements over long ranges are read
+    from those instead of the rows.
+
+    fields:
+        directory: where the segment files are kept
+        batch_rows: rows buffered in memory before they are written out as a segment
+        max_segments: oldest segments are deleted when there are more than this, None keeps all
+        cols: column names, as used by to_dataframe() and export_csv()
+        rollups: RollupIndex kept up to date by add_row(), saved next to the segments
     '''
     NUM_SECTIONS = 9
+    # signed change of a section's count, positive for people coming in
+    MOVEMENT_DTYPE = np.int16
 
-    def __init__(self, file = None):
-        if file == None:
-            self.cols = ['Time']
-            for i in range(self.NUM_SECTIONS):
-                self.cols.append('Section' + str(i+1) +' count')
-                self.cols.append('Section' + str(i+1) + ' movement')
-            self.db = pd.DataFrame(columns = self.cols)
-        else:
-            try:
-                self.db = pd.read_csv(file)
-                self.cols = list(self.db)
-            except:
-                print('Database not found.')
+    def __init__(self, directory='tp17db', batch_rows=4096, max_segments=None):
+        self.directory = directory
+        self.batch_rows = batch_rows
+        self.max_segments = max_segments
+        self.cols = ['Time', 'Rig', 'Camera']
+        for i in range(self.NUM_SECTIONS):
+            self.cols.append('Section' + str(i+1) +' count')
+            self.cols.append('Section' + str(i+1) + ' movement')
+
+        self._time = np.empty(batch_rows, dtype=np.float64)
+        self._camera = np.empty(batch_rows, dtype=np.int16)
+        self._rig = np.empty(batch_rows, dtype=np.int16)
+        self._counts = np.empty((batch_rows, self.NUM_SECTIONS), dtype=np.int32)
+        self._movements = np.empty((batch_rows, self.NUM_SECTIONS), dtype=self.MOVEMENT_DTYPE)
+        self._rows = 0
 
-    def add(self,frame):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(name for name in os.listdir(directory)
+                               if name.startswith('segment_') and name.endswith('.npz'))
+        self._next_segment = int(self.segments[-1].split('_')[1]) + 1 if self.segments else 0
+        self.rollups = RollupIndex(self.NUM_SECTIONS)
+        self.rollups.load(directory)
+
+    def add(self, frame, camera=0, rig=0):
         '''
         Adds a row to the database based on the current frame data
 
-        :param frame: the frame we are looking at
+        :param frame: the frame we are looking at, counted and with movements updated
+        :param camera: device number of the camera the frame came from
+        :param rig: id of the stereo rig the camera belongs to
 
         :returns None
         '''
-        row = [frame.time_now]
-        for i in range(self.NUM_SECTIONS):
-            row.append(frame.sections[i].people_count)
-            row.append(frame.movements[i])
-        to_add = pd.DataFrame([row],columns=self.cols)
-        both = [self.db,to_add]
-        self.db = pd.concat(both)
+        self.add_row(frame.time_now.timestamp(), camera, frame.counts, frame.movements, rig)
+        return None
+
+    def add_row(self, time, camera, counts, movements, rig=0):
+        '''
+        Adds a row from plain values
+
+        :param time: seconds since the epoch
+        :param camera: device number of the camera
+        :param counts: people count of every section
+        :param movements: signed change of every section's count
+        :param rig: id of the stereo rig
+
+        :returns None
+        '''
+        if self._rows == self.batch_rows:
+            # the last flush failed, eg. the disk was full. try again before the buffer overflows
+            self.flush()
+        i = self._rows
+        self._time[i] = time
+        self._camera[i] = camera
+        self._rig[i] = rig
+        self._counts[i] = counts[:self.NUM_SECTIONS]
+        self._movements[i] = movements[:self.NUM_SECTIONS]
+        self._rows += 1
+        self.rollups.add(time, camera, self._counts[i], self._movements[i], rig)
+        if self._rows == self.batch_rows:
+            self.flush()
+        return None
+
+    def flush(self):
+        '''
+        Writes the buffered rows out as a new segment
+
+        :returns None
+        '''
+        if self._rows == 0:
+            return None
+        n = self._rows
+        # sequence number, earliest and latest time in microseconds and number of rows. rows of
+        # several cameras and rigs aren't added in time order, so the first and last may not be those
+        time = self._time[:n]
+        name = 'segment_{:08d}_{}_{}_{}.npz'.format(self._next_segment, int(np.floor(time.min() * 1e6)),
+                                                     int(np.ceil(time.max() * 1e6)), n)
+        path = os.path.join(self.directory, name)
+        # write under a temporary name first so a reader never sees half a segment
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, time=self._time[:n], camera=self._camera[:n], counts=self._counts[:n],
+                     movements=self._movements[:n], rig=self._rig[:n])
+        os.replace(path + '.tmp', path)
+        self.segments.append(name)
+        self._next_segment += 1
+        self._rows = 0
+
+        if self.max_segments is not None:
+            while len(self.segments) > self.max_segments:
+                os.remove(os.path.join(self.directory, self.segments.pop(0)))
+        self.rollups.save(self.directory)
         return None
 
     def save(self):
         '''
-        Saves the database into working directory under name tp17db.csv
+        Makes sure everything added so far is on disk
 
         :returns None
         '''
-        self.db.to_csv('tp17db.csv', index = False)
+        if self._rows > 0:
+            # writes the rollups too
+            self.flush()
+        else:
+            self.rollups.save(self.directory)
+        return None
 
+    def scan(self, start=None, end=None):
+        '''
+        Reads the stored rows one segment at a time, oldest first, including rows not flushed yet
+
+        :param start: only rows at or after this time (seconds since the epoch)
+        :param end: only rows before this time
+
+        :returns generator of (time, camera, counts, movements, rig) column arrays
+        '''
+        for name in list(self.segments):
+            # earliest and latest time of the segment's rows
+            first, last = (int(v) / 1e6 for v in name[:-len('.npz')].split('_')[2:4])
+            if (start is not None and last < start) or (end is not None and first >= end):
+                continue
+            with np.load(os.path.join(self.directory, name)) as segment:
+                columns = (segment['time'], segment['camera'], segment['counts'], segment['movements'],
+                           segment['rig'])
+            yield self._between(columns, start, end)
+        n = self._rows
+        if n > 0:
+            yield self._between((self._time[:n].copy(), self._camera[:n].copy(), self._counts[:n].copy(),
+                                 self._movements[:n].copy(), self._rig[:n].copy()), start, end)
+
+    def to_dataframe(self, start=None, end=None):
+        '''
+        Loads the rows in a time range into a pandas DataFrame with the original column layout
+
+        :returns DataFrame
+        '''
+        frames = [self._dataframe(columns) for columns in self.scan(start, end)]
+        if not frames:
+            return pd.DataFrame(columns=self.cols)
+        return pd.concat(frames, ignore_index=True)
+
+    def rollup(self, seconds, start=None, end=None, camera=None, rig=None):
+        '''
+        Per-bucket section statistics for a time range, read from the rollups
+
+        :param seconds: bucket width, a multiple of 1 s, 1 min or 1 h
+        :param start: only buckets starting at or after this time (seconds since the epoch)
+        :param end: only buckets starting before this time
+        :param camera: only this camera, all cameras if None
+        :param rig: only this rig, all rigs if None
+
+        :returns DataFrame with Time (bucket start), Rig, Camera, Frames and the mean count, max count,
+                 people in and people out of every section
+        '''
+        buckets = self.rollups.query(seconds, start, end, camera, rig)
+        data = {'Time': pd.to_datetime(buckets['start'], unit='s'), 'Rig': buckets['rig'], 'Camera': buckets['camera'],
+                'Frames': buckets['frames']}
+        for i in range(self.NUM_SECTIONS):
+            name = 'Section' + str(i+1)
+            data[name + ' mean'] = buckets['mean'][:, i]
+            data[name + ' max'] = buckets['count_max'][:, i]
+            data[name + ' in'] = buckets['ins'][:, i]
+            data[name + ' out'] = buckets['outs'][:, i]
+        return pd.DataFrame(data)
+
+    def export_csv(self, file='tp17db.csv'):
+        '''
+        Writes the whole database into a CSV file, one segment at a time
+
+        :returns None
+        '''
+        header = True
+        with open(file, 'w', newline='') as f:
+            for columns in self.scan():
+                self._dataframe(columns).to_csv(f, index=False, header=header)
+                header = False
         return None
+
+    def __len__(self):
+        return sum(int(name[:-len('.npz')].split('_')[4]) for name in self.segments) + self._rows
+
+    def _between(self, columns, start, end):
+        time = columns[0]
+        keep = np.ones(len(time), dtype=bool)
+        if start is not None:
+            keep &= time >= start
+        if end is not None:
+            keep &= time < end
+        if keep.all():
+            return columns
+        return tuple(column[keep] for column in columns)
+
+    def _dataframe(self, columns):
+        time, camera, counts, movements, rig = columns
+        data = {'Time': pd.to_datetime(time, unit='s'), 'Rig': rig, 'Camera': camera}
+        for i in range(self.NUM_SECTIONS):
+            data[self.cols[3 + 2 * i]] = counts[:, i]
+            data[self.cols[4 + 2 * i]] = movements[:, i]
+        return pd.DataFrame(data, columns=self.cols)
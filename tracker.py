@@ -0,0 +1,134 @@
+
+import cv2
+import numpy as np
+
+
+class Track:
+    '''
+    A person followed across frames of one camera.
+
+    fields:
+        track_id: id that stays with the person for as long as they are tracked
+        box: last known (x, y, w, h) bounding box
+        template: grayscale patch of the person taken at the last detection
+        confidence: how well the template matched on the last tracked frame, 1 right after detection
+    '''
+    def __init__(self, track_id, box, template):
+        self.track_id = track_id
+        self.box = box
+        self.template = template
+        self.confidence = 1.0
+
+
+class PersonTracker:
+    '''
+    Runs the cascade every detect_every frames and follows people with template matching in between.
+
+    Between detections every track searches for its template in a small window around its last box.
+    When a track matches worse than min_confidence, the cascade runs again on that frame.
+    Fresh detections take over the id of the track they overlap most, so a person keeps the same id
+    from one detection to the next. One tracker per camera.
+
+    fields:
+        tracks: list of current Track objects
+        paths: dict path -> how many frames took it, 'full' (cascade) or 'tracked'
+    '''
+    FULL = 'full'
+    TRACKED = 'tracked'
+
+    def __init__(self, detect_every=5, min_confidence=0.6, search=16, min_iou=0.3):
+        '''
+        :param detect_every: run the cascade at least every this many frames
+        :param min_confidence: template match score (0 - 1) below which a track is considered lost
+        :param search: pixels the search window extends around the last box
+        :param min_iou: overlap a detection needs with a track to inherit its id
+        '''
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.search = search
+        self.min_iou = min_iou
+        self.tracks = []
+        self.paths = {self.FULL: 0, self.TRACKED: 0}
+        self._next_id = 1
+        self._since_detection = None
+
+    def update(self, detector, img):
+        '''
+        Moves the tracks to the new frame, running the cascade when it's due or tracking is lost
+
+        :param detector: Detector borrowed from the DetectorRegistry
+        :param img: BGR frame
+
+        :returns (path, boxes, ids) - path the frame took, (N, 4) ndarray of (x, y, w, h) boxes and
+                 the list of track ids belonging to them
+        '''
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        path = self.TRACKED
+        if self._since_detection is None or self._since_detection + 1 >= self.detect_every:
+            path = self.FULL
+        else:
+            self._track(gray)
+            if any(track.confidence < self.min_confidence for track in self.tracks):
+                path = self.FULL
+
+        if path == self.FULL:
+            self._associate(gray, np.asarray(detector.detect(img), dtype=int).reshape(-1, 4))
+            self._since_detection = 0
+        else:
+            self._since_detection += 1
+        self.paths[path] += 1
+
+        boxes = np.array([track.box for track in self.tracks], dtype=int).reshape(-1, 4)
+        return path, boxes, [track.track_id for track in self.tracks]
+
+    def _track(self, gray):
+        height, width = gray.shape
+        for track in self.tracks:
+            x, y, w, h = track.box
+            x0, y0 = max(x - self.search, 0), max(y - self.search, 0)
+            x1, y1 = min(x + w + self.search, width), min(y + h + self.search, height)
+            # the window got cut by the image edge so much the template doesn't fit any more
+            if x1 - x0 < w or y1 - y0 < h:
+                track.confidence = 0.0
+                continue
+            scores = cv2.matchTemplate(gray[y0:y1, x0:x1], track.template, cv2.TM_CCOEFF_NORMED)
+            _, best, _, (bx, by) = cv2.minMaxLoc(scores)
+            track.box = (x0 + bx, y0 + by, w, h)
+            track.confidence = best
+        return None
+
+    def _associate(self, gray, boxes):
+        # greedy, best overlapping pairs first
+        overlaps = _iou(boxes, np.array([track.box for track in self.tracks]).reshape(-1, 4))
+        ids = [None] * len(boxes)
+        taken = set()
+        for i, j in zip(*np.unravel_index(np.argsort(-overlaps, axis=None), overlaps.shape)):
+            if overlaps[i, j] < self.min_iou:
+                break
+            if ids[i] is None and j not in taken:
+                ids[i] = self.tracks[j].track_id
+                taken.add(j)
+
+        tracks = []
+        for box, track_id in zip(boxes, ids):
+            if track_id is None:
+                track_id = self._next_id
+                self._next_id += 1
+            x, y, w, h = (int(v) for v in box)
+            tracks.append(Track(track_id, (x, y, w, h), gray[y:y + h, x:x + w].copy()))
+        self.tracks = tracks
+        return None
+
+
+def _iou(a, b):
+    '''
+    :returns (len(a), len(b)) ndarray of intersection over union of (x, y, w, h) boxes
+    '''
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)))
+    ax0, ay0, ax1, ay1 = a[:, 0, None], a[:, 1, None], (a[:, 0] + a[:, 2])[:, None], (a[:, 1] + a[:, 3])[:, None]
+    bx0, by0, bx1, by1 = b[None, :, 0], b[None, :, 1], (b[:, 0] + b[:, 2])[None, :], (b[:, 1] + b[:, 3])[None, :]
+    inter = (np.clip(np.minimum(ax1, bx1) - np.maximum(ax0, bx0), 0, None) *
+             np.clip(np.minimum(ay1, by1) - np.maximum(ay0, by0), 0, None))
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return inter / np.maximum(union, 1)
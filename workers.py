@@ -0,0 +1,102 @@
+
+import multiprocessing as mp
+import threading
+
+from detectors import DetectorRegistry
+from person import make_people
+from pyramid import ImagePyramid
+from shmring import FrameRing
+
+# set in each worker process by _init_worker
+_detector = None
+_shm = None
+_frames = None
+_scale = 1.0
+
+
+def _init_worker(cascade, ring_name, count, shape, scale):
+    """
+    Runs once in every worker process, loads the cascade and maps the frame ring
+    so each frame only pays for detection
+    """
+    global _detector, _shm, _frames, _scale
+    _detector = DetectorRegistry().borrow(cascade)
+    _scale = scale
+    _shm, _frames = FrameRing.attach(ring_name, count, shape)
+
+
+def _run_detection(index):
+    """
+    Detects people in the frame held by a ring slot
+
+    :returns person.PERSON_DTYPE ndarray of the people found, one small array through the pipe
+    """
+    boxes = ImagePyramid(_frames[index]).detect(_detector, _scale)
+    return make_people(boxes, labels=_detector.name)
+
+
+class ProcessDetector:
+    '''
+    Detection backend that runs the cascade in a pool of worker processes, so detection isn't
+    limited to one core by the GIL.
+
+    Frames are read by the workers straight out of a shared FrameRing, only the slot index goes
+    through the pool's pipe. Every worker loads its cascade and maps the ring once when it starts.
+    A slot is retained while a worker is on it, submit blocks while too many frames are in flight,
+    which keeps the camera threads from running ahead of the workers.
+
+    fields:
+        processes: number of worker processes
+        cascade: name of the cascade the workers load, see detectors.CASCADES
+        ring: FrameRing the frames are read from
+        max_in_flight: most frames queued for the workers at once
+        scale: size of the grayscale copy searched relative to the frame, see Frame.DETECTION_SCALE
+    '''
+    def __init__(self, ring, processes=None, cascade='face', max_in_flight=None, scale=1.0):
+        self.ring = ring
+        self.processes = processes or mp.cpu_count()
+        self.cascade = cascade
+        self.max_in_flight = max_in_flight or 2 * self.processes
+        self.scale = scale
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self._pool = mp.Pool(self.processes, initializer=_init_worker,
+                             initargs=(cascade, ring.name, ring.count, ring.shape, scale))
+
+    def submit(self, img, slot=None, timeout=5.0):
+        '''
+        Queues a frame for detection
+
+        :param img: uint8 ndarray with the ring's frame shape, eg. Frame.img_data
+        :param slot: ring Slot that img lives in. If None the image is copied into a free slot first.
+        :param timeout: seconds to wait for a free slot when img has to be copied, RuntimeError after
+
+        :returns AsyncResult, its get() gives the person.PERSON_DTYPE ndarray of the people found
+        '''
+        if slot is None and img.shape != self.ring.shape:
+            raise ValueError("Frame shape {} doesn't fit slot shape {}".format(img.shape, self.ring.shape))
+        self._in_flight.acquire()
+        if slot is None:
+            slot = self.ring.acquire(timeout)
+            if slot is None:
+                self._in_flight.release()
+                raise RuntimeError("No free ring slot for detection in {} s, {} of {} slots still in use"
+                                   .format(timeout, self.ring.in_use(), self.ring.count))
+            slot.img[:] = img
+        else:
+            slot.retain()
+
+        def release(_):
+            slot.release()
+            self._in_flight.release()
+
+        return self._pool.apply_async(_run_detection, (slot.index,), callback=release, error_callback=release)
+
+    def close(self):
+        '''
+        Stops the workers
+
+        :returns None
+        '''
+        self._pool.terminate()
+        self._pool.join()
+        return None
@@ -0,0 +1,120 @@
+
+import queue as q
+from threading import Thread
+
+
+class RecordWriter:
+    '''
+    Writes frame records to a TP17Storage on a background thread.
+
+    Producers hand records to a bounded queue and never touch the disk themselves. The writer
+    thread takes records off the queue in batches and adds them to the storage, which writes
+    a segment whenever its buffer fills. When the queue is full, BLOCK waits up to block_timeout
+    for space (backpressure) and DROP throws the record away, either way dropped records are counted.
+    close() writes everything still queued and flushes the storage.
+
+    fields:
+        storage: TP17Storage the records end up in
+        policy: BLOCK or DROP
+        written: number of records added to the storage
+        dropped: number of records thrown away because the queue was full
+        errors: number of records the storage raised on, eg. an OSError writing a segment. the writer
+                carries on with the next one
+    '''
+    BLOCK = 'block'
+    DROP = 'drop'
+
+    def __init__(self, storage, capacity=1024, policy=DROP, batch_size=256, block_timeout=0.1):
+        if policy not in (self.BLOCK, self.DROP):
+            raise ValueError("Unknown queue policy '{}'".format(policy))
+        self.storage = storage
+        self.policy = policy
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = q.Queue(capacity)
+        self._closed = False
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, frame, camera=0, rig=0):
+        '''
+        Queues a record of an analysed frame, see TP17Storage.add
+
+        :param frame: Frame with counts and movements set
+        :param camera: device number the frame came from
+        :param rig: id of the stereo rig the camera belongs to
+
+        :returns True if the record was queued
+        '''
+        # only the count arrays are kept, they belong to the frame alone. its image can be reused once this returns
+        record = (frame.time_now.timestamp(), camera, frame.counts, frame.movements, rig)
+        return self.submit_record(record)
+
+    def submit_record(self, record):
+        '''
+        :param record: (time, camera, counts, movements[, rig]) as taken by TP17Storage.add_row
+
+        :returns True if the record was queued
+        '''
+        if self._closed:
+            raise ValueError("Writer is closed")
+        try:
+            if self.policy == self.BLOCK:
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+            return True
+        except q.Full:
+            self.dropped += 1
+            return False
+
+    def pending(self):
+        '''
+        :returns number of records waiting to be written
+        '''
+        return self._queue.qsize()
+
+    def close(self):
+        '''
+        Writes out whatever is still queued, flushes the storage and stops the thread
+
+        :returns None
+        '''
+        if self._closed:
+            return None
+        self._closed = True
+        # waits for the writer to make room if the queue is full, the sentinel must not be dropped.
+        # a writer thread that is gone will never make room
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=self.block_timeout)
+                break
+            except q.Full:
+                continue
+        self._thread.join()
+        self.storage.save()
+        return None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # take whatever else is already waiting, up to a batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except q.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    return None
+                try:
+                    self.storage.add_row(*record)
+                except Exception as error:
+                    self.errors += 1
+                    print("Couldn't store a record: {!r}".format(error))
+                    continue
+                self.written += 1